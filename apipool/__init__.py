@@ -16,3 +16,8 @@ try:
     from .stats import StatusCollection
 except Exception as e:  # pragma: no cover
     pass
+
+try:
+    from .aio import AsyncApiKeyManager
+except Exception as e:  # pragma: no cover
+    pass
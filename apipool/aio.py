@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio support, Python3 only.
+
+``await manager.dummyclient.some_method(...)`` picks an api key, awaits the
+client method, then records the real outcome. Usage events always go
+through the background stats writer, so the event loop never waits for the
+database.
+"""
+
+import asyncio
+import inspect
+
+from .manager import ApiKeyManager
+from .hooks import run_before_call, run_after_call, run_on_error
+from .clock import clock
+from .retry import should_give_up
+from .revival import ArchiveReason
+from .stats import StatusCollection
+from .writer import OverflowPolicy
+
+
+class AsyncApiCaller(object):
+    def __init__(self, apikey_manager, method_name):
+        self.apikey_manager = apikey_manager
+        self.method_name = method_name
+
+    async def __call__(self, *args, **kwargs):
+        manager = self.apikey_manager
+        policy = manager.retry_policy
+        if policy is None:
+            apikey = await manager.select_one_async()
+            return await self._call(apikey, args, kwargs)
+
+        retry_exc = (manager.reach_limit_exc,) + policy.transient_exc
+        tried = set()
+        attempt = 0
+        while True:
+            attempt += 1
+            apikey = await manager.select_one_async(exclude=tried)
+            tried.add(apikey.primary_key)
+            try:
+                return await self._call(apikey, args, kwargs)
+            except retry_exc as e:
+                if should_give_up(manager, policy, attempt, tried):
+                    raise e
+            wait_time = policy.get_wait_time(attempt)
+            if wait_time:
+                await asyncio.sleep(wait_time)
+
+    async def _call(self, apikey, args, kwargs):
+        manager = self.apikey_manager
+        hooks = manager.hooks
+        primary_key = apikey.primary_key
+        method_name = self.method_name
+        call_method = getattr(apikey._client, method_name)
+        if hooks:
+            run_before_call(hooks, primary_key, method_name, args, kwargs)
+        started_at = clock()
+        try:
+            res = call_method(*args, **kwargs)
+            if inspect.isawaitable(res):
+                res = await res
+        except manager.reach_limit_exc as e:
+            duration = clock() - started_at
+            manager.remove_one(primary_key, ArchiveReason.reach_limit)
+            await manager.add_event_async(
+                primary_key, StatusCollection.c9_ReachLimit.id,
+                duration, method_name,
+            )
+            if hooks:
+                run_on_error(
+                    hooks, primary_key, method_name, args, kwargs,
+                    duration, e,
+                )
+            raise e
+        except Exception as e:
+            duration = clock() - started_at
+            await manager.add_event_async(
+                primary_key, StatusCollection.c5_Failed.id,
+                duration, method_name,
+            )
+            if hooks:
+                run_on_error(
+                    hooks, primary_key, method_name, args, kwargs,
+                    duration, e,
+                )
+            raise e
+        duration = clock() - started_at
+        await manager.add_event_async(
+            primary_key, StatusCollection.c1_Success.id,
+            duration, method_name,
+        )
+        if hooks:
+            run_after_call(
+                hooks, primary_key, method_name, args, kwargs, duration, res)
+        return res
+
+
+class AsyncDummyClient(object):
+    def __init__(self):
+        self._apikey_manager = None
+
+    def __getattr__(self, item):
+        return AsyncApiCaller(
+            apikey_manager=self._apikey_manager,
+            method_name=item,
+        )
+
+
+class AsyncApiKeyManager(ApiKeyManager):
+    """
+    :class:`~apipool.manager.ApiKeyManager` for asyncio. Accept the same
+    arguments, except ``async_stats`` is always enabled.
+
+    Client methods can be either coroutine functions or regular functions,
+    regular functions are called directly in the event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs["async_stats"] = True
+        super(AsyncApiKeyManager, self).__init__(*args, **kwargs)
+        self.dummyclient = AsyncDummyClient()
+        self.dummyclient._apikey_manager = self
+
+    async def select_one_async(self, exclude=None):
+        """
+        Same as :meth:`~apipool.manager.ApiKeyManager.select_one`, but waits
+        for rate limit refill with ``asyncio.sleep``.
+        """
+        if (not self._rate_limiters) and (self.shared_state is None):
+            return self.select_one(exclude=exclude)
+
+        started_at = clock()
+        while True:
+            apikey, wait_time = self._try_select_one(started_at, exclude)
+            if apikey is not None:
+                return apikey
+            await asyncio.sleep(wait_time)
+
+    async def add_event_async(self,
+                              primary_key,
+                              status_id,
+                              duration=None,
+                              method_name=None):
+        """
+        Enqueue an usage event. If the queue is full and the overflow policy
+        is ``block``, wait in a thread instead of blocking the event loop.
+        """
+        writer = self.stats_writer
+        if (writer.overflow_policy == OverflowPolicy.block) and \
+                writer.is_full:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                None, writer.add_event, primary_key, status_id, duration,
+            )
+        else:
+            writer.add_event(primary_key, status_id, duration)
+        self._on_event(primary_key, status_id, duration, method_name)
+
+    async def flush_async(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.flush)
+
+    async def close_async(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close_async()
@@ -11,8 +11,21 @@ class ApiKey(object):
     - :meth:`ApiKey.user_01_get_primary_key`.
     - :meth:`ApiKey.user_02_create_client`.
     - :meth:`ApiKey.user_03_test_usable`.
+
+    Optionally, declare ``rate_limits`` as a list of ``(max_calls, period)``
+    tuple, for example ``[(10, 1), (2500, 86400)]``, then
+    :class:`~apipool.manager.ApiKeyManager` stops using this key before it
+    exceeds the limit.
+
+    Optionally, declare ``revival_cooldown`` as seconds, or a dict of
+    :class:`~apipool.revival.ArchiveReason` to seconds, to override the
+    cooldown before an archived key is tested again by
+    :class:`~apipool.revival.RevivalScheduler`.
     """
 
+    rate_limits = None
+    revival_cooldown = None
+
     _client = None
     _apikey_manager = None
 
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stats backends. :class:`BaseStatsCollector` is the interface used by
+:class:`~apipool.manager.ApiKeyManager`, pick the one that fits the overhead
+you are willing to pay:
+
+- :class:`~apipool.stats.StatsCollector`: sqlalchemy database backed, full
+  event history and event query.
+- :class:`MemoryStatsCollector`: compact in process event log, bounded by
+  a retention period.
+- :class:`NullStatsCollector`: discard everything, zero cost.
+"""
+
+import time
+import bisect
+import threading
+from array import array
+from datetime import datetime
+from collections import OrderedDict
+
+from .window import to_timestamp
+
+
+class BaseStatsCollector(object):
+    """
+    Stats backend abstract class.
+    """
+
+    def add_all_apikey(self, apikey_list):
+        """
+        Register api keys, events can only be added for registered keys.
+        """
+        raise NotImplementedError
+
+    def add_event(self,
+                  primary_key,
+                  status_id,
+                  finished_at=None,
+                  duration=None):
+        """
+        :param finished_at: naive local ``datetime``, or epoch seconds,
+            default is now.
+        :param duration: call duration in seconds, optional.
+        """
+        raise NotImplementedError
+
+    def add_events(self, event_data_list):
+        """
+        :param event_data_list: list of
+            ``(primary_key, status_id, finished_at[, duration])`` tuple.
+        """
+        for event_data in event_data_list:
+            self.add_event(*event_data)
+
+    def flush(self):
+        """
+        Persist pending events.
+
+        :return: number of events been flushed.
+        """
+        return 0
+
+    def maybe_rollup(self):
+        """
+        Run the periodic rollup if it is due, called by the background
+        :class:`~apipool.writer.StatsWriter` between writes.
+
+        :return: whether the rollup ran.
+        """
+        return False
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def usage_count_in_recent_n_seconds(self,
+                                        n_seconds,
+                                        primary_key=None,
+                                        status_id=None):
+        raise NotImplementedError
+
+    def usage_count_stats_in_recent_n_seconds(self, n_seconds):
+        """
+        :return: OrderedDict, primary key -> number of events, sorted by
+            primary key, keys without event are excluded.
+        """
+        raise NotImplementedError
+
+
+class NullStatsCollector(BaseStatsCollector):
+    """
+    Discard all events, every count is 0.
+    """
+
+    def add_all_apikey(self, apikey_list):
+        pass
+
+    def add_event(self,
+                  primary_key,
+                  status_id,
+                  finished_at=None,
+                  duration=None):
+        pass
+
+    def add_events(self, event_data_list):
+        pass
+
+    def usage_count_in_recent_n_seconds(self,
+                                        n_seconds,
+                                        primary_key=None,
+                                        status_id=None):
+        return 0
+
+    def usage_count_stats_in_recent_n_seconds(self, n_seconds):
+        return OrderedDict()
+
+
+class _EventLog(object):
+    """
+    Events of one api key, sorted by finish time. ``offset`` is the position
+    of the first event still in retention.
+    """
+    __slots__ = ("timestamps", "status_ids", "offset")
+
+    def __init__(self):
+        self.timestamps = array("d")
+        self.status_ids = array("H")
+        self.offset = 0
+
+    def add(self, timestamp, status_id):
+        position = bisect.bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(position, timestamp)
+        self.status_ids.insert(position, status_id)
+
+    def expire(self, before):
+        self.offset = max(
+            self.offset, bisect.bisect_left(self.timestamps, before))
+        # compact once at least half of the log is expired
+        if self.offset and (self.offset * 2 >= len(self.timestamps)):
+            del self.timestamps[:self.offset]
+            del self.status_ids[:self.offset]
+            self.offset = 0
+
+    def count(self, since, status_id=None):
+        start = max(self.offset, bisect.bisect_left(self.timestamps, since))
+        if status_id is None:
+            return len(self.timestamps) - start
+        return self.status_ids[start:].count(status_id)
+
+
+class MemoryStatsCollector(BaseStatsCollector):
+    """
+    Keep events in memory, about 10 bytes per event. Call duration is not
+    kept.
+
+    :param retention: events older than this many seconds are discarded,
+        queries can't look back further than that.
+    """
+
+    def __init__(self, retention=86400):
+        self.retention = retention
+        self._logs = dict()
+        self._lock = threading.Lock()
+
+    def add_all_apikey(self, apikey_list):
+        with self._lock:
+            for apikey in apikey_list:
+                self._logs.setdefault(apikey.primary_key, _EventLog())
+
+    def add_event(self,
+                  primary_key,
+                  status_id,
+                  finished_at=None,
+                  duration=None):
+        if finished_at is None:
+            timestamp = time.time()
+        elif isinstance(finished_at, datetime):
+            timestamp = to_timestamp(finished_at)
+        else:
+            timestamp = finished_at
+        log = self._logs[primary_key]
+        with self._lock:
+            log.add(timestamp, status_id)
+            log.expire(timestamp - self.retention)
+
+    def usage_count_in_recent_n_seconds(self,
+                                        n_seconds,
+                                        primary_key=None,
+                                        status_id=None):
+        since = time.time() - n_seconds
+        with self._lock:
+            if primary_key is None:
+                logs = list(self._logs.values())
+            else:
+                logs = [self._logs[primary_key], ]
+            return sum(log.count(since, status_id) for log in logs)
+
+    def usage_count_stats_in_recent_n_seconds(self, n_seconds):
+        since = time.time() - n_seconds
+        stats = list()
+        with self._lock:
+            for primary_key, log in self._logs.items():
+                count = log.count(since)
+                if count:
+                    stats.append((primary_key, count))
+        return OrderedDict(sorted(stats))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bulk concurrent api calls over the key pool. A pool of worker threads calls
+a client method for each input, inputs are read lazily and at most
+``2 * concurrency`` of them are in flight or waiting to be yielded, so
+memory use stays bounded no matter how long the input is.
+"""
+
+import threading
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from .retry import RetryPolicy, FailoverCaller
+
+_STOP = object()
+
+
+def to_args(item):
+    """
+    An input item is the positional arguments tuple of one call, any other
+    value is the single argument.
+    """
+    if isinstance(item, tuple):
+        return item
+    return (item,)
+
+
+def _worker(caller, tasks, done):
+    while True:
+        task = tasks.get()
+        if task is _STOP:
+            return
+        index, item = task
+        try:
+            done.put((index, True, caller(*to_args(item))))
+        except Exception as e:
+            done.put((index, False, e))
+
+
+def imap(apikey_manager,
+         method_name,
+         iterable,
+         concurrency=10,
+         ordered=True,
+         return_exceptions=False,
+         max_attempts=None):
+    """
+    Generator of call results, see :meth:`ApiKeyManager.map
+    <apipool.manager.ApiKeyManager.map>`.
+    """
+    retry_policy = apikey_manager.retry_policy
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_attempts=None)
+    if max_attempts is not None:
+        retry_policy = retry_policy.copy(max_attempts=max_attempts)
+    caller = FailoverCaller(apikey_manager, method_name, retry_policy)
+
+    concurrency = max(int(concurrency), 1)
+    max_pending = 2 * concurrency
+    tasks = queue.Queue()
+    done = queue.Queue()
+    workers = list()
+    for _ in range(concurrency):
+        worker = threading.Thread(
+            target=_worker, args=(caller, tasks, done),
+        )
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    iterator = iter(iterable)
+    exhausted = False
+    n_submitted = 0
+    n_yielded = 0
+    finished = dict()  # index -> (ok, value), ordered mode only
+    try:
+        while True:
+            while (not exhausted) and (n_submitted - n_yielded < max_pending):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                tasks.put((n_submitted, item))
+                n_submitted += 1
+            if n_yielded == n_submitted:
+                return
+
+            index, ok, value = done.get()
+            if ordered:
+                finished[index] = (ok, value)
+                ready = list()
+                while n_yielded + len(ready) in finished:
+                    ready.append(finished.pop(n_yielded + len(ready)))
+            else:
+                ready = [(ok, value), ]
+
+            for ok, value in ready:
+                n_yielded += 1
+                if ok or return_exceptions:
+                    yield value
+                else:
+                    raise value
+    finally:
+        # stop workers, unstarted calls are discarded
+        try:
+            while True:
+                tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in workers:
+            tasks.put(_STOP)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Monotonic clock shared by rate limiting, stats, strategies and hooks, falls
+back to the wall clock where ``time.monotonic`` is not available.
+"""
+
+import time
+
+try:
+    clock = time.monotonic
+except AttributeError:  # pragma: no cover
+    clock = time.time
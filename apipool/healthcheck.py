@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent api key health check. Each key is tested by
+:meth:`~apipool.apikey.ApiKey.user_03_test_usable` in a worker thread, with
+a limited number of checks running at the same time and a per key timeout.
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from .clock import clock
+
+
+class HealthStatus(object):
+    usable = "usable"
+    failed = "failed"
+    timeout = "timeout"
+
+
+class HealthCheckResult(object):
+    """
+    :param primary_key: primary key of the api key.
+    :param status: one of :class:`HealthStatus`.
+    :param latency: seconds the check took, for timed out check it is the
+        timeout.
+    :param error: the exception raised by the check, if any.
+    """
+
+    def __init__(self, primary_key, status, latency, error=None):
+        self.primary_key = primary_key
+        self.status = status
+        self.latency = latency
+        self.error = error
+
+    @property
+    def is_usable(self):
+        return self.status == HealthStatus.usable
+
+    def __repr__(self):
+        return (
+            "HealthCheckResult(primary_key=%r, status=%r, "
+            "latency=%.3f, error=%r)"
+        ) % (self.primary_key, self.status, self.latency, self.error)
+
+
+class HealthCheckReport(object):
+    """
+    Health check results in the original api key order.
+    """
+
+    def __init__(self, results):
+        self.results = OrderedDict(
+            (result.primary_key, result) for result in results
+        )
+
+    def _filter(self, status):
+        return [
+            primary_key
+            for primary_key, result in self.results.items()
+            if result.status == status
+        ]
+
+    @property
+    def usable(self):
+        return self._filter(HealthStatus.usable)
+
+    @property
+    def failed(self):
+        return self._filter(HealthStatus.failed)
+
+    @property
+    def timed_out(self):
+        return self._filter(HealthStatus.timeout)
+
+    def __str__(self):
+        lines = [
+            "%s usable, %s failed, %s timed out." % (
+                len(self.usable), len(self.failed), len(self.timed_out),
+            ),
+        ]
+        for result in self.results.values():
+            if not result.is_usable:
+                lines.append("    %s: %s, %.3f seconds, %r" % (
+                    result.primary_key, result.status,
+                    result.latency, result.error,
+                ))
+        return "\n".join(lines)
+
+
+def check_one(apikey):
+    """
+    Test one api key, connect the client if it is not connected yet.
+
+    :rtype: HealthCheckResult
+    """
+    started_at = clock()
+    error = None
+    try:
+        if apikey._client is None:
+            apikey.connect_client()
+        usable = bool(apikey.user_03_test_usable(apikey._client))
+    except Exception as e:
+        usable = False
+        error = e
+    return HealthCheckResult(
+        primary_key=apikey.primary_key,
+        status=HealthStatus.usable if usable else HealthStatus.failed,
+        latency=clock() - started_at,
+        error=error,
+    )
+
+
+def check_apikeys(apikey_list, parallelism=10, timeout=None):
+    """
+    Test many api keys concurrently.
+
+    A check which doesn't finish in ``timeout`` seconds is reported as timed
+    out and its worker thread is abandoned, it no longer counts against
+    ``parallelism``.
+
+    :param apikey_list: list of :class:`~apipool.apikey.ApiKey`.
+    :param parallelism: max number of checks running at the same time.
+    :param timeout: per key timeout in seconds, None means no timeout.
+
+    :rtype: HealthCheckReport
+    """
+    pending = deque(apikey_list)
+    running = dict()  # primary key -> deadline
+    results = dict()
+    done = queue.Queue()
+
+    def run(apikey):
+        done.put(check_one(apikey))
+
+    while pending or running:
+        while pending and (len(running) < max(parallelism, 1)):
+            apikey = pending.popleft()
+            deadline = None if timeout is None else clock() + timeout
+            running[apikey.primary_key] = deadline
+            thread = threading.Thread(target=run, args=(apikey,))
+            thread.daemon = True
+            thread.start()
+
+        deadlines = [d for d in running.values() if d is not None]
+        wait = None
+        if deadlines:
+            wait = max(min(deadlines) - clock(), 0)
+        try:
+            result = done.get(timeout=wait)
+            if result.primary_key in running:
+                del running[result.primary_key]
+                results[result.primary_key] = result
+        except queue.Empty:
+            pass
+
+        now = clock()
+        for primary_key, deadline in list(running.items()):
+            if (deadline is not None) and (now >= deadline):
+                del running[primary_key]
+                results[primary_key] = HealthCheckResult(
+                    primary_key=primary_key,
+                    status=HealthStatus.timeout,
+                    latency=timeout,
+                )
+
+    return HealthCheckReport(
+        [results[apikey.primary_key] for apikey in apikey_list]
+    )
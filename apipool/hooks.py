@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Middleware around api calls, for timing, tracing, argument sampling and
+profiling without touching :class:`~apipool.manager.ApiCaller`.
+
+Hooks registered on :class:`~apipool.manager.ApiKeyManager` see every call
+made through ``dummyclient``. ``before_call`` runs in registration order,
+``after_call`` and ``on_error`` run in reverse order, like nested context
+managers. ``elapsed`` is the duration of the client method alone.
+``after_call`` and ``on_error`` run once the usage event is recorded, so a
+failing hook never loses the event. With no hook registered, a call only
+pays for a truth test.
+"""
+
+import heapq
+import random
+import threading
+import collections
+
+
+class CallHook(object):
+    """
+    Base class of call hooks, override any of the methods. Exceptions
+    raised by a hook propagate to the caller.
+    """
+
+    def before_call(self, primary_key, method_name, args, kwargs):
+        pass
+
+    def after_call(self,
+                   primary_key, method_name, args, kwargs,
+                   elapsed, result):
+        """
+        :param elapsed: call duration in seconds.
+        """
+        pass
+
+    def on_error(self,
+                 primary_key, method_name, args, kwargs,
+                 elapsed, error):
+        """
+        :param elapsed: call duration in seconds.
+        """
+        pass
+
+
+def run_before_call(hooks, primary_key, method_name, args, kwargs):
+    for hook in hooks:
+        hook.before_call(primary_key, method_name, args, kwargs)
+
+
+def run_after_call(hooks,
+                   primary_key, method_name, args, kwargs,
+                   elapsed, result):
+    for hook in reversed(hooks):
+        hook.after_call(
+            primary_key, method_name, args, kwargs, elapsed, result)
+
+
+def run_on_error(hooks,
+                 primary_key, method_name, args, kwargs,
+                 elapsed, error):
+    for hook in reversed(hooks):
+        hook.on_error(primary_key, method_name, args, kwargs, elapsed, error)
+
+
+CallRecord = collections.namedtuple(
+    "CallRecord",
+    "elapsed primary_key method_name args kwargs error",
+)
+
+
+class SlowestCallsProfiler(CallHook):
+    """
+    Keep the ``n`` slowest calls, with their arguments and error if any.
+
+    :param n: number of calls to keep.
+    :param sample_rate: 0 ~ 1, fraction of calls looked at.
+    """
+
+    def __init__(self, n=10, sample_rate=1.0):
+        self.n = n
+        self.sample_rate = sample_rate
+        self._heap = list()  # min heap of (elapsed, seq, CallRecord)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _record(self, primary_key, method_name, args, kwargs, elapsed, error):
+        if (self.sample_rate < 1) and (random.random() >= self.sample_rate):
+            return
+        heap = self._heap
+        # fast path without lock, most calls are not among the slowest
+        if (len(heap) >= self.n) and (elapsed <= heap[0][0]):
+            return
+        record = CallRecord(
+            elapsed, primary_key, method_name, args, kwargs, error,
+        )
+        with self._lock:
+            self._seq += 1
+            item = (elapsed, self._seq, record)
+            if len(heap) < self.n:
+                heapq.heappush(heap, item)
+            elif elapsed > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    def after_call(self,
+                   primary_key, method_name, args, kwargs,
+                   elapsed, result):
+        self._record(primary_key, method_name, args, kwargs, elapsed, None)
+
+    def on_error(self,
+                 primary_key, method_name, args, kwargs,
+                 elapsed, error):
+        self._record(primary_key, method_name, args, kwargs, elapsed, error)
+
+    def get_slowest(self):
+        """
+        :return: list of :class:`CallRecord`, the slowest first.
+        """
+        with self._lock:
+            items = sorted(self._heap, reverse=True)
+        return [record for _, _, record in items]
+
+    def reset(self):
+        with self._lock:
+            del self._heap[:]
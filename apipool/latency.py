@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In memory latency histograms per api key and per client method.
+
+Durations are bucketed HDR style: in microseconds, every power of 2 range is
+split into ``sub_buckets / 2`` linear buckets, so a percentile is reported
+within ``2 / sub_buckets`` relative error, and memory and percentile queries
+are ``O(buckets)`` no matter how many calls are recorded.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LatencyHistogram(object):
+    """
+    :param precision_bits: ``sub_buckets = 2 ** precision_bits``, 6 means
+        about 3% relative error.
+    """
+    __slots__ = (
+        "precision_bits", "sub_buckets", "half",
+        "counts", "count", "total", "max",
+    )
+
+    def __init__(self, precision_bits=6):
+        self.precision_bits = precision_bits
+        self.sub_buckets = 2 ** precision_bits
+        self.half = self.sub_buckets // 2
+        self.counts = list()
+        self.count = 0
+        self.total = 0  # microseconds
+        self.max = 0  # microseconds
+
+    def _index(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.precision_bits
+        return self.sub_buckets + (shift - 1) * self.half + \
+            (value >> shift) - self.half
+
+    def _value(self, index):
+        """
+        Middle value of the bucket, in microseconds.
+        """
+        if index < self.sub_buckets:
+            return index
+        shift, mantissa = divmod(index - self.sub_buckets, self.half)
+        shift += 1
+        mantissa += self.half
+        return ((mantissa << shift) + ((mantissa + 1) << shift) - 1) // 2
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = self._index(value)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0, ] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend(
+                [0, ] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        histogram = LatencyHistogram(precision_bits=self.precision_bits)
+        histogram.merge(self)
+        return histogram
+
+    @property
+    def mean(self):
+        """
+        Mean duration in seconds, None if empty.
+        """
+        if not self.count:
+            return None
+        return self.total / 1000000.0 / self.count
+
+    def percentile(self, q):
+        """
+        :param q: percentile, 0 ~ 100.
+        :return: duration in seconds, None if empty.
+        """
+        if not self.count:
+            return None
+        rank = max(q / 100.0 * self.count, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1000000.0
+        return self.max / 1000000.0  # pragma: no cover
+
+    def percentiles(self, q_list=(50, 95, 99)):
+        """
+        :return: OrderedDict, percentile -> duration in seconds.
+        """
+        return OrderedDict((q, self.percentile(q)) for q in q_list)
+
+
+class LatencyRecorder(object):
+    """
+    Latency histogram of each api key and each client method, thread safe.
+
+    :param precision_bits: see :class:`LatencyHistogram`.
+    """
+
+    def __init__(self, precision_bits=6):
+        self.precision_bits = precision_bits
+        self.by_key = dict()
+        self.by_method = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, histograms, name):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = LatencyHistogram(precision_bits=self.precision_bits)
+            histograms[name] = histogram
+        return histogram
+
+    def record(self, primary_key, method_name, seconds):
+        with self._lock:
+            self._get(self.by_key, primary_key).record(seconds)
+            self._get(self.by_method, method_name).record(seconds)
+
+    def get_histogram(self, primary_key=None, method_name=None):
+        """
+        Copy of the histogram of an api key, or a method, or of all calls
+        if neither is given.
+
+        :rtype: LatencyHistogram
+        """
+        if (primary_key is not None) and (method_name is not None):
+            raise ValueError(
+                "histograms are kept per api key or per method, not both!")
+        with self._lock:
+            if primary_key is not None:
+                histograms = [self.by_key.get(primary_key), ]
+            elif method_name is not None:
+                histograms = [self.by_method.get(method_name), ]
+            else:
+                histograms = list(self.by_key.values())
+            result = LatencyHistogram(precision_bits=self.precision_bits)
+            for histogram in histograms:
+                if histogram is not None:
+                    result.merge(histogram)
+        return result
+
+    def percentiles(self,
+                    primary_key=None,
+                    method_name=None,
+                    q_list=(50, 95, 99)):
+        """
+        :return: OrderedDict, percentile -> duration in seconds.
+        """
+        return self.get_histogram(
+            primary_key=primary_key, method_name=method_name,
+        ).percentiles(q_list)
+
+    def reset(self):
+        with self._lock:
+            self.by_key.clear()
+            self.by_method.clear()
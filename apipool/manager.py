@@ -6,12 +6,29 @@ built-in stats collector service for api usage and status.
 """
 
 import sys
+import time
 import random
+import threading
 from collections import OrderedDict
+from sqlalchemy.pool import StaticPool
 from sqlalchemy_mate import engine_creator
 
 from .apikey import ApiKey
+from .clock import clock
 from .stats import StatusCollection, StatsCollector
+from .backends import BaseStatsCollector
+from .writer import OverflowPolicy, StatsWriter
+from .strategy import SelectionStrategy, RandomStrategy
+from .ratelimit import (
+    RateLimiter, RateLimitedError, normalize_rate_limits,
+)
+from .healthcheck import check_apikeys
+from .bulk import imap
+from .retry import RetryPolicy, FailoverCaller
+from .revival import ArchiveReason, RevivalScheduler
+from .latency import LatencyRecorder
+from .metrics import Metrics
+from .hooks import CallHook, run_before_call, run_after_call, run_on_error
 
 
 def validate_is_apikey(obj):
@@ -20,45 +37,86 @@ def validate_is_apikey(obj):
 
 
 class ApiCaller(object):
-    def __init__(self, apikey, apikey_manager, call_method, reach_limit_exc):
+    """
+    Call ``call_method``, measure its duration and record the outcome.
+    Callers are cached by :class:`ApiKeyManager` per api key and method name.
+    """
+    __slots__ = (
+        "apikey", "primary_key", "apikey_manager",
+        "method_name", "call_method", "reach_limit_exc",
+    )
+
+    def __init__(self,
+                 apikey,
+                 apikey_manager,
+                 call_method,
+                 reach_limit_exc,
+                 method_name=None):
         self.apikey = apikey
+        self.primary_key = apikey.primary_key
         self.apikey_manager = apikey_manager
+        self.method_name = method_name
         self.call_method = call_method
         self.reach_limit_exc = reach_limit_exc
 
     def __call__(self, *args, **kwargs):
+        hooks = self.apikey_manager.hooks
+        if hooks:
+            run_before_call(
+                hooks, self.primary_key, self.method_name, args, kwargs)
+        started_at = clock()
         try:
             res = self.call_method(*args, **kwargs)
-            self.apikey_manager.stats.add_event(
-                self.apikey.primary_key, StatusCollection.c1_Success.id,
-            )
-            return res
         except self.reach_limit_exc as e:
-            self.apikey_manager.remove_one(self.apikey.primary_key)
-            self.apikey_manager.stats.add_event(
-                self.apikey.primary_key, StatusCollection.c9_ReachLimit.id,
+            duration = clock() - started_at
+            self.apikey_manager.remove_one(
+                self.primary_key, ArchiveReason.reach_limit)
+            self.apikey_manager.add_event(
+                self.primary_key, StatusCollection.c9_ReachLimit.id,
+                duration, self.method_name,
             )
+            if hooks:
+                run_on_error(
+                    hooks, self.primary_key, self.method_name, args, kwargs,
+                    duration, e,
+                )
             raise e
         except Exception as e:
-            self.apikey_manager.stats.add_event(
-                self.apikey.primary_key, StatusCollection.c5_Failed.id,
+            duration = clock() - started_at
+            self.apikey_manager.add_event(
+                self.primary_key, StatusCollection.c5_Failed.id,
+                duration, self.method_name,
             )
+            if hooks:
+                run_on_error(
+                    hooks, self.primary_key, self.method_name, args, kwargs,
+                    duration, e,
+                )
             raise e
+        duration = clock() - started_at
+        self.apikey_manager.add_event(
+            self.primary_key, StatusCollection.c1_Success.id,
+            duration, self.method_name,
+        )
+        if hooks:
+            run_after_call(
+                hooks, self.primary_key, self.method_name, args, kwargs,
+                duration, res,
+            )
+        return res
 
 
 class DummyClient(object):
+    __slots__ = ("_apikey_manager",)
+
     def __init__(self):
         self._apikey_manager = None
 
     def __getattr__(self, item):
-        apikey = self._apikey_manager.random_one()
-        call_method = getattr(apikey._client, item)
-        return ApiCaller(
-            apikey=apikey,
-            apikey_manager=self._apikey_manager,
-            call_method=call_method,
-            reach_limit_exc=self._apikey_manager.reach_limit_exc,
-        )
+        manager = self._apikey_manager
+        if manager.retry_policy is None:
+            return manager.get_caller(manager.select_one(), item)
+        return manager.get_failover_caller(item)
 
 
 class NeverRaisesError(Exception):
@@ -68,20 +126,118 @@ class NeverRaisesError(Exception):
 class ApiKeyManager(object):
     _settings_api_client_class = None
 
-    def __init__(self, apikey_list, reach_limit_exc=None, db_engine=None):
+    def __init__(self,
+                 apikey_list,
+                 reach_limit_exc=None,
+                 db_engine=None,
+                 stats_buffer_size=None,
+                 stats_buffer_max_age=None,
+                 stats_window=None,
+                 async_stats=False,
+                 stats_queue_size=10000,
+                 stats_overflow_policy=OverflowPolicy.block,
+                 stats_store_duration=False,
+                 strategy=None,
+                 rate_limits=None,
+                 rate_limit_wait=False,
+                 shared_state=None,
+                 stats=None,
+                 retry_policy=None,
+                 revival=None,
+                 latency=None,
+                 metrics=None,
+                 hooks=None):
         # validate
         for apikey in apikey_list:
             validate_is_apikey(apikey)
 
-        # stats collector
-        if db_engine is None:
-            db_engine = engine_creator.create_sqlite()
-
-        self.stats = StatsCollector(engine=db_engine)
+        # stats collector, a custom stats backend takes priority over the
+        # ``db_engine`` and ``stats_*`` arguments
+        if stats is None:
+            if db_engine is None:
+                # share one connection across threads, otherwise each thread
+                # would see its own empty in memory database
+                db_engine = engine_creator.create_sqlite(
+                    connect_args={"check_same_thread": False},
+                    poolclass=StaticPool,
+                )
+            stats = StatsCollector(
+                engine=db_engine,
+                buffer_size=stats_buffer_size,
+                buffer_max_age=stats_buffer_max_age,
+                window=stats_window,
+                store_duration=stats_store_duration,
+            )
+        if not isinstance(stats, BaseStatsCollector):  # pragma: no cover
+            raise TypeError
+        self.stats = stats
         self.stats.add_all_apikey(apikey_list)
 
-        # initiate apikey chain data
+        self.stats_writer = None
+        if async_stats:
+            self.stats_writer = StatsWriter(
+                stats=self.stats,
+                maxsize=stats_queue_size,
+                overflow_policy=stats_overflow_policy,
+            ).start()
+
+        # key selection strategy
+        if strategy is None:
+            strategy = RandomStrategy()
+        if not isinstance(strategy, SelectionStrategy):  # pragma: no cover
+            raise TypeError
+        self.strategy = strategy
+        self.strategy.bind(self)
+        self._strategy_wants_result = strategy.wants_result
+
+        # cross process key state, see :class:`apipool.shm.SharedKeyState`
+        self.shared_state = shared_state
+
+        # rate limit, ``ApiKey.rate_limits`` takes priority
+        self.rate_limits = normalize_rate_limits(rate_limits)
+        self.rate_limit_wait = rate_limit_wait
+        self._rate_limiters = dict()
+
+        # guards mutation of the apikey chains, the dispatch path reads them
+        # without lock
+        self._lock = threading.RLock()
+
+        # ``id(apikey)`` -> {method name: ApiCaller}
+        self._caller_cache = dict()
+
+        # call middleware, see :class:`apipool.hooks.CallHook`. A tuple
+        # replaced on change, so the dispatch path reads it without lock
+        self.hooks = tuple()
+        for hook in (hooks or list()):
+            self.add_hook(hook)
+
+        # failover retry, see :class:`apipool.retry.RetryPolicy`
+        if retry_policy is not None:
+            if not isinstance(retry_policy, RetryPolicy):  # pragma: no cover
+                raise TypeError
+        self.retry_policy = retry_policy
+        self._failover_caller_cache = dict()
+
+        # latency histograms of successful calls, see
+        # :class:`apipool.latency.LatencyRecorder`
+        if latency is not None:
+            if not isinstance(latency, LatencyRecorder):  # pragma: no cover
+                raise TypeError
+        self.latency = latency
+
+        # in process counters and gauges, see :class:`apipool.metrics.Metrics`
+        if metrics is not None:
+            if not isinstance(metrics, Metrics):  # pragma: no cover
+                raise TypeError
+            metrics.bind(self)
+        self.metrics = metrics
+
+        # initiate apikey chain data, ``_apikey_list`` is an array backed
+        # index of ``apikey_chain`` values for O(1) random selection,
+        # ``_apikey_position`` maps primary key to the position in it.
         self.apikey_chain = OrderedDict()
+        self._apikey_list = list()
+        self._apikey_position = dict()
         for apikey in apikey_list:
             self.add_one(apikey, upsert=False)
 
@@ -93,6 +249,15 @@ class ApiKeyManager(object):
         self.dummyclient = DummyClient()
         self.dummyclient._apikey_manager = self
 
+        # revive archived keys in background, see
+        # :class:`apipool.revival.RevivalScheduler`
+        if revival is not None:
+            if not isinstance(revival, RevivalScheduler):  # pragma: no cover
+                raise TypeError
+            revival.bind(self)
+            revival.start()
+        self.revival = revival
+
     def add_one(self, apikey, upsert=False):
         validate_is_apikey(apikey)
         primary_key = apikey.primary_key
@@ -105,44 +270,395 @@ class ApiKeyManager(object):
             do_insert = True
 
         if do_insert:
+            # config errors raise before any mutation
+            rate_limits = normalize_rate_limits(apikey.rate_limits) or \
+                self.rate_limits
             try:
                 apikey.connect_client()
-                self.apikey_chain[primary_key] = apikey
             except Exception as e:  # pragma: no cover
                 sys.stdout.write(
                     "\nCan't create api client with {}, error: {}".format(
                         apikey.primary_key, e)
                 )
+            else:
+                with self._lock:
+                    if rate_limits and \
+                            (primary_key not in self._rate_limiters):
+                        self._rate_limiters[primary_key] = \
+                            self._create_rate_limiter(primary_key, rate_limits)
+                    old_apikey = self.apikey_chain.get(primary_key)
+                    if old_apikey is not None:
+                        self._caller_cache.pop(id(old_apikey), None)
+                    self._caller_cache.pop(id(apikey), None)
+                    self.apikey_chain[primary_key] = apikey
+                    self._index_add(primary_key, apikey)
+                    self.strategy.on_add(primary_key, apikey)
+                    if upsert and (self.shared_state is not None) and \
+                            self.shared_state.has_key(primary_key):
+                        self.shared_state.set_active(primary_key, True)
 
         # update stats collector
         self.stats.add_all_apikey([apikey, ])
 
+    def _create_rate_limiter(self, primary_key, rate_limits):
+        if (self.shared_state is not None) and \
+                self.shared_state.has_key(primary_key):
+            return self.shared_state.rate_limiter(primary_key, rate_limits)
+        return RateLimiter(rate_limits)
+
+    def add_event(self,
+                  primary_key,
+                  status_id,
+                  duration=None,
+                  method_name=None):
+        """
+        Record an usage event, through the background writer if enabled.
+
+        :param duration: call duration in seconds, optional.
+        :param method_name: client method name, optional.
+        """
+        if self.stats_writer is None:
+            self.stats.add_event(primary_key, status_id, duration=duration)
+        else:
+            self.stats_writer.add_event(primary_key, status_id, duration)
+        self._on_event(primary_key, status_id, duration, method_name)
+
+    def _on_event(self, primary_key, status_id, duration, method_name):
+        """
+        Update in memory state other than stats backend.
+        """
+        if self._strategy_wants_result:
+            self.strategy.on_result(primary_key, status_id, duration)
+        if (self.latency is not None) and (duration is not None) and \
+                (status_id == StatusCollection.c1_Success.id):
+            self.latency.record(primary_key, method_name, duration)
+        if self.metrics is not None:
+            self.metrics.record_call(primary_key, method_name, status_id)
+        if (self.shared_state is not None) and \
+                self.shared_state.has_key(primary_key):
+            self.shared_state.incr(primary_key, status_id)
+
+    def flush(self):
+        """
+        Block until all usage events are written to database.
+        """
+        if self.stats_writer is None:
+            self.stats.flush()
+        else:
+            self.stats_writer.flush()
+
+    def close(self):
+        if self.revival is not None:
+            self.revival.stop()
+        if self.stats_writer is not None:
+            self.stats_writer.join()
+        self.stats.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_hook(self, hook):
+        """
+        Register a :class:`~apipool.hooks.CallHook`, it wraps the hooks
+        registered before it.
+        """
+        if not isinstance(hook, CallHook):  # pragma: no cover
+            raise TypeError
+        with self._lock:
+            self.hooks = self.hooks + (hook,)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self.hooks = tuple(h for h in self.hooks if h is not hook)
+
     def fetch_one(self, primary_key):
         return self.apikey_chain[primary_key]
 
-    def remove_one(self, primary_key):
-        apikey = self.apikey_chain.pop(primary_key)
-        self.archived_apikey_chain[primary_key] = apikey
+    def _index_add(self, primary_key, apikey):
+        position = self._apikey_position.get(primary_key)
+        if position is None:
+            self._apikey_position[primary_key] = len(self._apikey_list)
+            self._apikey_list.append(apikey)
+        else:
+            self._apikey_list[position] = apikey
+
+    def _index_remove(self, primary_key):
+        """
+        Swap the last one into the removed position then pop, O(1).
+        """
+        position = self._apikey_position.pop(primary_key)
+        last = self._apikey_list.pop()
+        if position < len(self._apikey_list):
+            self._apikey_list[position] = last
+            self._apikey_position[last.primary_key] = position
+
+    def remove_one(self, primary_key, reason=ArchiveReason.manual):
+        """
+        Archive an api key.
+
+        :param reason: one of :class:`~apipool.revival.ArchiveReason`, decides
+            the cooldown before the revival scheduler tests it again.
+        """
+        with self._lock:
+            apikey = self.apikey_chain.pop(primary_key, None)
+            if apikey is None:  # already archived, maybe by another thread
+                return self.archived_apikey_chain[primary_key]
+            self._index_remove(primary_key)
+            self._caller_cache.pop(id(apikey), None)
+            self.strategy.on_remove(primary_key)
+            if (self.shared_state is not None) and \
+                    self.shared_state.has_key(primary_key):
+                self.shared_state.set_active(primary_key, False)
+            self.archived_apikey_chain[primary_key] = apikey
+            if self.revival is not None:
+                self.revival.on_archive(primary_key, apikey, reason)
+            return apikey
+
+    def revive_one(self, primary_key):
+        """
+        Move an archived api key back to ``apikey_chain``.
+
+        :return: the api key, None if it is not archived.
+        """
+        with self._lock:
+            apikey = self.archived_apikey_chain.pop(primary_key, None)
+            if apikey is None:
+                return None
+            self.add_one(apikey, upsert=True)
+            if primary_key not in self.apikey_chain:  # failed to connect
+                self.archived_apikey_chain[primary_key] = apikey
+                return None
+        if self.revival is not None:
+            self.revival.on_revive(primary_key)
         return apikey
 
+    def get_caller(self, apikey, method_name):
+        """
+        Get the cached :class:`ApiCaller` of the api key and method, create
+        one on first use.
+        """
+        try:
+            return self._caller_cache[id(apikey)][method_name]
+        except KeyError:
+            caller = ApiCaller(
+                apikey=apikey,
+                apikey_manager=self,
+                call_method=getattr(apikey._client, method_name),
+                reach_limit_exc=self.reach_limit_exc,
+                method_name=method_name,
+            )
+            callers = self._caller_cache.setdefault(id(apikey), dict())
+            callers[method_name] = caller
+            return caller
+
+    def get_failover_caller(self, method_name):
+        """
+        Get the cached :class:`~apipool.retry.FailoverCaller` of the method,
+        which picks an api key for each call and retries on other keys.
+        """
+        try:
+            return self._failover_caller_cache[method_name]
+        except KeyError:
+            caller = FailoverCaller(
+                apikey_manager=self,
+                method_name=method_name,
+                retry_policy=self.retry_policy,
+            )
+            self._failover_caller_cache[method_name] = caller
+            return caller
+
     def random_one(self):
-        return random.choice(list(self.apikey_chain.values()))
+        return random.choice(self._apikey_list)
+
+    def select_one(self, exclude=None):
+        """
+        Pick an api key for next api call by ``self.strategy``.
+
+        Keys which used up their rate limit are skipped. If all keys are
+        exhausted, wait for the earliest refill when ``rate_limit_wait`` is
+        True (or at most ``rate_limit_wait`` seconds if it is a number),
+        otherwise raise :class:`~apipool.ratelimit.RateLimitedError`.
+
+        :param exclude: set of primary keys to avoid, for example the keys
+            already tried by a failover call. An excluded key is only picked
+            if no other key is available, and never takes a rate limit token
+            just to be rejected.
+        """
+        if (not self._rate_limiters) and (self.shared_state is None):
+            apikey = self.strategy.select()
+            if exclude and (apikey.primary_key in exclude):
+                candidates = self._get_candidates(exclude)
+                if candidates:
+                    apikey = candidates[0]
+            return apikey
+
+        started_at = clock()
+        while True:
+            apikey, wait_time = self._try_select_one(started_at, exclude)
+            if apikey is not None:
+                return apikey
+            time.sleep(wait_time)
+
+    def _get_candidates(self, exclude):
+        """
+        Active api keys not in ``exclude`` in random order, then the
+        excluded ones.
+        """
+        untried, tried = list(), list()
+        for apikey in list(self._apikey_list):
+            if apikey.primary_key in exclude:
+                tried.append(apikey)
+            else:
+                untried.append(apikey)
+        random.shuffle(untried)
+        return untried + tried
+
+    def _try_select_one(self, started_at, exclude=None):
+        """
+        :return: ``(apikey, None)`` if a key is available, otherwise
+            ``(None, wait_time)``, or raise ``RateLimitedError`` if not
+            allowed to wait that long.
+        """
+        apikey = self._select_available(exclude)
+        if apikey is not None:
+            return apikey, None
+        if not self._apikey_list:
+            return self.strategy.select(), None  # raise error
+
+        wait_times = [
+            self._rate_limiters[key.primary_key].wait_time()
+            for key in list(self._apikey_list)
+            if key.primary_key in self._rate_limiters
+        ]
+        wait_time = min(wait_times) if wait_times else 0.0
+        if self.rate_limit_wait is False:
+            raise RateLimitedError(
+                "all api keys are rate limited, next one is available "
+                "in %.3f seconds" % wait_time
+            )
+        if self.rate_limit_wait is not True:
+            remaining = self.rate_limit_wait - (clock() - started_at)
+            if wait_time > remaining:
+                raise RateLimitedError(
+                    "all api keys are rate limited for more than "
+                    "%s seconds" % self.rate_limit_wait
+                )
+        return None, wait_time
 
-    def check_usable(self):
-        for primary_key, apikey in self.apikey_chain.items():
-            if apikey.is_usable():
-                self.stats.add_event(
+    def _is_available(self, apikey):
+        primary_key = apikey.primary_key
+        # archived by another process
+        state = self.shared_state
+        if (state is not None) and state.has_key(primary_key) and \
+                (not state.is_active(primary_key)):
+            self.remove_one(primary_key, ArchiveReason.shared)
+            return False
+        limiter = self._rate_limiters.get(primary_key)
+        return (limiter is None) or limiter.try_acquire()
+
+    def _select_available(self, exclude=None):
+        if not self._apikey_list:
+            return self.strategy.select()  # raise error
+        for _ in range(len(self._apikey_list)):
+            apikey = self.strategy.select()
+            if exclude and (apikey.primary_key in exclude):
+                break
+            if self._is_available(apikey):
+                return apikey
+        # strategy keeps picking exhausted or excluded keys, scan all
+        if exclude:
+            candidates = self._get_candidates(exclude)
+        else:
+            candidates = list(self._apikey_list)
+        for apikey in candidates:
+            if self._is_available(apikey):
+                return apikey
+        return None
+
+    def check_usable(self, parallelism=1, timeout=None):
+        """
+        Test all active api keys, archive the unusable ones, and record an
+        usage event for each key.
+
+        :param parallelism: max number of keys tested at the same time.
+        :param timeout: per key timeout in seconds, timed out key is
+            considered not usable.
+
+        :rtype: :class:`~apipool.healthcheck.HealthCheckReport`
+        """
+        report = check_apikeys(
+            list(self.apikey_chain.values()),
+            parallelism=parallelism,
+            timeout=timeout,
+        )
+        for primary_key, result in report.results.items():
+            if result.is_usable:
+                self.add_event(
                     primary_key, StatusCollection.c1_Success.id)
             else:
-                self.remove_one(primary_key)
-                self.stats.add_event(
+                self.remove_one(primary_key, ArchiveReason.failed)
+                self.add_event(
                     primary_key, StatusCollection.c5_Failed.id)
+        return report
 
-        if len(self.apikey_chain) == 0:
-            sys.stdout.write("\nThere's no API Key usable!")
-        elif len(self.archived_apikey_chain) == 0:
-            sys.stdout.write("\nAll API Key are usable.")
-        else:
-            sys.stdout.write("\nThese keys are not usable:")
-            for key in self.archived_apikey_chain:
-                sys.stdout.write("\n    %s: %r" % (key, apikey))
+    def map(self,
+            method_name,
+            iterable,
+            concurrency=10,
+            return_exceptions=False,
+            max_attempts=None):
+        """
+        Call client method ``method_name`` for each input concurrently, in a
+        pool of ``concurrency`` worker threads. Each call picks its own api
+        key, failed calls are retried on other keys according to
+        ``retry_policy``. Without a retry policy, a call failed with
+        ``reach_limit_exc`` is retried on each active key at most once.
+
+        Inputs are read lazily, and results are yielded in input order as
+        soon as they are ready. Only ``2 * concurrency`` inputs are in
+        flight or waiting for their turn at the same time.
+
+        Example::
+
+            for location in manager.map(
+                    "geocode", address_iterator, concurrency=20):
+                ...
+
+        :param method_name: client method name.
+        :param iterable: inputs, a tuple is the positional arguments of one
+            call, any other value is the single argument.
+        :param concurrency: number of worker threads.
+        :param return_exceptions: yield the exception of a failed call
+            instead of raising it, which stops the iteration.
+        :param max_attempts: override the max number of calls per input.
+
+        :return: generator of results.
+        """
+        return imap(
+            self, method_name, iterable,
+            concurrency=concurrency,
+            ordered=True,
+            return_exceptions=return_exceptions,
+            max_attempts=max_attempts,
+        )
+
+    def imap_unordered(self,
+                       method_name,
+                       iterable,
+                       concurrency=10,
+                       return_exceptions=False,
+                       max_attempts=None):
+        """
+        Same as :meth:`map`, but yields results in completion order, a slow
+        call never holds back the others.
+        """
+        return imap(
+            self, method_name, iterable,
+            concurrency=concurrency,
+            ordered=False,
+            return_exceptions=return_exceptions,
+            max_attempts=max_attempts,
+        )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In process metrics, no database query involved.
+
+Call counters are incremented on the dispatch path, gauges such as pool
+sizes and stats queue depth are read from the manager only when a snapshot
+is taken. Export them as a dict with :meth:`Metrics.snapshot`, as OpenMetrics
+text with :meth:`Metrics.to_openmetrics`, or serve the text over HTTP with
+:func:`start_http_server`.
+"""
+
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from .stats import StatusCollection
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\") \
+        .replace("\"", "\\\"") \
+        .replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (name, escape_label_value(value))
+        for name, value in labels
+    )
+
+
+class Metrics(object):
+    """
+    Counters and gauges of an :class:`~apipool.manager.ApiKeyManager`,
+    thread safe.
+
+    :param prefix: metric name prefix in OpenMetrics text.
+    """
+
+    def __init__(self, prefix="apipool"):
+        self.prefix = prefix
+        # (primary key, method name, status id) -> count
+        self._calls = dict()
+        self._lock = threading.Lock()
+        self._apikey_manager = None
+
+    def bind(self, apikey_manager):
+        if (self._apikey_manager is not None) and \
+                (self._apikey_manager is not apikey_manager):
+            raise ValueError("metrics is already bound to another manager!")
+        self._apikey_manager = apikey_manager
+
+    def record_call(self, primary_key, method_name, status_id):
+        key = (primary_key, method_name, status_id)
+        with self._lock:
+            self._calls[key] = self._calls.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+
+    def _get_gauges(self):
+        manager = self._apikey_manager
+        gauges = dict(
+            active_apikeys=0,
+            archived_apikeys=0,
+            stats_queue_size=0,
+            stats_dropped_events=0,
+            stats_flush_count=0,
+            stats_flush_seconds_total=0.0,
+            stats_last_flush_seconds=0.0,
+        )
+        if manager is None:
+            return gauges
+        gauges["active_apikeys"] = len(manager.apikey_chain)
+        gauges["archived_apikeys"] = len(manager.archived_apikey_chain)
+        writer = manager.stats_writer
+        if writer is not None:
+            gauges["stats_queue_size"] = writer.qsize
+            gauges["stats_dropped_events"] = writer.n_dropped
+            gauges["stats_flush_count"] = writer.n_flushes
+            gauges["stats_flush_seconds_total"] = writer.flush_seconds_total
+            gauges["stats_last_flush_seconds"] = writer.last_flush_seconds
+        return gauges
+
+    def snapshot(self):
+        """
+        :return: dict, ``calls`` is a nested dict of primary key -> method
+            name -> status description -> count, the others are gauges.
+        """
+        mapper = StatusCollection.get_mapper_id_to_description()
+        with self._lock:
+            calls = list(self._calls.items())
+        result = self._get_gauges()
+        result["calls"] = nested = dict()
+        for (primary_key, method_name, status_id), count in calls:
+            nested.setdefault(primary_key, dict()) \
+                .setdefault(method_name, dict())[mapper[status_id]] = count
+        return result
+
+    def to_openmetrics(self):
+        """
+        :return: str, metrics in OpenMetrics text exposition format.
+        """
+        snapshot = self.snapshot()
+        prefix = self.prefix
+        lines = list()
+
+        def add_metric(name, metric_type, help_text, samples):
+            name = "%s_%s" % (prefix, name)
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            lines.append("# HELP %s %s" % (name, help_text))
+            for suffix, labels, value in samples:
+                lines.append("%s%s%s %s" % (
+                    name, suffix, format_labels(labels) if labels else "",
+                    value,
+                ))
+
+        samples = list()
+        for primary_key, methods in sorted(
+                snapshot["calls"].items(), key=lambda x: str(x[0])):
+            for method_name, statuses in sorted(
+                    methods.items(), key=lambda x: str(x[0])):
+                for status, count in sorted(statuses.items()):
+                    labels = [
+                        ("apikey", primary_key),
+                        ("method", "" if method_name is None else method_name),
+                        ("status", status),
+                    ]
+                    samples.append(("_total", labels, count))
+        add_metric("calls", "counter",
+                   "Api calls by key, method and status.", samples)
+        add_metric("active_apikeys", "gauge", "Number of active api keys.",
+                   [("", None, snapshot["active_apikeys"])])
+        add_metric("archived_apikeys", "gauge",
+                   "Number of archived api keys.",
+                   [("", None, snapshot["archived_apikeys"])])
+        add_metric("stats_queue_size", "gauge",
+                   "Usage events waiting for the stats writer.",
+                   [("", None, snapshot["stats_queue_size"])])
+        add_metric("stats_dropped_events", "counter",
+                   "Usage events dropped by the stats queue overflow policy.",
+                   [("_total", None, snapshot["stats_dropped_events"])])
+        add_metric("stats_flush", "summary",
+                   "Seconds spent writing usage event batches.", [
+                       ("_count", None, snapshot["stats_flush_count"]),
+                       ("_sum", None, snapshot["stats_flush_seconds_total"]),
+                   ])
+        add_metric("stats_last_flush_seconds", "gauge",
+                   "Seconds spent writing the last usage event batch.",
+                   [("", None, snapshot["stats_last_flush_seconds"])])
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.metrics.to_openmetrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(metrics, port=0, host="127.0.0.1"):
+    """
+    Serve ``/metrics`` in OpenMetrics text from a daemon thread.
+
+    :param port: 0 picks a free port, see ``server.server_address``.
+    :return: the ``HTTPServer``, call ``server.shutdown()`` to stop it.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), dict(metrics=metrics))
+    server = HTTPServer((host, port), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="apipool-metrics-server",
+    )
+    thread.daemon = True
+    thread.start()
+    return server
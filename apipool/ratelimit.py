@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In memory per api key rate limiting with token buckets.
+
+A rate limit is a ``(max_calls, period)`` tuple, for example ``(10, 1)``
+means 10 calls per second, ``(1000, 86400)`` means 1000 calls per day.
+"""
+
+import threading
+
+from .clock import clock
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when every active api key has used up its rate limit.
+    """
+    pass
+
+
+def normalize_rate_limits(rate_limits):
+    """
+    Validate rate limits, a single ``(max_calls, period)`` tuple is accepted
+    too.
+
+    :return: list of ``(max_calls, period)`` tuple, None if no rate limit.
+    """
+    if not rate_limits:
+        return None
+    if (len(rate_limits) == 2) and \
+            all(isinstance(value, (int, float)) for value in rate_limits):
+        rate_limits = [rate_limits, ]
+    result = list()
+    for rate_limit in rate_limits:
+        try:
+            max_calls, period = rate_limit
+        except (TypeError, ValueError):
+            raise ValueError(
+                "rate limit has to be a (max_calls, period) tuple, "
+                "got %r!" % (rate_limit,))
+        if (not isinstance(max_calls, (int, float))) or \
+                (not isinstance(period, (int, float))) or \
+                (max_calls <= 0) or (period <= 0):
+            raise ValueError(
+                "max_calls and period has to be positive numbers, "
+                "got %r!" % (rate_limit,))
+        result.append((max_calls, period))
+    return result
+
+
+class TokenBucket(object):
+    """
+    Allows ``max_calls`` in ``period`` seconds, tokens are refilled
+    continuously.
+    """
+
+    def __init__(self, max_calls, period):
+        if max_calls <= 0 or period <= 0:
+            raise ValueError("max_calls and period has to be positive!")
+        self.capacity = float(max_calls)
+        self.fill_rate = float(max_calls) / period
+        self.tokens = self.capacity
+        self.updated_at = clock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(
+                self.capacity, self.tokens + elapsed * self.fill_rate)
+            self.updated_at = now
+
+    def wait_time(self, now):
+        """
+        Seconds until one token is available.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.fill_rate
+
+
+class RateLimiter(object):
+    """
+    All rate limits of one api key, a call is allowed only if every bucket
+    has a token.
+
+    :param rate_limits: list of ``(max_calls, period)`` tuple.
+    """
+
+    def __init__(self, rate_limits):
+        self.buckets = [
+            TokenBucket(max_calls, period)
+            for max_calls, period in rate_limits
+        ]
+        self._lock = threading.Lock()
+
+    def try_acquire(self, now=None):
+        """
+        Take one token from every bucket if all of them have one.
+
+        :return: bool, True if the call is allowed.
+        """
+        if now is None:
+            now = clock()
+        with self._lock:
+            for bucket in self.buckets:
+                if bucket.wait_time(now) > 0:
+                    return False
+            for bucket in self.buckets:
+                bucket.tokens -= 1
+            return True
+
+    def wait_time(self, now=None):
+        """
+        Seconds until a call is allowed.
+        """
+        if now is None:
+            now = clock()
+        with self._lock:
+            return max(
+                [bucket.wait_time(now) for bucket in self.buckets] + [0.0, ]
+            )
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Failover retry. A call failed with the reach limit exception, or with one of
+the configured transient exceptions, is retried on another active api key.
+Every attempt records its own usage event.
+"""
+
+import time
+import random
+
+
+class RetryPolicy(object):
+    """
+    :param max_attempts: max number of calls including the first one, None
+        means try each active key at most once.
+    :param transient_exc: exception class or tuple of classes also retried
+        on another key. The reach limit exception is always retried.
+    :param backoff: seconds to wait before the second attempt, doubled for
+        every next attempt. 0 means retry immediately.
+    :param max_backoff: upper bound of the wait time.
+    :param jitter: wait a random time between 0 and the backoff instead,
+        so concurrent callers don't retry in lockstep.
+    """
+
+    def __init__(self,
+                 max_attempts=3,
+                 transient_exc=(),
+                 backoff=0.0,
+                 max_backoff=10.0,
+                 jitter=True):
+        if isinstance(transient_exc, type):
+            transient_exc = (transient_exc,)
+        self.max_attempts = max_attempts
+        self.transient_exc = tuple(transient_exc)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def copy(self, **kwargs):
+        params = dict(
+            max_attempts=self.max_attempts,
+            transient_exc=self.transient_exc,
+            backoff=self.backoff,
+            max_backoff=self.max_backoff,
+            jitter=self.jitter,
+        )
+        params.update(kwargs)
+        return self.__class__(**params)
+
+    def is_exhausted(self, attempt):
+        return (self.max_attempts is not None) and \
+               (attempt >= self.max_attempts)
+
+    def get_wait_time(self, attempt):
+        """
+        Seconds to wait after the ``attempt`` th call failed.
+        """
+        if not self.backoff:
+            return 0.0
+        wait_time = min(
+            self.backoff * (2 ** (attempt - 1)), self.max_backoff)
+        if self.jitter:
+            wait_time = random.uniform(0, wait_time)
+        return wait_time
+
+
+def is_all_tried(apikey_manager, tried):
+    """
+    Whether every active api key is in ``tried`` primary keys.
+    """
+    return all(
+        apikey.primary_key in tried
+        for apikey in list(apikey_manager._apikey_list)
+    )
+
+
+def should_give_up(apikey_manager, policy, attempt, tried):
+    """
+    Whether to re-raise the error of the ``attempt`` th call. Without
+    ``max_attempts``, each active key is tried at most once.
+    """
+    if not apikey_manager._apikey_list:
+        return True
+    if policy.max_attempts is None:
+        return is_all_tried(apikey_manager, tried)
+    return policy.is_exhausted(attempt)
+
+
+class FailoverCaller(object):
+    """
+    Call client method ``method_name`` with an api key picked by the
+    manager, retry on other keys according to ``retry_policy``.
+    """
+    __slots__ = ("apikey_manager", "method_name", "retry_policy")
+
+    def __init__(self, apikey_manager, method_name, retry_policy):
+        self.apikey_manager = apikey_manager
+        self.method_name = method_name
+        self.retry_policy = retry_policy
+
+    def __call__(self, *args, **kwargs):
+        manager = self.apikey_manager
+        policy = self.retry_policy
+        retry_exc = (manager.reach_limit_exc,) + policy.transient_exc
+        tried = set()
+        attempt = 0
+        while True:
+            attempt += 1
+            apikey = manager.select_one(exclude=tried)
+            tried.add(apikey.primary_key)
+            try:
+                return manager.get_caller(apikey, self.method_name)(
+                    *args, **kwargs)
+            except retry_exc as e:
+                if should_give_up(manager, policy, attempt, tried):
+                    raise e
+            wait_time = policy.get_wait_time(attempt)
+            if wait_time:
+                time.sleep(wait_time)
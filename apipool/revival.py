@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Automatic revival of archived api keys. Provider quotas usually reset
+hourly or daily, so a key archived for reaching its limit is worth another
+try after a cooldown.
+
+A background thread looks for archived keys whose cooldown has expired,
+tests them with :meth:`~apipool.apikey.ApiKey.user_03_test_usable`, and
+moves the usable ones back to ``apikey_chain``. Keys failed the test start
+another cooldown.
+"""
+
+import threading
+
+from .clock import clock
+from .healthcheck import check_apikeys
+
+
+class ArchiveReason(object):
+    reach_limit = "reach limit"
+    failed = "failed"  # health check failed
+    shared = "shared"  # archived by another process
+    manual = "manual"
+
+
+class RevivalScheduler(object):
+    """
+    :param cooldowns: dict, archive reason -> seconds before the key is
+        tested again, None means never. ``ApiKey.revival_cooldown`` takes
+        priority.
+    :param check_interval: seconds between two scans of archived keys.
+    :param parallelism: max number of keys tested at the same time.
+    :param timeout: per key test timeout in seconds.
+
+    Keys archived by another process (see :mod:`apipool.shm`) are revived
+    without test once the other process marks them active again.
+    """
+
+    default_cooldowns = {
+        ArchiveReason.reach_limit: 3600,
+        ArchiveReason.failed: 600,
+        ArchiveReason.shared: None,
+        ArchiveReason.manual: None,
+    }
+
+    def __init__(self,
+                 cooldowns=None,
+                 check_interval=10,
+                 parallelism=4,
+                 timeout=30):
+        self.cooldowns = dict(self.default_cooldowns)
+        if cooldowns:
+            self.cooldowns.update(cooldowns)
+        self.check_interval = check_interval
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self._apikey_manager = None
+        # primary key -> (archive reason, due time), None means never
+        self._due = dict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def bind(self, apikey_manager):
+        self._apikey_manager = apikey_manager
+
+    def get_cooldown(self, apikey, reason):
+        cooldown = apikey.revival_cooldown
+        if isinstance(cooldown, dict):
+            cooldown = cooldown.get(reason, self.cooldowns.get(reason))
+        elif cooldown is None:
+            cooldown = self.cooldowns.get(reason)
+        return cooldown
+
+    def on_archive(self, primary_key, apikey, reason):
+        """
+        Called by the manager when a key is archived.
+        """
+        with self._lock:
+            self._due[primary_key] = (
+                reason, self._get_due(apikey, reason),
+            )
+
+    def _get_due(self, apikey, reason):
+        cooldown = self.get_cooldown(apikey, reason)
+        if cooldown is None:
+            return None
+        return clock() + cooldown
+
+    def on_revive(self, primary_key):
+        with self._lock:
+            self._due.pop(primary_key, None)
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def is_alive(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop_event.wait(self.check_interval):
+            try:
+                self.run_once()
+            except Exception:  # pragma: no cover
+                pass
+
+    def run_once(self):
+        """
+        Test archived keys whose cooldown has expired, revive usable ones.
+
+        :return: list of revived primary keys.
+        """
+        manager = self._apikey_manager
+        revived = list()
+
+        # archived by another process which revived it later
+        state = manager.shared_state
+        if state is not None:
+            for primary_key in list(manager.archived_apikey_chain):
+                if state.has_key(primary_key) and \
+                        state.is_active(primary_key):
+                    if manager.revive_one(primary_key) is not None:
+                        revived.append(primary_key)
+
+        now = clock()
+        with self._lock:
+            due_keys = [
+                primary_key
+                for primary_key, (_, due) in self._due.items()
+                if (due is not None) and (due <= now)
+            ]
+        apikey_list = list()
+        for primary_key in due_keys:
+            apikey = manager.archived_apikey_chain.get(primary_key)
+            if apikey is None:
+                self.on_revive(primary_key)
+            else:
+                apikey_list.append(apikey)
+        if not apikey_list:
+            return revived
+
+        report = check_apikeys(
+            apikey_list, parallelism=self.parallelism, timeout=self.timeout,
+        )
+        for apikey in apikey_list:
+            primary_key = apikey.primary_key
+            if report.results[primary_key].is_usable:
+                if manager.revive_one(primary_key) is not None:
+                    revived.append(primary_key)
+            else:  # start another cooldown
+                with self._lock:
+                    if primary_key in self._due:
+                        reason = self._due[primary_key][0]
+                        self._due[primary_key] = (
+                            reason, self._get_due(apikey, reason),
+                        )
+        return revived
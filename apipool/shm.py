@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cross process api key state in a ``multiprocessing.shared_memory`` segment,
+Python3.8+ only.
+
+All processes on a host share per key usage counters, the active / archived
+flag and the token bucket state of rate limits, so pre-fork workers
+(gunicorn, multiprocessing) coordinate key usage without a database round
+trip. Every process has to use the same list of primary keys, in the same
+order.
+
+Updates are guarded by a set of striped ``multiprocessing.Lock``, so the
+state has to be created before the worker processes are forked, or be passed
+to ``multiprocessing.Process`` as an argument.
+"""
+
+import math
+import time
+import zlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+from .stats import StatusCollection
+
+_HEADER_SIZE = 3  # n_keys, max_rate_limits, keys checksum
+_INT_SIZE = 8
+_FLOAT_SIZE = 8
+
+_STATUS_ID_LIST = StatusCollection.get_id_list()
+_STATUS_OFFSET = {
+    status_id: 1 + i for i, status_id in enumerate(_STATUS_ID_LIST)
+}
+_N_INT_PER_KEY = 1 + len(_STATUS_ID_LIST)  # active flag + status counters
+
+
+def keys_checksum(primary_keys):
+    return zlib.crc32("\n".join(
+        [str(primary_key) for primary_key in primary_keys]
+    ).encode("utf-8"))
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13, stop resource tracker unlinking it
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:  # pragma: no cover
+            pass
+        return shm
+
+
+class SharedKeyState(object):
+    """
+    :param primary_keys: list of primary keys, same order in all processes.
+    :param name: shared memory segment name, generated if not given.
+    :param create: create a new segment, or attach to an existing one.
+    :param max_rate_limits: max number of rate limits per key.
+    :param n_locks: number of striped locks.
+    :param locks: locks shared by all processes, only used when attaching.
+    :param context: multiprocessing context used to create locks, it has to
+        match the context used to start worker processes.
+    """
+
+    def __init__(self,
+                 primary_keys,
+                 name=None,
+                 create=True,
+                 max_rate_limits=4,
+                 n_locks=16,
+                 locks=None,
+                 context=None):
+        self.primary_keys = list(primary_keys)
+        self.n_keys = len(self.primary_keys)
+        self.max_rate_limits = max_rate_limits
+        if context is None:
+            context = multiprocessing
+        self._slot = {
+            primary_key: slot
+            for slot, primary_key in enumerate(self.primary_keys)
+        }
+
+        n_int = _HEADER_SIZE + self.n_keys * _N_INT_PER_KEY
+        n_float = self.n_keys * max_rate_limits * 2  # tokens, updated_at
+        size = n_int * _INT_SIZE + n_float * _FLOAT_SIZE
+        checksum = keys_checksum(self.primary_keys)
+
+        if create:
+            self.shm = shared_memory.SharedMemory(
+                name=name, create=True, size=size)
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self.is_owner = create
+
+        self._ints = self.shm.buf[:n_int * _INT_SIZE].cast("q")
+        self._floats = self.shm.buf[
+            n_int * _INT_SIZE:n_int * _INT_SIZE + n_float * _FLOAT_SIZE
+        ].cast("d")
+
+        if create:
+            self._ints[0] = self.n_keys
+            self._ints[1] = max_rate_limits
+            self._ints[2] = checksum
+            for slot in range(self.n_keys):
+                self._ints[self._int_index(slot, 0)] = 1
+            for i in range(n_float):
+                self._floats[i] = float("nan")
+            self.locks = [context.Lock() for _ in range(n_locks)]
+        else:
+            if (self._ints[0], self._ints[1], self._ints[2]) != \
+                    (self.n_keys, max_rate_limits, checksum):
+                self.close()
+                raise ValueError(
+                    "shared memory %r is created with different keys!" % name
+                )
+            if locks is None:
+                locks = [context.Lock() for _ in range(n_locks)]
+            self.locks = locks
+
+    def __getstate__(self):
+        return {
+            "primary_keys": self.primary_keys,
+            "name": self.name,
+            "max_rate_limits": self.max_rate_limits,
+            "locks": self.locks,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(
+            state["primary_keys"],
+            name=state["name"],
+            create=False,
+            max_rate_limits=state["max_rate_limits"],
+            locks=state["locks"],
+        )
+
+    def close(self):
+        self._ints.release()
+        self._floats.release()
+        self.shm.close()
+
+    def unlink(self):
+        """
+        Destroy the segment, call it once in the creator process.
+        """
+        self.shm.unlink()
+
+    def _int_index(self, slot, offset):
+        return _HEADER_SIZE + slot * _N_INT_PER_KEY + offset
+
+    def _lock(self, slot):
+        return self.locks[slot % len(self.locks)]
+
+    def has_key(self, primary_key):
+        return primary_key in self._slot
+
+    # --- active / archived flag
+    def is_active(self, primary_key):
+        return self._ints[self._int_index(self._slot[primary_key], 0)] == 1
+
+    def set_active(self, primary_key, active):
+        self._ints[self._int_index(self._slot[primary_key], 0)] = int(active)
+
+    # --- usage counters
+    def incr(self, primary_key, status_id, n=1):
+        slot = self._slot[primary_key]
+        index = self._int_index(slot, _STATUS_OFFSET[status_id])
+        with self._lock(slot):
+            self._ints[index] += n
+
+    def usage_count(self, primary_key=None, status_id=None):
+        """
+        Number of events since the segment is created.
+        """
+        if primary_key is None:
+            slots = range(self.n_keys)
+        else:
+            slots = [self._slot[primary_key], ]
+        if status_id is None:
+            offsets = list(_STATUS_OFFSET.values())
+        else:
+            offsets = [_STATUS_OFFSET[status_id], ]
+        return sum(
+            self._ints[self._int_index(slot, offset)]
+            for slot in slots
+            for offset in offsets
+        )
+
+    # --- rate limit
+    def rate_limiter(self, primary_key, rate_limits):
+        return SharedRateLimiter(self, self._slot[primary_key], rate_limits)
+
+
+class SharedRateLimiter(object):
+    """
+    Same interface as :class:`~apipool.ratelimit.RateLimiter`, token buckets
+    live in the shared memory segment. Uses wall clock time, since it is
+    compared between processes.
+    """
+
+    def __init__(self, state, slot, rate_limits):
+        if len(rate_limits) > state.max_rate_limits:
+            raise ValueError(
+                "at most %s rate limits per key!" % state.max_rate_limits)
+        self.state = state
+        self.slot = slot
+        self.buckets = [
+            (float(max_calls), float(max_calls) / period)
+            for max_calls, period in rate_limits
+        ]
+
+    def _index(self, i):
+        return (self.slot * self.state.max_rate_limits + i) * 2
+
+    def _wait_times(self, now):
+        floats = self.state._floats
+        wait_times = list()
+        for i, (capacity, fill_rate) in enumerate(self.buckets):
+            index = self._index(i)
+            tokens, updated_at = floats[index], floats[index + 1]
+            if math.isnan(tokens):
+                tokens, updated_at = capacity, now
+            elif now > updated_at:
+                tokens = min(capacity, tokens + (now - updated_at) * fill_rate)
+                updated_at = now
+            floats[index], floats[index + 1] = tokens, updated_at
+            if tokens >= 1:
+                wait_times.append(0.0)
+            else:
+                wait_times.append((1 - tokens) / fill_rate)
+        return wait_times
+
+    def try_acquire(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.state._lock(self.slot):
+            if any(self._wait_times(now)):
+                return False
+            floats = self.state._floats
+            for i in range(len(self.buckets)):
+                floats[self._index(i)] -= 1
+            return True
+
+    def wait_time(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.state._lock(self.slot):
+            return max(self._wait_times(now) + [0.0, ])
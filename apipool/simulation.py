@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load simulation against fake upstreams, to see how a dispatch configuration
+behaves under realistic latency, quotas and failure rates before a rollout.
+
+Each fake api key follows a :class:`KeyProfile`: the client sleeps for a
+latency drawn from a distribution, raises :class:`SimulatedReachLimitError`
+once the per period quota is used up, and :class:`SimulatedTransientError`
+at random. :class:`Simulation` creates fresh keys for every run, drives an
+:class:`~apipool.manager.ApiKeyManager` with a closed loop (a fixed number
+of concurrent users) or an open loop (requests arrive at a fixed rate no
+matter how slow the upstream is), and reports throughput, latency
+percentiles and quota utilisation.
+
+Example::
+
+    simulation = Simulation([
+        KeyProfile(latency=lognormal(0.05, 0.5), quota=100, period=1),
+        KeyProfile(latency=uniform(0.2, 0.4), quota=50, period=1,
+                   error_rate=0.05),
+    ] * 5)
+    reports = simulation.compare(OrderedDict([
+        ("random", dict()),
+        ("ewma", lambda: dict(
+            strategy=EwmaStrategy(),
+            retry_policy=RetryPolicy(
+                transient_exc=(SimulatedTransientError,)),
+        )),
+    ]), load="closed", concurrency=20, n_requests=2000)
+    print(format_reports(reports))
+"""
+
+import math
+import time
+import random
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from .apikey import ApiKey
+from .latency import LatencyHistogram
+from .clock import clock
+
+
+class SimulatedReachLimitError(Exception):
+    pass
+
+
+class SimulatedTransientError(Exception):
+    pass
+
+
+# --- latency distributions, callables taking a random.Random -> seconds ---
+def constant(seconds):
+    return lambda rnd: seconds
+
+
+def uniform(low, high):
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def exponential(mean):
+    return lambda rnd: rnd.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    """
+    Long tail latency, ``median`` seconds, ``sigma`` is the standard
+    deviation of the underlying normal distribution.
+    """
+    mu = math.log(median)
+    return lambda rnd: rnd.lognormvariate(mu, sigma)
+
+
+class KeyProfile(object):
+    """
+    Behavior of a fake api key.
+
+    :param latency: callable, ``random.Random`` -> seconds, see
+        :func:`constant`, :func:`uniform`, :func:`exponential` and
+        :func:`lognormal`.
+    :param quota: max number of calls per ``period``, None means unlimited.
+    :param period: quota period in seconds, fixed window.
+    :param error_rate: 0 ~ 1, probability of a transient error.
+    """
+
+    def __init__(self, latency=constant(0.0), quota=None, period=1.0,
+                 error_rate=0.0):
+        self.latency = latency
+        self.quota = quota
+        self.period = period
+        self.error_rate = error_rate
+
+
+class SimulatedClient(object):
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def request(self, *args, **kwargs):
+        return self.apikey.consume()
+
+
+class SimulatedApiKey(ApiKey):
+    """
+    Fake api key, its client follows ``profile``. Thread safe.
+
+    :param random_seed: seed of the key's own random generator.
+    """
+
+    def __init__(self, apikey, profile, random_seed=None):
+        self.apikey = apikey
+        self.profile = profile
+        self.random = random.Random(random_seed)
+        self.n_accepted = 0
+        self.n_rejected = 0
+        self.n_transient_error = 0
+        self._window_start = clock()
+        self._window_count = 0
+        self._lock = threading.Lock()
+
+    def user_01_get_primary_key(self):
+        return self.apikey
+
+    def user_02_create_client(self):
+        return SimulatedClient(self)
+
+    def user_03_test_usable(self, client):
+        with self._lock:
+            self._roll_window()
+            return not self._is_exhausted()
+
+    def _roll_window(self):
+        now = clock()
+        if now - self._window_start >= self.profile.period:
+            n_periods = (now - self._window_start) // self.profile.period
+            self._window_start += n_periods * self.profile.period
+            self._window_count = 0
+
+    def _is_exhausted(self):
+        return (self.profile.quota is not None) and \
+               (self._window_count >= self.profile.quota)
+
+    def consume(self):
+        """
+        One upstream call: wait for the latency, then succeed or fail.
+        """
+        profile = self.profile
+        with self._lock:
+            latency = profile.latency(self.random)
+            is_error = (profile.error_rate > 0) and \
+                (self.random.random() < profile.error_rate)
+            self._roll_window()
+            if self._is_exhausted():
+                self.n_rejected += 1
+                raise SimulatedReachLimitError(self.apikey)
+            self._window_count += 1
+            if is_error:
+                self.n_transient_error += 1
+            else:
+                self.n_accepted += 1
+        if latency > 0:
+            time.sleep(latency)
+        if is_error:
+            raise SimulatedTransientError(self.apikey)
+        return self.apikey
+
+    def get_utilisation(self, elapsed):
+        """
+        Fraction of the quota offered during ``elapsed`` seconds that is
+        used by successful calls, None if unlimited.
+        """
+        if self.profile.quota is None:
+            return None
+        n_periods = max(int(math.ceil(elapsed / self.profile.period)), 1)
+        return float(self.n_accepted) / (self.profile.quota * n_periods)
+
+
+class SimulationReport(object):
+    """
+    :param name: dispatch configuration name.
+    :param load: ``closed`` or ``open``.
+    :param elapsed: wall clock seconds of the run.
+    :param n_requests: number of requests sent.
+    :param errors: dict, exception class name -> count.
+    :param latency: :class:`~apipool.latency.LatencyHistogram` of successful
+        requests, including retries, and queueing for open loop.
+    :param utilisation: OrderedDict, primary key -> quota utilisation.
+    """
+
+    def __init__(self, name, load, elapsed, n_requests, errors, latency,
+                 utilisation):
+        self.name = name
+        self.load = load
+        self.elapsed = elapsed
+        self.n_requests = n_requests
+        self.errors = errors
+        self.latency = latency
+        self.utilisation = utilisation
+
+    @property
+    def n_success(self):
+        return self.n_requests - sum(self.errors.values())
+
+    @property
+    def throughput(self):
+        """
+        Successful requests per second.
+        """
+        return self.n_success / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mean_utilisation(self):
+        values = [v for v in self.utilisation.values() if v is not None]
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+    def to_dict(self):
+        return OrderedDict([
+            ("name", self.name),
+            ("load", self.load),
+            ("elapsed", self.elapsed),
+            ("n_requests", self.n_requests),
+            ("n_success", self.n_success),
+            ("throughput", self.throughput),
+            ("errors", dict(self.errors)),
+            ("latency", self.latency.percentiles()),
+            ("mean_utilisation", self.mean_utilisation),
+            ("utilisation", self.utilisation),
+        ])
+
+    def __repr__(self):
+        return (
+            "SimulationReport(name=%r, n_success=%s/%s, throughput=%.1f)"
+        ) % (self.name, self.n_success, self.n_requests, self.throughput)
+
+
+def format_reports(reports):
+    """
+    :param reports: OrderedDict, name -> :class:`SimulationReport`.
+    :return: str, a table with one line per report.
+    """
+    template = "%-16s %12s %10s %9s %9s %9s %7s  %s"
+    lines = [template % (
+        "name", "success", "req/s", "p50 ms", "p95 ms", "p99 ms",
+        "quota", "errors",
+    ), ]
+    for name, report in reports.items():
+        p50, p95, p99 = [
+            "-" if value is None else "%.1f" % (value * 1000)
+            for value in report.latency.percentiles().values()
+        ]
+        utilisation = report.mean_utilisation
+        lines.append(template % (
+            name,
+            "%s/%s" % (report.n_success, report.n_requests),
+            "%.1f" % report.throughput,
+            p50, p95, p99,
+            "-" if utilisation is None else "%.0f%%" % (utilisation * 100),
+            ", ".join(
+                "%s=%s" % item for item in sorted(report.errors.items())),
+        ))
+    return "\n".join(lines)
+
+
+class _RequestRecorder(object):
+    """
+    Outcome of every request of one run, thread safe.
+    """
+
+    def __init__(self):
+        self.n_requests = 0
+        self.errors = dict()
+        self.latency = LatencyHistogram()
+        self._lock = threading.Lock()
+
+    def call(self, caller, args, started_at=None):
+        """
+        :param started_at: when the request was due, defaults to now.
+        """
+        if started_at is None:
+            started_at = clock()
+        error = None
+        try:
+            caller(*args)
+        except Exception as e:
+            error = e
+        elapsed = clock() - started_at
+        with self._lock:
+            self.n_requests += 1
+            if error is None:
+                self.latency.record(elapsed)
+            else:
+                name = error.__class__.__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class Simulation(object):
+    """
+    :param profiles: list of :class:`KeyProfile`, one fake api key each.
+    :param method_name: client method called by the load generator.
+    :param random_seed: seed of the fake keys and of the open loop
+        arrivals, None for a random run.
+    """
+
+    def __init__(self, profiles, method_name="request", random_seed=None):
+        self.profiles = profiles
+        self.method_name = method_name
+        self.random_seed = random_seed
+
+    def create_apikeys(self):
+        """
+        Fresh fake api keys, with empty quota windows.
+        """
+        apikey_list = list()
+        for i, profile in enumerate(self.profiles):
+            seed = None if self.random_seed is None else self.random_seed + i
+            apikey_list.append(SimulatedApiKey(
+                apikey="simulated-%s" % i, profile=profile, random_seed=seed,
+            ))
+        return apikey_list
+
+    def create_manager(self, **kwargs):
+        """
+        :param kwargs: arguments for :class:`~apipool.manager.ApiKeyManager`,
+            ``reach_limit_exc`` defaults to :class:`SimulatedReachLimitError`.
+        """
+        from .manager import ApiKeyManager
+
+        kwargs.setdefault("reach_limit_exc", SimulatedReachLimitError)
+        return ApiKeyManager(apikey_list=self.create_apikeys(), **kwargs)
+
+    def _get_caller(self, manager):
+        method_name = self.method_name
+        dummyclient = manager.dummyclient
+        return lambda *args: getattr(dummyclient, method_name)(*args)
+
+    def _make_report(self, name, load, manager, recorder, elapsed):
+        utilisation = OrderedDict()
+        apikeys = list(manager.apikey_chain.values()) + \
+            list(manager.archived_apikey_chain.values())
+        for apikey in sorted(apikeys, key=lambda apikey: apikey.primary_key):
+            utilisation[apikey.primary_key] = apikey.get_utilisation(elapsed)
+        return SimulationReport(
+            name=name,
+            load=load,
+            elapsed=elapsed,
+            n_requests=recorder.n_requests,
+            errors=recorder.errors,
+            latency=recorder.latency,
+            utilisation=utilisation,
+        )
+
+    def run_closed_loop(self, manager, concurrency=10, n_requests=1000,
+                        name=None):
+        """
+        ``concurrency`` users send requests back to back, ``n_requests``
+        in total. Throughput is bounded by the upstream latency.
+
+        :rtype: :class:`SimulationReport`
+        """
+        caller = self._get_caller(manager)
+        recorder = _RequestRecorder()
+        counter = iter(range(n_requests))
+        counter_lock = threading.Lock()
+
+        def user():
+            while True:
+                with counter_lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                recorder.call(caller, (i,))
+
+        started_at = clock()
+        threads = [
+            threading.Thread(target=user, name="apipool-simulation-%s" % i)
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = clock() - started_at
+        return self._make_report(name, "closed", manager, recorder, elapsed)
+
+    def run_open_loop(self, manager, rate=100.0, n_requests=1000,
+                      max_concurrency=100, poisson=True, name=None):
+        """
+        Requests arrive at ``rate`` per second no matter how fast they are
+        served, and are handled by at most ``max_concurrency`` threads.
+        Latency is measured from the arrival time, so queueing delay of an
+        overloaded configuration shows up in the percentiles.
+
+        :param poisson: exponential inter arrival times if True, otherwise
+            evenly spaced.
+
+        :rtype: :class:`SimulationReport`
+        """
+        caller = self._get_caller(manager)
+        recorder = _RequestRecorder()
+        rnd = random.Random(self.random_seed)
+        arrivals = queue.Queue()
+        stop = object()
+
+        def worker():
+            while True:
+                item = arrivals.get()
+                if item is stop:
+                    return
+                i, due = item
+                recorder.call(caller, (i,), started_at=due)
+
+        threads = [
+            threading.Thread(target=worker, name="apipool-simulation-%s" % i)
+            for i in range(max_concurrency)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        started_at = clock()
+        due = started_at
+        sleeper = threading.Event()
+        for i in range(n_requests):
+            wait_time = due - clock()
+            if wait_time > 0:
+                sleeper.wait(wait_time)
+            arrivals.put((i, due))
+            if poisson:
+                due += rnd.expovariate(rate)
+            else:
+                due += 1.0 / rate
+        for _ in threads:
+            arrivals.put(stop)
+        for thread in threads:
+            thread.join()
+        elapsed = clock() - started_at
+        return self._make_report(name, "open", manager, recorder, elapsed)
+
+    def compare(self, configurations, load="closed", **load_kwargs):
+        """
+        Run the same load against each dispatch configuration, with fresh
+        fake keys every time.
+
+        :param configurations: dict, name -> keyword arguments for
+            :meth:`create_manager`, or a callable returning them, so
+            stateful objects such as strategies are not shared between
+            runs.
+        :param load: ``closed`` or ``open``.
+        :param load_kwargs: arguments for :meth:`run_closed_loop` or
+            :meth:`run_open_loop`.
+
+        :return: OrderedDict, name -> :class:`SimulationReport`.
+        """
+        if load == "closed":
+            run = self.run_closed_loop
+        elif load == "open":
+            run = self.run_open_loop
+        else:
+            raise ValueError("load has to be 'closed' or 'open'!")
+
+        reports = OrderedDict()
+        for name, kwargs in configurations.items():
+            if callable(kwargs):
+                kwargs = kwargs()
+            manager = self.create_manager(**kwargs)
+            try:
+                reports[name] = run(manager, name=name, **load_kwargs)
+            finally:
+                manager.close()
+        return reports
@@ -6,16 +6,25 @@ stats用于统计API的使用记录. 我们使用一个RDS数据库(通常是本
 API Call所使用的api key, 返回的状态 以及 完成API Call的时间.
 """
 
+import time
+import sqlite3
+import threading
 from datetime import datetime, timedelta
 from collections import OrderedDict
 
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import String, Integer, DateTime
-from sqlalchemy import func
+from sqlalchemy import Column, ForeignKey, Index, Table, MetaData
+from sqlalchemy import String, Integer, BigInteger
+from sqlalchemy import func, event, create_engine, inspect, select
+from sqlalchemy import and_, bindparam, literal_column, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool, AssertionPool, QueuePool
 from sqlalchemy_mate import ExtendedBase
 
+from .window import SlidingWindowCounter, to_timestamp
+from .clock import clock
+from .backends import BaseStatsCollector
+
 Base = declarative_base()
 
 
@@ -44,15 +53,74 @@ class Status(Base, ExtendedBase):
 
 
 class Event(Base, ExtendedBase):
-    __tablename__ = "event"
+    """
+    One api call. ``finished_at`` is epoch microseconds, many events of the
+    same key can finish at the same time.
 
-    apikey_id = Column(Integer, ForeignKey("apikey.id"), primary_key=True)
-    finished_at = Column(DateTime, primary_key=True)
-    status_id = Column(Integer, ForeignKey("status.id"))
+    Both indexes cover every column used by the usage count queries, time
+    range scans never visit the table rows.
+    """
+    __tablename__ = "event"
+    __table_args__ = (
+        Index("ix_event_finished_at_apikey_id_status_id",
+              "finished_at", "apikey_id", "status_id"),
+        Index("ix_event_apikey_id_finished_at_status_id",
+              "apikey_id", "finished_at", "status_id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    apikey_id = Column(Integer, ForeignKey("apikey.id"), nullable=False)
+    finished_at = Column(BigInteger, nullable=False)
+    status_id = Column(Integer, ForeignKey("status.id"), nullable=False)
+    duration = Column(Integer)  # microseconds, optional
 
     apikey = relationship("ApiKey")
     status = relationship("Status")
 
+    @property
+    def finished_datetime(self):
+        """
+        ``finished_at`` as naive local ``datetime``.
+        """
+        return datetime.fromtimestamp(self.finished_at / 1000000.0)
+
+    def __repr__(self):
+        return (
+            "Event(id=%r, apikey_id=%r, finished_at=%r, status_id=%r, "
+            "duration=%r)"
+        ) % (self.id, self.apikey_id, self.finished_at, self.status_id,
+             self.duration)
+
+
+class EventRollup(Base, ExtendedBase):
+    """
+    Number of events per api key, status and time bucket. ``resolution`` is
+    the bucket size in seconds, ``bucket_start`` is epoch seconds.
+
+    Per minute rows are maintained with upserts whenever events are written,
+    windowed counts read ``O(buckets * keys)`` rows instead of every event.
+    """
+    __tablename__ = "event_rollup"
+
+    bucket_start = Column(BigInteger, primary_key=True, autoincrement=False)
+    resolution = Column(Integer, primary_key=True, autoincrement=False)
+    apikey_id = Column(Integer, ForeignKey("apikey.id"),
+                       primary_key=True, autoincrement=False)
+    status_id = Column(Integer, ForeignKey("status.id"),
+                       primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return (
+            "EventRollup(bucket_start=%r, resolution=%r, apikey_id=%r, "
+            "status_id=%r, count=%r)"
+        ) % (self.bucket_start, self.resolution, self.apikey_id,
+             self.status_id, self.count)
+
+
+MINUTE = 60
+HOUR = 3600
+
 
 class StatusCollection(object):
     class c1_Success(object):
@@ -105,83 +173,796 @@ def get_n_seconds_before(n_seconds):
     return datetime.now() - timedelta(seconds=n_seconds)
 
 
-class StatsCollector(object):
-    def __init__(self, engine):
+def to_epoch_micros(finished_at=None):
+    """
+    Convert event finish time to epoch microseconds.
+
+    :param finished_at: naive local ``datetime``, epoch seconds, or None
+        for now.
+    """
+    if finished_at is None:
+        return int(time.time() * 1000000)
+    if isinstance(finished_at, datetime):
+        return int(round(to_timestamp(finished_at) * 1000000))
+    return int(finished_at * 1000000)
+
+
+def get_n_seconds_before_micros(n_seconds):
+    return int((time.time() - n_seconds) * 1000000)
+
+
+def _get_event_columns(engine):
+    """
+    :return: column names of the ``event`` table, None if not exists.
+    """
+    insp = inspect(engine)
+    if "event" not in insp.get_table_names():
+        return None
+    return [column["name"] for column in insp.get_columns("event")]
+
+
+def migrate_event_table(engine, batch_size=10000):
+    """
+    Migrate the ``event`` table created by older versions, which uses
+    ``(apikey_id, finished_at)`` as primary key and stores ``finished_at``
+    as ``DateTime``, to the current schema.
+
+    Rows are copied in batches into a new table, then the old table is
+    dropped and the new one renamed. Indexes are built after the copy. The
+    whole migration runs in one transaction.
+
+    Optional columns added later, ``duration``, are added in place.
+
+    :return: number of migrated events, None if there is nothing to migrate.
+    """
+    columns = _get_event_columns(engine)
+    if columns is None:
+        return None
+    if "id" in columns:
+        if "duration" not in columns:
+            with engine.begin() as conn:
+                conn.execute("ALTER TABLE event ADD COLUMN duration INTEGER")
+        return None
+
+    metadata = MetaData()
+    ApiKey.__table__.tometadata(metadata)
+    Status.__table__.tometadata(metadata)
+    new_table = Event.__table__.tometadata(metadata, name="event_migrating")
+    new_table.indexes = set()
+    legacy_table = Table("event", MetaData(), autoload=True,
+                         autoload_with=engine)
+
+    n_events = 0
+    with engine.begin() as conn:
+        new_table.create(conn)
+        result = conn.execute(
+            select([
+                legacy_table.c.apikey_id,
+                legacy_table.c.finished_at,
+                legacy_table.c.status_id,
+            ]).order_by(legacy_table.c.finished_at)
+        )
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            conn.execute(new_table.insert(), [
+                {
+                    "apikey_id": apikey_id,
+                    "finished_at": to_epoch_micros(finished_at),
+                    "status_id": status_id,
+                }
+                for apikey_id, finished_at, status_id in rows
+            ])
+            n_events += len(rows)
+        legacy_table.drop(conn)
+        conn.execute("ALTER TABLE event_migrating RENAME TO event")
+        for index in Event.__table__.indexes:
+            index.create(conn)
+    return n_events
+
+
+def _bucket_of(column, size):
+    """
+    SQL expression of the start of the bucket containing ``column``. The
+    bucket size is rendered inline, so the expression can be repeated in
+    ``GROUP BY``.
+    """
+    return column - column % literal_column(str(int(size)))
+
+
+_INSERT_ROLLUP_SQL = (
+    "INSERT INTO event_rollup "
+    "(bucket_start, resolution, apikey_id, status_id, count) "
+    "VALUES (:bucket_start, :resolution, :apikey_id, :status_id, :count) "
+)
+
+_ON_CONFLICT_SQL = (
+    "ON CONFLICT (bucket_start, resolution, apikey_id, status_id) "
+    "DO UPDATE SET count = event_rollup.count + excluded.count"
+)
+
+_ON_DUPLICATE_KEY_SQL = "ON DUPLICATE KEY UPDATE count = count + VALUES(count)"
+
+
+def get_upsert_rollup_sql(engine):
+    """
+    Native upsert statement of :class:`EventRollup` for PostgreSQL 9.5+,
+    sqlite 3.24+ and MySQL, None for other databases. The engine has to be
+    connected once, so the server version is known.
+    """
+    name = engine.dialect.name
+    if name == "postgresql":
+        if engine.dialect.server_version_info >= (9, 5):
+            return text(_INSERT_ROLLUP_SQL + _ON_CONFLICT_SQL)
+    elif name == "sqlite":
+        if sqlite3.sqlite_version_info >= (3, 24):
+            return text(_INSERT_ROLLUP_SQL + _ON_CONFLICT_SQL)
+    elif name == "mysql":
+        return text(_INSERT_ROLLUP_SQL + _ON_DUPLICATE_KEY_SQL)
+    return None
+
+
+def count_by_minute(rows):
+    """
+    :param rows: ``(apikey_id, finished_at, status_id, duration)`` rows,
+        ``finished_at`` is epoch microseconds.
+    :return: dict, ``(bucket_start, apikey_id, status_id)`` -> count.
+    """
+    counts = dict()
+    for apikey_id, finished_at, status_id, _ in rows:
+        bucket_start = finished_at // (MINUTE * 1000000) * MINUTE
+        key = (bucket_start, apikey_id, status_id)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _upsert_rollup(conn, resolution, counts, upsert_sql=None):
+    """
+    Add counts into :class:`EventRollup` rows of one resolution, with the
+    native upsert statement if given, otherwise select then update / insert.
+
+    :param counts: dict, ``(bucket_start, apikey_id, status_id)`` -> count.
+    :param upsert_sql: see :func:`get_upsert_rollup_sql`.
+    """
+    if not counts:
+        return
+    if upsert_sql is not None:
+        conn.execute(upsert_sql, [
+            {
+                "bucket_start": bucket_start,
+                "resolution": resolution,
+                "apikey_id": apikey_id,
+                "status_id": status_id,
+                "count": count,
+            }
+            for (bucket_start, apikey_id, status_id), count in counts.items()
+        ])
+    else:
+        _merge_rollup(conn, resolution, counts)
+
+
+def _merge_rollup(conn, resolution, counts):
+    """
+    Portable version of :func:`_upsert_rollup`, the caller has to make sure
+    no one else writes the same rows meanwhile.
+
+    :param counts: dict, ``(bucket_start, apikey_id, status_id)`` -> count.
+    """
+    if not counts:
+        return
+    counts = dict(counts)
+    table = EventRollup.__table__
+    bucket_start_list = [key[0] for key in counts]
+    existing = conn.execute(
+        select([
+            table.c.bucket_start, table.c.apikey_id,
+            table.c.status_id, table.c.count,
+        ]).where(and_(
+            table.c.resolution == resolution,
+            table.c.bucket_start >= min(bucket_start_list),
+            table.c.bucket_start <= max(bucket_start_list),
+        ))
+    ).fetchall()
+
+    updates = list()
+    for bucket_start, apikey_id, status_id, count in existing:
+        key = (bucket_start, apikey_id, status_id)
+        if key in counts:
+            updates.append({
+                "b_bucket_start": bucket_start,
+                "b_apikey_id": apikey_id,
+                "b_status_id": status_id,
+                "b_count": count + counts.pop(key),
+            })
+    if updates:
+        conn.execute(
+            table.update().where(and_(
+                table.c.bucket_start == bindparam("b_bucket_start"),
+                table.c.resolution == resolution,
+                table.c.apikey_id == bindparam("b_apikey_id"),
+                table.c.status_id == bindparam("b_status_id"),
+            )).values(count=bindparam("b_count")),
+            updates,
+        )
+    if counts:
+        conn.execute(table.insert(), [
+            {
+                "bucket_start": bucket_start,
+                "resolution": resolution,
+                "apikey_id": apikey_id,
+                "status_id": status_id,
+                "count": count,
+            }
+            for (bucket_start, apikey_id, status_id), count in counts.items()
+        ])
+
+
+def create_durable_sqlite_engine(path,
+                                 pool_size=5,
+                                 busy_timeout=30,
+                                 cache_size_kb=65536,
+                                 mmap_size=268435456):
+    """
+    Create a file backed sqlite engine tuned for high write throughput.
+
+    Every connection uses WAL journaling, so readers don't block the writer,
+    and ``synchronous=NORMAL``, which fsyncs only at checkpoint instead of at
+    every commit. The database stays consistent after a crash, only the most
+    recent transactions might be lost on power failure.
+
+    :param path: sqlite database file path.
+    :param pool_size: number of pooled connections, for concurrent readers.
+    :param busy_timeout: seconds to wait for the write lock.
+    :param cache_size_kb: page cache size per connection in KiB.
+    :param mmap_size: max bytes of the database file to memory map.
+    """
+    engine = create_engine(
+        "sqlite:///%s" % path,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": busy_timeout,
+        },
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-%d" % cache_size_kb)
+        cursor.execute("PRAGMA mmap_size=%d" % mmap_size)
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA busy_timeout=%d" % (busy_timeout * 1000))
+        cursor.close()
+
+    return engine
+
+
+class _NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def is_single_connection_engine(engine):
+    """
+    Whether all threads share one database connection, for example the
+    in memory sqlite engine with ``StaticPool``.
+    """
+    return isinstance(engine.pool, (StaticPool, AssertionPool))
+
+
+def is_thread_local_memory_engine(engine):
+    """
+    Whether each thread gets its own empty database from this engine, for
+    example ``engine_creator.create_sqlite()`` with ``SingletonThreadPool``.
+    """
+    return (engine.dialect.name == "sqlite") and \
+        (engine.url.database in (None, "", ":memory:")) and \
+        (not is_single_connection_engine(engine))
+
+
+class StatsCollector(BaseStatsCollector):
+    """
+    Database backed usage events collector.
+
+    :param engine: sqlalchemy engine.
+    :param buffer_size: if given, events are collected in memory and written
+        with one bulk insert when this many events are pending.
+    :param buffer_max_age: if given, pending events are also written once
+        the oldest one is older than this many seconds. The age is checked
+        when a new event is added.
+    :param window: if given, keep an in memory
+        :class:`~apipool.window.SlidingWindowCounter` of this many seconds.
+        ``usage_count_*`` queries within the window are answered from memory
+        without touching database. Only events added by this collector are
+        counted.
+    :param window_resolution: bucket size in seconds of the sliding window.
+    :param store_duration: store the call duration on the event, as
+        microseconds in ``Event.duration``.
+    :param rollup_after: if given, raw events older than this many seconds
+        are deleted, they are already counted in the per minute
+        :class:`EventRollup` rows.
+    :param hourly_rollup_after: if given, per minute rows older than this
+        many seconds are rolled up into per hour rows.
+    :param retention: if given, events and rollup rows older than this many
+        seconds are deleted.
+    :param rollup_interval: seconds between two automatic :meth:`rollup`,
+        run by the background :class:`~apipool.writer.StatsWriter` between
+        writes, never by the write of an api call. None turns it off.
+        Without background writer, call :meth:`rollup` from a scheduled job.
+
+    Pending events are always written on :meth:`flush` and :meth:`close`.
+
+    Every write also adds the events to per minute :class:`EventRollup`
+    counter rows. ``usage_count_*`` queries read counter rows for the whole
+    minutes in the time window, and raw events for the partial minute at its
+    start. Beyond ``rollup_after`` the count is precise to the bucket size,
+    only buckets starting within the time window are counted.
+    :meth:`query_event_in_recent_n_seconds` returns raw events only.
+
+    It is safe to share a collector between threads. Each database operation
+    uses its own session, ``self.ses`` is a thread local session. Database
+    access is serialized only if the engine shares one connection between
+    threads, the pending events buffer is guarded by a short lived lock.
+    """
+
+    def __init__(self,
+                 engine,
+                 buffer_size=None,
+                 buffer_max_age=None,
+                 window=None,
+                 window_resolution=1,
+                 rollup_after=None,
+                 hourly_rollup_after=None,
+                 retention=None,
+                 rollup_interval=60,
+                 store_duration=False):
+        migrate_event_table(engine)
+        table_names = inspect(engine).get_table_names()
+        needs_backfill = ("event" in table_names) and \
+                         ("event_rollup" not in table_names)
         Base.metadata.create_all(engine)
         self.engine = engine
-        self.ses = self.create_session()
+        self._upsert_sql = get_upsert_rollup_sql(engine)
+        self._session_factory = sessionmaker(bind=engine)
+        self.ses = scoped_session(self._session_factory)
+
+        if is_single_connection_engine(engine):
+            self._db_lock = threading.RLock()
+        else:
+            self._db_lock = _NoLock()
 
         self._add_all_status()
 
         self._cache_apikey = dict()
         self._cache_status = StatusCollection.get_mapper_id_to_description()
 
-    def create_session(self):
-        return sessionmaker(bind=self.engine)()
+        self.store_duration = store_duration
+        self.buffer_size = buffer_size
+        self.buffer_max_age = buffer_max_age
+        self._buffer = list()
+        self._lock = threading.Lock()
+
+        self.window = None
+        if window:
+            self.window = SlidingWindowCounter(
+                window=window, resolution=window_resolution,
+            )
+
+        self.rollup_after = rollup_after
+        self.hourly_rollup_after = hourly_rollup_after
+        self.retention = retention
+        self.rollup_interval = rollup_interval
+        self._rollup_lock = threading.Lock()
+        self._next_rollup_at = None
+        if (rollup_interval is not None) and (
+                (rollup_after is not None) or
+                (hourly_rollup_after is not None) or
+                (retention is not None)):
+            self._next_rollup_at = clock() + rollup_interval
+
+        if needs_backfill:
+            with self._db_lock:
+                with self.engine.begin() as conn:
+                    self._backfill_rollup(conn)
 
-    def close(self):
-        self.ses.close()
+    @classmethod
+    def from_sqlite_file(cls, path, engine_kwargs=None, **kwargs):
+        """
+        Durable stats collector on a WAL mode sqlite file, see
+        :func:`create_durable_sqlite_engine`.
+
+        :param engine_kwargs: arguments for
+            :func:`create_durable_sqlite_engine`.
+        :param kwargs: arguments for :class:`StatsCollector`.
+        """
+        if engine_kwargs is None:
+            engine_kwargs = dict()
+        engine = create_durable_sqlite_engine(path, **engine_kwargs)
+        return cls(engine=engine, **kwargs)
 
-    def __enter__(self):
-        return self
+    def create_session(self):
+        return self._session_factory()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+    def close(self):
+        self.flush()
+        self.ses.remove()
 
     def _add_all_status(self):
-        Status.smart_insert(
-            self.engine,
-            StatusCollection.get_status_list(),
-        )
+        with self._db_lock:
+            Status.smart_insert(
+                self.engine,
+                StatusCollection.get_status_list(),
+            )
 
     def add_all_apikey(self, apikey_list):
         data = [ApiKey(key=apikey.primary_key) for apikey in apikey_list]
-        ApiKey.smart_insert(self.engine, data)
-        self._update_cache()
+        with self._db_lock:
+            ApiKey.smart_insert(self.engine, data)
+            self._update_cache()
 
     def _update_cache(self):
         ses = self.create_session()
-        apikey_list = ses.query(ApiKey).all()
+        try:
+            apikey_list = ses.query(ApiKey).all()
+        finally:
+            ses.close()
         for apikey in apikey_list:
             self._cache_apikey.setdefault(apikey.key, apikey.id)
-        ses.close()
 
-    def add_event(self, primary_key, status_id):
-        event = Event(
-            apikey_id=self._cache_apikey[primary_key],
-            finished_at=datetime.now(),
-            status_id=status_id,
+    @property
+    def is_buffered(self):
+        return bool(self.buffer_size) or (self.buffer_max_age is not None)
+
+    def add_event(self,
+                  primary_key,
+                  status_id,
+                  finished_at=None,
+                  duration=None):
+        finished_at = to_epoch_micros(finished_at)
+        row = (
+            self._cache_apikey[primary_key],
+            finished_at,
+            status_id,
+            self._to_duration_micros(duration),
         )
-        Event.smart_insert(self.engine, event)
+        if self.window is not None:
+            self.window.add(primary_key, status_id, finished_at / 1000000.0)
+        if self.is_buffered:
+            with self._lock:
+                self._buffer.append(row)
+                is_due = self._is_buffer_due(finished_at)
+            if is_due:
+                self.flush()
+        else:
+            self._insert_rows([row, ])
+
+    def add_events(self, event_data_list):
+        """
+        Add many events at once, unbuffered events are written with one
+        bulk insert.
+
+        :param event_data_list: list of
+            ``(primary_key, status_id, finished_at[, duration])`` tuple.
+        """
+        rows = [
+            (
+                self._cache_apikey[event_data[0]],
+                to_epoch_micros(event_data[2]),
+                event_data[1],
+                self._to_duration_micros(
+                    event_data[3] if len(event_data) > 3 else None),
+            )
+            for event_data in event_data_list
+        ]
+        if not rows:
+            return
+        if self.window is not None:
+            for event_data, row in zip(event_data_list, rows):
+                self.window.add(
+                    event_data[0], event_data[1], row[1] / 1000000.0)
+        if self.is_buffered:
+            with self._lock:
+                self._buffer.extend(rows)
+                is_due = self._is_buffer_due(to_epoch_micros())
+            if is_due:
+                self.flush()
+        else:
+            self._insert_rows(rows)
+
+    def _insert_rows(self, rows):
+        """
+        Insert ``(apikey_id, finished_at, status_id, duration)`` rows with
+        one bulk insert, and add them to the per minute counters in the same
+        transaction.
+        """
+        counts = count_by_minute(rows)
+        with self._db_lock:
+            with self.engine.begin() as conn:
+                conn.execute(Event.__table__.insert(), [
+                    {
+                        "apikey_id": apikey_id,
+                        "finished_at": finished_at,
+                        "status_id": status_id,
+                        "duration": duration,
+                    }
+                    for apikey_id, finished_at, status_id, duration in rows
+                ])
+                _upsert_rollup(conn, MINUTE, counts, self._upsert_sql)
+
+    def _to_duration_micros(self, duration):
+        if (duration is None) or (not self.store_duration):
+            return None
+        return int(duration * 1000000)
+
+    def _is_buffer_due(self, now):
+        if self.buffer_size and len(self._buffer) >= self.buffer_size:
+            return True
+        if self.buffer_max_age is not None:
+            age = (now - self._buffer[0][1]) / 1000000.0
+            if age >= self.buffer_max_age:
+                return True
+        return False
+
+    def flush(self):
+        """
+        Write all pending events into database with one bulk insert.
+
+        :return: number of events been flushed.
+        """
+        with self._lock:
+            if not self._buffer:
+                return 0
+            rows, self._buffer = self._buffer, list()
+        self._insert_rows(rows)
+        return len(rows)
+
+    def maybe_rollup(self):
+        if (self._next_rollup_at is None) or (clock() < self._next_rollup_at):
+            return False
+        if not self._rollup_lock.acquire(False):  # another thread is on it
+            return False
+        try:
+            self._next_rollup_at = clock() + self.rollup_interval
+            self._rollup(time.time())
+        finally:
+            self._rollup_lock.release()
+        return True
+
+    def rollup(self, now=None):
+        """
+        Purge and roll up old events according to ``rollup_after``,
+        ``hourly_rollup_after`` and ``retention``, in one transaction. The
+        background writer runs it every ``rollup_interval`` seconds.
+
+        :param now: epoch seconds, default is now.
+        :return: number of raw events purged.
+        """
+        if now is None:
+            now = time.time()
+        with self._rollup_lock:
+            return self._rollup(now)
+
+    def _rollup(self, now):
+        n_events = 0
+        with self._db_lock:
+            with self.engine.begin() as conn:
+                if self.rollup_after is not None:
+                    n_events = self._purge_events(
+                        conn,
+                        int((now - self.rollup_after) // MINUTE * MINUTE),
+                    )
+                if self.hourly_rollup_after is not None:
+                    self._rollup_minutes(
+                        conn,
+                        int((now - self.hourly_rollup_after) // HOUR * HOUR),
+                    )
+                if self.retention is not None:
+                    self._purge(conn, int(now - self.retention))
+        return n_events
+
+    def _backfill_rollup(self, conn):
+        """
+        Count all raw events into per minute rows, for an ``event`` table
+        created before :class:`EventRollup` existed.
+        """
+        table = Event.__table__
+        bucket = _bucket_of(table.c.finished_at, MINUTE * 1000000)
+        rows = conn.execute(
+            select([
+                bucket, table.c.apikey_id, table.c.status_id, func.count(),
+            ]).group_by(
+                bucket, table.c.apikey_id, table.c.status_id,
+            )
+        ).fetchall()
+        _upsert_rollup(conn, MINUTE, {
+            (bucket_start // 1000000, apikey_id, status_id): count
+            for bucket_start, apikey_id, status_id, count in rows
+        }, self._upsert_sql)
+
+    def _purge_events(self, conn, cutoff):
+        """
+        Delete raw events finished before ``cutoff`` epoch seconds, they
+        are already counted in the per minute rows.
+        """
+        table = Event.__table__
+        return conn.execute(
+            table.delete().where(table.c.finished_at < cutoff * 1000000)
+        ).rowcount
+
+    def _rollup_minutes(self, conn, cutoff):
+        table = EventRollup.__table__
+        where = and_(
+            table.c.resolution == MINUTE, table.c.bucket_start < cutoff,
+        )
+        bucket = _bucket_of(table.c.bucket_start, HOUR)
+        rows = conn.execute(
+            select([
+                bucket, table.c.apikey_id, table.c.status_id,
+                func.sum(table.c.count),
+            ]).where(where).group_by(
+                bucket, table.c.apikey_id, table.c.status_id,
+            )
+        ).fetchall()
+        _upsert_rollup(conn, HOUR, {
+            (bucket_start, apikey_id, status_id): count
+            for bucket_start, apikey_id, status_id, count in rows
+        }, self._upsert_sql)
+        conn.execute(table.delete().where(where))
+
+    def _purge(self, conn, cutoff):
+        conn.execute(Event.__table__.delete().where(
+            Event.__table__.c.finished_at < cutoff * 1000000))
+        conn.execute(EventRollup.__table__.delete().where(
+            EventRollup.__table__.c.bucket_start < cutoff))
+
+    def _buffered_events(self,
+                         n_seconds_before,
+                         apikey_id=None,
+                         status_id=None):
+        """
+        :return: pending ``(apikey_id, finished_at, status_id, duration)``
+            rows matching the filters.
+        """
+        with self._lock:
+            buffer = list(self._buffer)
+        return [
+            row for row in buffer
+            if (row[1] >= n_seconds_before) and
+            ((apikey_id is None) or (row[0] == apikey_id)) and
+            ((status_id is None) or (row[2] == status_id))
+        ]
 
     def query_event_in_recent_n_seconds(self,
                                         n_seconds,
                                         primary_key=None,
                                         status_id=None):
-        n_seconds_before = get_n_seconds_before(n_seconds)
+        """
+        Pending events are flushed first, so the returned query sees them.
+        The query is bound to the thread local session ``self.ses``.
+        """
+        self.flush()
+        return self._query_event_after(
+            self.ses,
+            get_n_seconds_before_micros(n_seconds),
+            primary_key=primary_key,
+            status_id=status_id,
+        )
+
+    def _query_event_after(self,
+                           ses,
+                           n_seconds_before,
+                           primary_key=None,
+                           status_id=None,
+                           before=None):
         filters = [Event.finished_at >= n_seconds_before, ]
+        if not (before is None):
+            filters.append(Event.finished_at < before)
         if not (primary_key is None):
             filters.append(Event.apikey_id == self._cache_apikey[primary_key])
         if not (status_id is None):
             filters.append(Event.status_id == status_id)
-        return self.ses.query(Event).filter(*filters)
+        return ses.query(Event).filter(*filters)
+
+    def _query_rollup_after(self,
+                            ses,
+                            bucket_start,
+                            primary_key=None,
+                            status_id=None):
+        filters = [EventRollup.bucket_start >= bucket_start, ]
+        if not (primary_key is None):
+            filters.append(
+                EventRollup.apikey_id == self._cache_apikey[primary_key])
+        if not (status_id is None):
+            filters.append(EventRollup.status_id == status_id)
+        return ses.query(func.sum(EventRollup.count)).filter(*filters)
+
+    @staticmethod
+    def _split_window(n_seconds):
+        """
+        Split the recent ``n_seconds`` into raw events before the first
+        whole minute, and counter rows since then.
+
+        :return: ``(n_seconds_before, edge)``, both epoch microseconds.
+        """
+        n_seconds_before = get_n_seconds_before_micros(n_seconds)
+        bucket_size = MINUTE * 1000000
+        edge = -(-n_seconds_before // bucket_size) * bucket_size
+        return n_seconds_before, edge
 
     def usage_count_in_recent_n_seconds(self,
                                         n_seconds,
                                         primary_key=None,
                                         status_id=None):
-        q = self.query_event_in_recent_n_seconds(
-            n_seconds,
-            primary_key=primary_key,
-            status_id=status_id,
-        )
-        return q.count()
+        if (self.window is not None) and self.window.covers(n_seconds):
+            return self.window.count(
+                n_seconds, primary_key=primary_key, status_id=status_id,
+            )
+
+        n_seconds_before, edge = self._split_window(n_seconds)
+        ses = self.create_session()
+        try:
+            with self._db_lock:
+                count = self._query_event_after(
+                    ses,
+                    n_seconds_before,
+                    primary_key=primary_key,
+                    status_id=status_id,
+                    before=edge,
+                ).count()
+                count += self._query_rollup_after(
+                    ses,
+                    edge // 1000000,
+                    primary_key=primary_key,
+                    status_id=status_id,
+                ).scalar() or 0
+        finally:
+            ses.close()
+
+        if self._buffer:
+            apikey_id = None
+            if primary_key is not None:
+                apikey_id = self._cache_apikey[primary_key]
+            count += len(self._buffered_events(
+                n_seconds_before, apikey_id=apikey_id, status_id=status_id,
+            ))
+        return count
 
     def usage_count_stats_in_recent_n_seconds(self, n_seconds):
-        n_seconds_before = get_n_seconds_before(n_seconds)
-        q = self.ses.query(ApiKey.key, func.count(Event.apikey_id)) \
-            .select_from(Event).join(ApiKey) \
-            .filter(Event.finished_at >= n_seconds_before) \
-            .group_by(Event.apikey_id) \
-            .order_by(ApiKey.key)
-        return OrderedDict(q.all())
+        if (self.window is not None) and self.window.covers(n_seconds):
+            return self.window.count_by_key(n_seconds)
+
+        n_seconds_before, edge = self._split_window(n_seconds)
+        ses = self.create_session()
+        try:
+            q = ses.query(ApiKey.key, func.count(Event.apikey_id)) \
+                .select_from(Event).join(ApiKey) \
+                .filter(Event.finished_at >= n_seconds_before) \
+                .filter(Event.finished_at < edge) \
+                .group_by(Event.apikey_id, ApiKey.key)
+            q_rollup = ses.query(ApiKey.key, func.sum(EventRollup.count)) \
+                .select_from(EventRollup) \
+                .join(ApiKey, EventRollup.apikey_id == ApiKey.id) \
+                .filter(EventRollup.bucket_start >= edge // 1000000) \
+                .group_by(EventRollup.apikey_id, ApiKey.key)
+            with self._db_lock:
+                rows = q.all() + q_rollup.all()
+        finally:
+            ses.close()
+
+        stats = dict()
+        for key, count in rows:
+            stats[key] = stats.get(key, 0) + count
+
+        if self._buffer:
+            id_to_key = {v: k for k, v in self._cache_apikey.items()}
+            for row in self._buffered_events(n_seconds_before):
+                key = id_to_key[row[0]]
+                stats[key] = stats.get(key, 0) + 1
+        return OrderedDict(sorted(stats.items()))
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Api key selection strategies used by :class:`~apipool.manager.DummyClient`
+to pick an api key for each api call.
+
+A strategy is bound to one :class:`~apipool.manager.ApiKeyManager`, which
+notifies it when an api key is added or removed from the active chain.
+
+:meth:`SelectionStrategy.select` can be called from many threads at the same
+time, while ``on_add`` / ``on_remove`` are called with the manager lock held.
+"""
+
+import math
+import time
+import heapq
+import random
+import bisect
+import itertools
+import threading
+from collections import OrderedDict
+
+from .clock import clock
+from .stats import StatusCollection
+
+
+class SelectionStrategy(object):
+    """
+    Api key selection strategy abstract class.
+
+    Subclass has to implement :meth:`SelectionStrategy.select`, and
+    optionally :meth:`SelectionStrategy.on_add` and
+    :meth:`SelectionStrategy.on_remove` to maintain its own index, and
+    :meth:`SelectionStrategy.on_result` to learn from call outcomes.
+    """
+
+    _apikey_manager = None
+
+    def bind(self, apikey_manager):
+        if (self._apikey_manager is not None) and \
+                (self._apikey_manager is not apikey_manager):
+            raise ValueError("strategy is already bound to another manager!")
+        self._apikey_manager = apikey_manager
+
+    def on_add(self, primary_key, apikey):
+        pass
+
+    def on_remove(self, primary_key):
+        pass
+
+    def on_result(self, primary_key, status_id, duration):
+        """
+        Called after every recorded usage event.
+
+        :param status_id: see :class:`~apipool.stats.StatusCollection`.
+        :param duration: call duration in seconds, None if unknown.
+        """
+        pass
+
+    def select(self):
+        """
+        :return: :class:`~apipool.apikey.ApiKey` instance.
+        """
+        raise NotImplementedError
+
+    @property
+    def wants_result(self):
+        """
+        Whether :meth:`on_result` is overridden, the manager skips the call
+        otherwise.
+        """
+        return type(self).on_result is not SelectionStrategy.on_result
+
+
+def pick_from_list(apikey_list, index_getter):
+    """
+    Read ``apikey_list[index_getter(len(apikey_list))]`` without lock, retry
+    if the list shrinks in between.
+    """
+    while True:
+        n = len(apikey_list)
+        if n == 0:
+            raise IndexError("there's no usable api key!")
+        try:
+            return apikey_list[index_getter(n)]
+        except IndexError:  # pragma: no cover
+            pass
+
+
+class RandomStrategy(SelectionStrategy):
+    """
+    Uniform random selection, O(1).
+    """
+
+    def select(self):
+        return pick_from_list(
+            self._apikey_manager._apikey_list, random.randrange,
+        )
+
+
+class RoundRobinStrategy(SelectionStrategy):
+    """
+    Rotate through active api keys, O(1).
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def _next_index(self, n):
+        return next(self._counter) % n
+
+    def select(self):
+        return pick_from_list(
+            self._apikey_manager._apikey_list, self._next_index,
+        )
+
+
+class LeastRecentlyUsedStrategy(SelectionStrategy):
+    """
+    Pick the api key which hasn't been used for the longest time, O(1).
+    """
+
+    def __init__(self):
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_add(self, primary_key, apikey):
+        with self._lock:
+            self._lru.pop(primary_key, None)
+            self._lru[primary_key] = apikey
+
+    def on_remove(self, primary_key):
+        with self._lock:
+            self._lru.pop(primary_key, None)
+
+    def select(self):
+        with self._lock:
+            if not self._lru:
+                raise IndexError("there's no usable api key!")
+            primary_key = next(iter(self._lru))
+            apikey = self._lru.pop(primary_key)
+            self._lru[primary_key] = apikey
+            return apikey
+
+
+class LeastUsedInWindowStrategy(SelectionStrategy):
+    """
+    Pick the api key with the least usage in recent ``n_seconds``, O(log n).
+
+    Usage counts come from ``manager.stats.usage_count_stats_in_recent_n_seconds``
+    and are refreshed every ``refresh_interval`` seconds, between refreshes
+    each selection increments the local count of the selected key.
+
+    :param n_seconds: usage window in seconds.
+    :param refresh_interval: seconds between two refresh from stats.
+    """
+
+    def __init__(self, n_seconds=3600, refresh_interval=10):
+        self.n_seconds = n_seconds
+        self.refresh_interval = refresh_interval
+        self._heap = list()
+        self._counts = dict()
+        self._tiebreak = itertools.count()
+        self._refreshed_at = None
+        self._lock = threading.RLock()
+
+    def on_add(self, primary_key, apikey):
+        with self._lock:
+            count = self._counts.get(primary_key, 0)
+            self._counts[primary_key] = count
+            heapq.heappush(
+                self._heap, (count, next(self._tiebreak), primary_key))
+
+    def on_remove(self, primary_key):
+        # lazy deletion, stale heap entries are skipped by ``select``
+        with self._lock:
+            self._counts.pop(primary_key, None)
+
+    def refresh(self):
+        stats = self._apikey_manager.stats.usage_count_stats_in_recent_n_seconds(
+            self.n_seconds
+        )
+        with self._lock:
+            self._counts = {
+                primary_key: stats.get(primary_key, 0)
+                for primary_key in list(self._apikey_manager.apikey_chain)
+            }
+            self._heap = [
+                (count, next(self._tiebreak), primary_key)
+                for primary_key, count in self._counts.items()
+            ]
+            heapq.heapify(self._heap)
+            self._refreshed_at = time.time()
+
+    def select(self):
+        if (self._refreshed_at is None) or \
+                (time.time() - self._refreshed_at >= self.refresh_interval):
+            self.refresh()
+
+        apikey_chain = self._apikey_manager.apikey_chain
+        with self._lock:
+            while True:
+                if not self._heap:
+                    raise IndexError("there's no usable api key!")
+                count, _, primary_key = heapq.heappop(self._heap)
+                if self._counts.get(primary_key) == count:
+                    apikey = apikey_chain.get(primary_key)
+                    if apikey is not None:
+                        break
+
+            count += 1
+            self._counts[primary_key] = count
+            heapq.heappush(
+                self._heap, (count, next(self._tiebreak), primary_key))
+            return apikey
+
+
+class WeightedStrategy(SelectionStrategy):
+    """
+    Random selection proportional to static weight, O(log n).
+
+    The weight of an api key is looked up from ``weights`` by primary key,
+    then from the ``weight`` attribute of the api key, default 1.
+
+    :param weights: dict, primary key -> weight.
+    """
+
+    def __init__(self, weights=None):
+        if weights is None:
+            weights = dict()
+        self.weights = weights
+        self._snapshot = None  # (apikey_list, cumulative weight list)
+        self._dirty = True
+
+    def get_weight(self, apikey):
+        weight = self.weights.get(apikey.primary_key)
+        if weight is None:
+            weight = getattr(apikey, "weight", 1)
+        return weight
+
+    def on_add(self, primary_key, apikey):
+        self._dirty = True
+
+    def on_remove(self, primary_key):
+        self._dirty = True
+
+    def _rebuild(self):
+        self._dirty = False
+        apikey_list = list(self._apikey_manager._apikey_list)
+        cumulative = list()
+        total = 0
+        for apikey in apikey_list:
+            total += self.get_weight(apikey)
+            cumulative.append(total)
+        self._snapshot = (apikey_list, cumulative)
+
+    def select(self):
+        if self._dirty:
+            self._rebuild()
+        apikey_list, cumulative = self._snapshot
+        if not apikey_list:
+            raise IndexError("there's no usable api key!")
+        total = cumulative[-1]
+        if total <= 0:
+            raise ValueError("sum of weight has to be positive!")
+        position = bisect.bisect_right(cumulative, random.random() * total)
+        return apikey_list[min(position, len(apikey_list) - 1)]
+
+
+class EwmaStrategy(SelectionStrategy):
+    """
+    Latency and error aware selection by power of two random choices, O(1).
+
+    Every api key has an exponentially weighted moving average of latency
+    of successful calls and of failure rate, updated by each call outcome.
+    For each call two distinct keys are picked at random, the one with lower
+    cost ``latency + error_penalty * failure_rate`` wins. Traffic moves
+    towards the fast and healthy keys, a key which fails fast is as
+    expensive as a key which is ``error_penalty`` seconds slow.
+
+    A key without any result yet costs 0, so it is tried first. Until a key
+    has a successful call with a known duration, its latency is the moving
+    average of all keys. The cost of a key decays towards 0 while it is not
+    used, so a key which had a bad moment is tried again.
+
+    :param alpha: weight of the newest outcome, 0 ~ 1.
+    :param error_penalty: seconds added to the cost at 100% failure rate.
+    :param decay_time: seconds for the cost of an idle key to decay to
+        ``1 / e``.
+    """
+
+    def __init__(self, alpha=0.2, error_penalty=1.0, decay_time=10.0):
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.decay_time = decay_time
+        # primary key -> (latency or None, failure rate, updated at)
+        self._stats = dict()
+        # latency of successful calls of all keys
+        self._mean_latency = None
+        self._lock = threading.Lock()
+
+    def on_result(self, primary_key, status_id, duration):
+        is_success = status_id == StatusCollection.c1_Success.id
+        alpha = self.alpha
+        with self._lock:
+            stat = self._stats.get(primary_key)
+            if stat is None:
+                latency, failure_rate = None, 0.0
+            else:
+                latency, failure_rate, _ = stat
+            if is_success and (duration is not None):
+                if latency is None:
+                    latency = duration
+                else:
+                    latency += alpha * (duration - latency)
+                if self._mean_latency is None:
+                    self._mean_latency = duration
+                else:
+                    self._mean_latency += alpha * \
+                        (duration - self._mean_latency)
+            failure_rate += alpha * ((0.0 if is_success else 1.0)
+                                     - failure_rate)
+            self._stats[primary_key] = (latency, failure_rate, clock())
+
+    def get_cost(self, primary_key, now=None):
+        stat = self._stats.get(primary_key)
+        if stat is None:
+            return 0.0
+        latency, failure_rate, updated_at = stat
+        if latency is None:
+            latency = self._mean_latency or 0.0
+        if now is None:
+            now = clock()
+        decay = math.exp(-(now - updated_at) / self.decay_time)
+        return (latency + self.error_penalty * failure_rate) * decay
+
+    def select(self):
+        apikey_list = self._apikey_manager._apikey_list
+        while True:
+            n = len(apikey_list)
+            if n < 2:
+                return pick_from_list(apikey_list, random.randrange)
+            i = random.randrange(n)
+            j = random.randrange(n - 1)
+            if j >= i:
+                j += 1
+            try:
+                first, second = apikey_list[i], apikey_list[j]
+            except IndexError:  # list shrinks in between
+                continue
+            now = clock()
+            if self.get_cost(second.primary_key, now) < \
+                    self.get_cost(first.primary_key, now):
+                return second
+            return first
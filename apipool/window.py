@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In process sliding window usage counter. Each api key owns a ring buffer of
+time buckets, each bucket counts events by status id. Counting events in the
+recent n seconds only visits the buckets in that window, no database query
+is needed.
+"""
+
+import time
+import math
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+
+def to_timestamp(dt):
+    """
+    Convert a naive local ``datetime`` to epoch seconds.
+    """
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+
+class _Ring(object):
+    __slots__ = ("epochs", "counts")
+
+    def __init__(self, n_buckets):
+        self.epochs = [-1, ] * n_buckets
+        self.counts = [None, ] * n_buckets
+
+
+class SlidingWindowCounter(object):
+    """
+    :param window: max time window in seconds can be answered.
+    :param resolution: bucket size in seconds. The counted window is rounded
+        to whole buckets, so the result is precise to ``resolution`` seconds.
+
+    Memory usage is ``O(n_keys * window / resolution)``.
+    """
+
+    def __init__(self, window=3600, resolution=1):
+        if window <= 0 or resolution <= 0:
+            raise ValueError("window and resolution has to be positive!")
+        self.window = window
+        self.resolution = resolution
+        self.n_buckets = int(math.ceil(float(window) / resolution))
+        self._rings = dict()
+        self._lock = threading.Lock()
+
+    def covers(self, n_seconds):
+        return n_seconds <= self.window
+
+    def add(self, primary_key, status_id, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        elif isinstance(timestamp, datetime):
+            timestamp = to_timestamp(timestamp)
+        epoch = int(timestamp // self.resolution)
+        idx = epoch % self.n_buckets
+
+        with self._lock:
+            try:
+                ring = self._rings[primary_key]
+            except KeyError:
+                ring = _Ring(self.n_buckets)
+                self._rings[primary_key] = ring
+
+            slot_epoch = ring.epochs[idx]
+            if slot_epoch != epoch:
+                if slot_epoch > epoch:  # older than the window
+                    return
+                ring.epochs[idx] = epoch
+                ring.counts[idx] = {status_id: 1}
+            else:
+                counts = ring.counts[idx]
+                counts[status_id] = counts.get(status_id, 0) + 1
+
+    def _epoch_range(self, n_seconds, now):
+        if now is None:
+            now = time.time()
+        now_epoch = int(now // self.resolution)
+        n = min(
+            self.n_buckets,
+            int(math.ceil(float(n_seconds) / self.resolution)),
+        )
+        return range(now_epoch - n + 1, now_epoch + 1)
+
+    def _count_ring(self, ring, epoch_range, status_id):
+        total = 0
+        n_buckets = self.n_buckets
+        for epoch in epoch_range:
+            idx = epoch % n_buckets
+            if ring.epochs[idx] == epoch:
+                counts = ring.counts[idx]
+                if status_id is None:
+                    total += sum(counts.values())
+                else:
+                    total += counts.get(status_id, 0)
+        return total
+
+    def count(self, n_seconds, primary_key=None, status_id=None, now=None):
+        """
+        Number of events in recent ``n_seconds``.
+        """
+        epoch_range = self._epoch_range(n_seconds, now)
+        with self._lock:
+            if primary_key is None:
+                rings = list(self._rings.values())
+            else:
+                rings = [self._rings.get(primary_key), ]
+            return sum(
+                self._count_ring(ring, epoch_range, status_id)
+                for ring in rings if ring is not None
+            )
+
+    def count_by_key(self, n_seconds, now=None):
+        """
+        Number of events in recent ``n_seconds`` per key, sorted by key, keys
+        without event are excluded.
+        """
+        epoch_range = self._epoch_range(n_seconds, now)
+        stats = list()
+        with self._lock:
+            for primary_key, ring in self._rings.items():
+                count = self._count_ring(ring, epoch_range, None)
+                if count:
+                    stats.append((primary_key, count))
+        return OrderedDict(sorted(stats))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Background stats writer. API callers put usage events into a bounded queue,
+a dedicated writer thread drains the queue into the
+:class:`~apipool.stats.StatsCollector` in batches, so the request path never
+waits for the database.
+"""
+
+import sys
+import threading
+import time
+
+from .clock import clock
+from .stats import is_thread_local_memory_engine
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+
+class OverflowPolicy(object):
+    """
+    What to do when the event queue is full.
+
+    - ``block``: wait until the writer frees a slot.
+    - ``drop_oldest``: discard the oldest pending event.
+    - ``drop_new``: discard the event being added.
+    """
+    block = "block"
+    drop_oldest = "drop_oldest"
+    drop_new = "drop_new"
+
+    @classmethod
+    def get_all(cls):
+        return [cls.block, cls.drop_oldest, cls.drop_new]
+
+
+_STOP = object()
+
+
+class StatsWriter(object):
+    """
+    :param stats: :class:`~apipool.stats.StatsCollector` instance.
+    :param maxsize: max number of pending events in the queue.
+    :param overflow_policy: one of :class:`OverflowPolicy`.
+    :param batch_size: max number of events written in one bulk insert.
+    :param flush_interval: seconds the writer waits for new events before it
+        flushes the buffer of ``stats``.
+    """
+
+    def __init__(self,
+                 stats,
+                 maxsize=10000,
+                 overflow_policy=OverflowPolicy.block,
+                 batch_size=1000,
+                 flush_interval=1.0):
+        if overflow_policy not in OverflowPolicy.get_all():
+            raise ValueError(
+                "overflow_policy has to be one of %r" % OverflowPolicy.get_all()
+            )
+        self.stats = stats
+        self.overflow_policy = overflow_policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.n_dropped = 0
+        # batch write latency, see :class:`apipool.metrics.Metrics`
+        self.n_flushes = 0
+        self.flush_seconds_total = 0.0
+        self.last_flush_seconds = 0.0
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+
+    def start(self):
+        """
+        Start the writer thread.
+
+        Raise ``ValueError`` if ``stats`` uses an in memory sqlite engine
+        whose connections are per thread, the writer thread would write to
+        its own empty database. Use ``poolclass=StaticPool`` instead.
+        """
+        engine = getattr(self.stats, "engine", None)
+        if (engine is not None) and is_thread_local_memory_engine(engine):
+            raise ValueError(
+                "the in memory sqlite engine of the stats collector gives "
+                "each thread its own database, the background writer can't "
+                "use it! create the engine with "
+                "``poolclass=sqlalchemy.pool.StaticPool`` and "
+                "``connect_args={'check_same_thread': False}``."
+            )
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="apipool-stats-writer",
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    @property
+    def is_alive(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    @property
+    def qsize(self):
+        return self._queue.qsize()
+
+    @property
+    def is_full(self):
+        return self._queue.full()
+
+    def add_event(self, primary_key, status_id, duration=None):
+        """
+        Enqueue an event, the finish time is taken at enqueue time.
+        """
+        item = (primary_key, status_id, time.time(), duration)
+        if self.overflow_policy == OverflowPolicy.block:
+            self._queue.put(item)
+        elif self.overflow_policy == OverflowPolicy.drop_new:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.n_dropped += 1
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._queue.task_done()
+                        self.n_dropped += 1
+                    except queue.Empty:  # pragma: no cover
+                        pass
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_stats()
+                self._maybe_rollup()
+                continue
+
+            stop = item is _STOP
+            batch = list()
+            if not stop:
+                batch.append(item)
+            while (not stop) and (len(batch) < self.batch_size):
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+
+            self._write(batch)
+            self._maybe_rollup()
+            for _ in range(len(batch) + int(stop)):
+                self._queue.task_done()
+            if stop:
+                break
+
+    def _write(self, batch):
+        started_at = clock()
+        try:
+            self.stats.add_events(batch)
+            self.stats.flush()
+            elapsed = clock() - started_at
+            self.n_flushes += 1
+            self.flush_seconds_total += elapsed
+            self.last_flush_seconds = elapsed
+        except Exception as e:  # pragma: no cover
+            sys.stdout.write(
+                "\nFailed to write %s usage events, error: %r\n" % (
+                    len(batch), e)
+            )
+
+    def _flush_stats(self):
+        try:
+            self.stats.flush()
+        except Exception as e:  # pragma: no cover
+            sys.stdout.write(
+                "\nFailed to flush usage events, error: %r\n" % e)
+
+    def _maybe_rollup(self):
+        try:
+            self.stats.maybe_rollup()
+        except Exception as e:  # pragma: no cover
+            sys.stdout.write(
+                "\nFailed to roll up usage events, error: %r\n" % e)
+
+    def flush(self):
+        """
+        Block until every event enqueued so far is written to database.
+        """
+        if self.is_alive:
+            self._queue.join()
+        else:
+            self._drain()
+        self.stats.flush()
+
+    def _drain(self):
+        batch = list()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+            self._queue.task_done()
+        if batch:
+            self._write(batch)
+
+    def join(self, timeout=None):
+        """
+        Write all pending events then stop the writer thread.
+        """
+        if self.is_alive:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+        self._drain()
+        self.stats.flush()
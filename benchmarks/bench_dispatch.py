@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Dispatch hot path: key selection and ``dummyclient`` call overhead over
+pools of fake ``GoogleMapApiKey``. Usage events go to a
+``NullStatsCollector``, so only apipool's own overhead is measured, see
+``bench_stats.py`` for the stats write path.
+
+Usage::
+
+    python benchmarks/bench_dispatch.py --pool-sizes 10,10000 --save
+"""
+
+from runner import main
+
+from apipool import ApiKeyManager
+from apipool.backends import NullStatsCollector
+from apipool.hooks import CallHook
+from apipool.strategy import (
+    RandomStrategy,
+    RoundRobinStrategy,
+    LeastRecentlyUsedStrategy,
+    EwmaStrategy,
+)
+from apipool.tests import GoogleMapApiKey
+
+ADDRESS = "123st, NewYork, NY 10001"
+NUMBER = 20000
+
+
+def create_manager(pool_size, **kwargs):
+    kwargs.setdefault("stats", NullStatsCollector())
+    return ApiKeyManager(
+        apikey_list=[
+            GoogleMapApiKey(apikey="key%s" % i) for i in range(pool_size)
+        ],
+        **kwargs
+    )
+
+
+def run(suite, args):
+    for pool_size in args.pool_sizes:
+        manager = create_manager(pool_size)
+        client = manager._apikey_list[0]._client
+        dummyclient = manager.dummyclient
+
+        # direct client call, the baseline of per call overhead
+        suite.run(
+            "client_call",
+            lambda: client.get_lat_lng_by_address(ADDRESS),
+            NUMBER, pool_size=pool_size,
+        )
+        suite.run(
+            "dummyclient_getattr",
+            lambda: dummyclient.get_lat_lng_by_address,
+            NUMBER, pool_size=pool_size,
+        )
+        suite.run(
+            "dummyclient_call",
+            lambda: dummyclient.get_lat_lng_by_address(ADDRESS),
+            NUMBER, pool_size=pool_size,
+        )
+        suite.run(
+            "random_one", manager.random_one, NUMBER, pool_size=pool_size,
+        )
+
+        for strategy_class in [
+            RandomStrategy,
+            RoundRobinStrategy,
+            LeastRecentlyUsedStrategy,
+            EwmaStrategy,
+        ]:
+            manager = create_manager(pool_size, strategy=strategy_class())
+            suite.run(
+                "select_one", manager.select_one, NUMBER,
+                pool_size=pool_size, strategy=strategy_class.__name__,
+            )
+
+        manager = create_manager(pool_size, rate_limits=[(10 ** 9, 1), ])
+        suite.run(
+            "select_one_rate_limited", manager.select_one, NUMBER,
+            pool_size=pool_size,
+        )
+
+        manager = create_manager(pool_size, hooks=[CallHook(), ])
+        dummyclient = manager.dummyclient
+        suite.run(
+            "dummyclient_call_with_hook",
+            lambda: dummyclient.get_lat_lng_by_address(ADDRESS),
+            NUMBER, pool_size=pool_size,
+        )
+
+
+if __name__ == "__main__":
+    main("dispatch", run)
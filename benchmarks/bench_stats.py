@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stats hot path: ``StatsCollector.add_event`` write cost, and usage query
+latency over event tables of different sizes. Events are spread over the
+last 24 hours, so windowed queries read both per minute rollup rows and raw
+events.
+
+Usage::
+
+    python benchmarks/bench_stats.py --table-sizes 1000,1e7 --save
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+from runner import main
+
+from sqlalchemy.pool import StaticPool
+from sqlalchemy_mate import engine_creator
+
+from apipool.stats import StatusCollection, StatsCollector
+from apipool.tests import GoogleMapApiKey
+
+N_KEYS = 100
+SPAN = 86400
+CHUNK_SIZE = 10000
+SUCCESS_ID = StatusCollection.c1_Success.id
+
+
+def create_memory_collector(**kwargs):
+    engine = engine_creator.create_sqlite(
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    return StatsCollector(engine=engine, **kwargs)
+
+
+def add_keys(stats, n_keys=N_KEYS):
+    keys = ["key%s" % i for i in range(n_keys)]
+    stats.add_all_apikey([GoogleMapApiKey(apikey=key) for key in keys])
+    return keys
+
+
+def load_events(stats, keys, table_size):
+    """
+    Insert ``table_size`` events evenly spread over the last ``SPAN``
+    seconds.
+    """
+    now = time.time()
+    step = float(SPAN) / table_size
+    status_id_list = StatusCollection.get_id_list()
+    for start in range(0, table_size, CHUNK_SIZE):
+        stats.add_events([
+            (
+                keys[i % len(keys)],
+                status_id_list[i % len(status_id_list)],
+                now - SPAN + i * step,
+            )
+            for i in range(start, min(start + CHUNK_SIZE, table_size))
+        ])
+
+
+def run_write(suite, tmp_dir):
+    stats = create_memory_collector()
+    keys = add_keys(stats)
+    suite.run(
+        "add_event", lambda: stats.add_event(keys[0], SUCCESS_ID), 2000,
+        engine="memory", buffer_size=0,
+    )
+    stats = create_memory_collector(buffer_size=1000)
+    keys = add_keys(stats)
+    suite.run(
+        "add_event", lambda: stats.add_event(keys[0], SUCCESS_ID), 20000,
+        engine="memory", buffer_size=1000,
+    )
+    stats.close()
+
+    stats = StatsCollector.from_sqlite_file(
+        os.path.join(tmp_dir, "write.sqlite"))
+    keys = add_keys(stats)
+    suite.run(
+        "add_event", lambda: stats.add_event(keys[0], SUCCESS_ID), 2000,
+        engine="sqlite_file", buffer_size=0,
+    )
+    stats.close()
+
+    stats = StatsCollector.from_sqlite_file(
+        os.path.join(tmp_dir, "write_buffered.sqlite"), buffer_size=1000)
+    keys = add_keys(stats)
+    suite.run(
+        "add_event", lambda: stats.add_event(keys[0], SUCCESS_ID), 20000,
+        engine="sqlite_file", buffer_size=1000,
+    )
+    stats.close()
+
+
+def run_query(suite, table_size):
+    stats = create_memory_collector()
+    keys = add_keys(stats)
+    load_events(stats, keys, table_size)
+    number = 50
+    for n_seconds in [60, 3600, SPAN]:
+        suite.run(
+            "usage_count_in_recent_n_seconds",
+            lambda: stats.usage_count_in_recent_n_seconds(n_seconds),
+            number, table_size=table_size, n_seconds=n_seconds,
+        )
+        suite.run(
+            "usage_count_in_recent_n_seconds_by_key",
+            lambda: stats.usage_count_in_recent_n_seconds(
+                n_seconds, primary_key=keys[0]),
+            number, table_size=table_size, n_seconds=n_seconds,
+        )
+        suite.run(
+            "usage_count_stats_in_recent_n_seconds",
+            lambda: stats.usage_count_stats_in_recent_n_seconds(n_seconds),
+            number, table_size=table_size, n_seconds=n_seconds,
+        )
+    stats.close()
+
+
+def run(suite, args):
+    tmp_dir = tempfile.mkdtemp(prefix="apipool-bench-")
+    try:
+        run_write(suite, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    for table_size in args.table_sizes:
+        run_query(suite, table_size)
+
+
+if __name__ == "__main__":
+    main("stats", run)
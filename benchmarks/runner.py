@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tiny benchmark runner, standard library only.
+
+Each ``bench_*.py`` script defines ``run(suite, args)`` and calls
+:func:`main`. Results are printed, and saved as json under
+``benchmarks/results`` with ``--save``, so two versions can be compared::
+
+    python benchmarks/bench_dispatch.py --save
+    python benchmarks/runner.py benchmarks/results/old.json \
+        benchmarks/results/new.json
+"""
+
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import apipool
+from apipool.clock import clock
+
+RESULTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def measure(func, number, repeat=5):
+    """
+    Call ``func`` ``number`` times per round, with gc disabled.
+
+    :return: ``(best, median)`` seconds per call over ``repeat`` rounds.
+    """
+    timings = list()
+    for _ in range(repeat):
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            started_at = clock()
+            for _ in range(number):
+                func()
+            timings.append((clock() - started_at) / number)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def format_seconds(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "%.3f %s" % (seconds / scale, unit)
+    return "%.1f ns" % (seconds / 1e-9)
+
+
+def format_params(params):
+    return ", ".join("%s=%s" % (k, v) for k, v in sorted(params.items()))
+
+
+class Suite(object):
+    """
+    :param repeat: number of rounds of each benchmark.
+    """
+
+    def __init__(self, name, repeat=5):
+        self.name = name
+        self.repeat = repeat
+        self.results = list()
+
+    def run(self, name, func, number, **params):
+        """
+        Time ``func``, the keyword arguments are recorded as parameters.
+        """
+        best, median = measure(func, number, self.repeat)
+        self.results.append(dict(
+            name=name, params=params, number=number,
+            best=best, median=median,
+        ))
+        print("%-40s %-40s best %12s  median %12s" % (
+            name, format_params(params),
+            format_seconds(best), format_seconds(median),
+        ))
+
+    def to_dict(self):
+        return dict(
+            suite=self.name,
+            apipool_version=apipool.__version__,
+            python_version=platform.python_version(),
+            platform=platform.platform(),
+            created_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            results=self.results,
+        )
+
+    def save(self, path=None):
+        if path is None:
+            if not os.path.exists(RESULTS_DIR):
+                os.makedirs(RESULTS_DIR)
+            path = os.path.join(RESULTS_DIR, "%s-%s-%s.json" % (
+                self.name, apipool.__version__,
+                time.strftime("%Y%m%d-%H%M%S"),
+            ))
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4, sort_keys=True)
+        print("results saved to %s" % path)
+        return path
+
+
+def _result_key(result):
+    return result["name"], format_params(result["params"])
+
+
+def compare(baseline, current, threshold=1.1):
+    """
+    Print the ratio of ``current`` to ``baseline`` best time of each
+    benchmark in both.
+
+    :param baseline: dict loaded from a results file.
+    :param current: dict loaded from a results file.
+    :param threshold: ratio above which a benchmark is flagged.
+    :return: list of keys of the regressed benchmarks.
+    """
+    baseline_results = {
+        _result_key(result): result for result in baseline["results"]
+    }
+    regressions = list()
+    for result in current["results"]:
+        key = _result_key(result)
+        old = baseline_results.get(key)
+        if old is None:
+            continue
+        ratio = result["best"] / old["best"]
+        flag = ""
+        if ratio > threshold:
+            flag = "REGRESSION"
+            regressions.append(key)
+        print("%-40s %-40s %12s -> %12s  x%.2f %s" % (
+            key[0], key[1],
+            format_seconds(old["best"]), format_seconds(result["best"]),
+            ratio, flag,
+        ))
+    return regressions
+
+
+def parse_sizes(text):
+    return [int(float(size)) for size in text.split(",")]
+
+
+def main(name, run, argv=None, pool_sizes="10,100,1000,10000",
+         table_sizes="1000,10000,100000"):
+    parser = argparse.ArgumentParser(
+        description="apipool %s benchmarks" % name)
+    parser.add_argument(
+        "--pool-sizes", type=parse_sizes, default=parse_sizes(pool_sizes),
+        help="comma separated number of api keys, default %s" % pool_sizes)
+    parser.add_argument(
+        "--table-sizes", type=parse_sizes, default=parse_sizes(table_sizes),
+        help="comma separated number of events, default %s, "
+             "1e7 takes a few minutes to load" % table_sizes)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="rounds of each benchmark")
+    parser.add_argument(
+        "--save", action="store_true", help="save results as json")
+    parser.add_argument(
+        "--compare", metavar="BASELINE_JSON",
+        help="compare results with a saved results file")
+    args = parser.parse_args(argv)
+
+    suite = Suite(name, repeat=args.repeat)
+    run(suite, args)
+    if args.save:
+        suite.save()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        compare(baseline, suite.to_dict())
+    return suite
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python runner.py BASELINE_JSON CURRENT_JSON")
+        sys.exit(1)
+    with open(sys.argv[1]) as f1, open(sys.argv[2]) as f2:
+        sys.exit(1 if compare(json.load(f1), json.load(f2)) else 0)
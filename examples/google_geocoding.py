@@ -60,7 +60,7 @@ if __name__ == "__main__":
         apikey_list=apikey_list,
         reach_limit_exc=GeocoderQuotaExceeded,
     )
-    manager.check_usable()
+    print(manager.check_usable(parallelism=5, timeout=10))
 
     address = "1600 Pennsylvania Ave NW, Washington, DC 20500"
 
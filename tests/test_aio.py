@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import asyncio
+from apipool import AsyncApiKeyManager, StatusCollection
+from apipool.hooks import CallHook, SlowestCallsProfiler
+from apipool.tests import ReachLimitError, GoogleMapApiKey, apikeys
+
+
+class AsyncGoogleMapApiClient(object):
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    async def get_lat_lng_by_address(self, address):
+        await asyncio.sleep(0.01)
+        return {"lat": 40.762882, "lng": -73.973700}
+
+    async def raise_other_error(self, address):
+        await asyncio.sleep(0)
+        raise ValueError
+
+    async def raise_reach_limit_error(self, address):
+        await asyncio.sleep(0)
+        raise ReachLimitError
+
+    def sync_method(self):
+        return self.apikey
+
+
+class AsyncGoogleMapApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return AsyncGoogleMapApiClient(self.apikey)
+
+    def user_03_test_usable(self, client):
+        return "99" not in self.apikey
+
+
+class FailingHook(CallHook):
+    def on_error(self,
+                 primary_key, method_name, args, kwargs,
+                 elapsed, error):
+        raise RuntimeError
+
+
+class TestAsyncApiKeyManager(object):
+    def test(self):
+        address = "123st, NewYork, NY 10001"
+
+        async def main():
+            async with AsyncApiKeyManager(
+                apikey_list=[
+                    AsyncGoogleMapApiKey(apikey=apikey)
+                    for apikey in apikeys
+                ],
+                reach_limit_exc=ReachLimitError,
+            ) as manager:
+                results = await asyncio.gather(*[
+                    manager.dummyclient.get_lat_lng_by_address(address)
+                    for _ in range(100)
+                ])
+                assert all("lat" in res for res in results)
+                assert await manager.dummyclient.sync_method() in apikeys
+
+                with pytest.raises(ValueError):
+                    await manager.dummyclient.raise_other_error(address)
+                with pytest.raises(ReachLimitError):
+                    await manager.dummyclient.raise_reach_limit_error(address)
+                assert len(manager.apikey_chain) == 3
+
+                await manager.flush_async()
+                stats = manager.stats
+                assert stats.usage_count_in_recent_n_seconds(3600) == 103
+                assert stats.usage_count_in_recent_n_seconds(
+                    3600, status_id=StatusCollection.c5_Failed.id) == 1
+                assert stats.usage_count_in_recent_n_seconds(
+                    3600, status_id=StatusCollection.c9_ReachLimit.id) == 1
+            return manager
+
+        manager = asyncio.run(main())
+        assert not manager.stats_writer.is_alive
+
+    def test_rate_limit_wait(self):
+        async def main():
+            manager = AsyncApiKeyManager(
+                apikey_list=[AsyncGoogleMapApiKey(apikey=apikeys[0])],
+                rate_limits=[(20, 1), ],
+                rate_limit_wait=True,
+            )
+            await asyncio.gather(*[
+                manager.dummyclient.sync_method() for _ in range(25)
+            ])
+            await manager.close_async()
+
+        asyncio.run(main())
+
+    def test_hooks(self):
+        address = "123st, NewYork, NY 10001"
+        profiler = SlowestCallsProfiler(n=2)
+
+        async def main():
+            manager = AsyncApiKeyManager(
+                apikey_list=[
+                    AsyncGoogleMapApiKey(apikey=apikey)
+                    for apikey in apikeys
+                ],
+                hooks=[profiler, ],
+            )
+            await manager.dummyclient.sync_method()
+            await manager.dummyclient.get_lat_lng_by_address(address)
+            with pytest.raises(ValueError):
+                await manager.dummyclient.raise_other_error(address)
+            await manager.close_async()
+
+        asyncio.run(main())
+        slowest = profiler.get_slowest()
+        assert slowest[0].method_name == "get_lat_lng_by_address"
+        assert slowest[0].elapsed >= 0.01
+        assert slowest[0].args == (address,)
+
+    def test_failing_hook(self):
+        async def main():
+            async with AsyncApiKeyManager(
+                apikey_list=[
+                    AsyncGoogleMapApiKey(apikey=apikey)
+                    for apikey in apikeys
+                ],
+                reach_limit_exc=ReachLimitError,
+                hooks=[FailingHook(), ],
+            ) as manager:
+                with pytest.raises(RuntimeError):
+                    await manager.dummyclient.raise_reach_limit_error("")
+                assert len(manager.apikey_chain) == 3
+                await manager.flush_async()
+                assert manager.stats.usage_count_in_recent_n_seconds(
+                    3600, status_id=StatusCollection.c9_ReachLimit.id) == 1
+
+        asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import threading
 from apipool import ApiKey, ApiKeyManager, StatusCollection
 from apipool.tests import (
     ReachLimitError,
@@ -69,6 +70,90 @@ class TestApiKeyManager(object):
         assert manager.stats.usage_count_in_recent_n_seconds(
             3600, status_id=StatusCollection.c9_ReachLimit.id) == 1
 
+    def test_random_one(self):
+        keys = ["example%s@gmail.com" % i for i in range(10)]
+        manager = ApiKeyManager(
+            apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in keys],
+        )
+
+        def assert_index_consistent():
+            assert len(manager._apikey_list) == len(manager.apikey_chain)
+            for position, apikey in enumerate(manager._apikey_list):
+                assert manager.apikey_chain[apikey.primary_key] is apikey
+                assert manager._apikey_position[apikey.primary_key] == position
+
+        assert_index_consistent()
+        for key in [keys[0], keys[5], keys[9]]:
+            manager.remove_one(key)
+            assert_index_consistent()
+        assert manager.fetch_one(keys[3]).primary_key == keys[3]
+
+        new_apikey = GoogleMapApiKey(apikey=keys[3])
+        manager.add_one(new_apikey, upsert=True)
+        assert_index_consistent()
+        assert manager.fetch_one(keys[3]) is new_apikey
+
+        picked = set(manager.random_one().primary_key for _ in range(200))
+        assert picked == set(manager.apikey_chain)
+
+    def test_caller_cache(self):
+        address = "123st, NewYork, NY 10001"
+        apikey = GoogleMapApiKey(apikey="example1@gmail.com")
+        manager = ApiKeyManager(apikey_list=[apikey])
+
+        caller = manager.dummyclient.get_lat_lng_by_address
+        assert manager.dummyclient.get_lat_lng_by_address is caller
+        assert caller.primary_key == "example1@gmail.com"
+        assert caller(address) == {"lat": 40.762882, "lng": -73.973700}
+        with pytest.raises(AttributeError):
+            manager.dummyclient.not_exists_method
+
+        # upsert replaces the client, the cached caller is invalidated
+        new_apikey = GoogleMapApiKey(apikey="example1@gmail.com")
+        manager.add_one(new_apikey, upsert=True)
+        new_caller = manager.dummyclient.get_lat_lng_by_address
+        assert new_caller is not caller
+        assert new_caller.apikey is new_apikey
+
+        manager.remove_one("example1@gmail.com")
+        assert len(manager._caller_cache) == 0
+
+    @pytest.mark.parametrize("async_stats", [False, True])
+    def test_multi_thread(self, async_stats):
+        address = "123st, NewYork, NY 10001"
+        keys = ["example%s@gmail.com" % i for i in range(20)]
+        manager = ApiKeyManager(
+            apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in keys],
+            reach_limit_exc=ReachLimitError,
+            async_stats=async_stats,
+        )
+
+        def worker(i):
+            for _ in range(50):
+                manager.dummyclient.get_lat_lng_by_address(address)
+            if i % 2:
+                try:
+                    manager.dummyclient.raise_reach_limit_error(address)
+                except ReachLimitError:
+                    pass
+            manager.stats.usage_count_in_recent_n_seconds(3600)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        manager.flush()
+
+        assert manager.stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c1_Success.id) == 400
+        assert manager.stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c9_ReachLimit.id) == 4
+        assert len(manager.apikey_chain) + \
+            len(manager.archived_apikey_chain) == 20
+        assert len(manager._apikey_list) == len(manager.apikey_chain)
+        manager.close()
+
 
 if __name__ == "__main__":
     import os
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from datetime import datetime, timedelta
+from apipool import ApiKeyManager, StatusCollection
+from apipool.backends import (
+    BaseStatsCollector, NullStatsCollector, MemoryStatsCollector,
+)
+from apipool.stats import StatsCollector
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+address = "123st, NewYork, NY 10001"
+
+
+def new_manager(stats):
+    return ApiKeyManager(
+        apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in apikeys],
+        reach_limit_exc=ReachLimitError,
+        stats=stats,
+    )
+
+
+class TestNullStatsCollector(object):
+    def test(self):
+        manager = new_manager(NullStatsCollector())
+        for _ in range(10):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        assert manager.stats.usage_count_in_recent_n_seconds(3600) == 0
+        assert manager.stats.usage_count_stats_in_recent_n_seconds(3600) == {}
+        manager.close()
+
+
+class TestMemoryStatsCollector(object):
+    def test(self):
+        manager = new_manager(MemoryStatsCollector())
+        assert issubclass(StatsCollector, BaseStatsCollector)
+
+        manager.check_usable()
+        for _ in range(10):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        try:
+            manager.dummyclient.raise_reach_limit_error(address)
+        except ReachLimitError:
+            pass
+
+        stats = manager.stats
+        assert stats.usage_count_in_recent_n_seconds(3600) == 15
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c5_Failed.id) == 1
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c9_ReachLimit.id) == 1
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, primary_key=apikeys[3]) == 1
+        assert sum(stats.usage_count_stats_in_recent_n_seconds(
+            3600).values()) == 15
+
+    def test_retention(self):
+        stats = MemoryStatsCollector(retention=60)
+        stats.add_all_apikey([GoogleMapApiKey(apikey=apikeys[0])])
+        now = datetime.now()
+        stats.add_events([
+            (apikeys[0], StatusCollection.c1_Success.id,
+             now - timedelta(seconds=i + 0.5))
+            for i in range(100, 0, -1)
+        ])
+        stats.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        assert stats.usage_count_in_recent_n_seconds(3600) == 60
+        assert stats.usage_count_in_recent_n_seconds(30) == 30
+        log = stats._logs[apikeys[0]]
+        assert len(log.timestamps) - log.offset == 60
+
+        # out of order event
+        stats.add_event(
+            apikeys[0], StatusCollection.c5_Failed.id,
+            time.time() - 10,
+        )
+        assert stats.usage_count_in_recent_n_seconds(
+            15, status_id=StatusCollection.c5_Failed.id) == 1
+        assert list(log.timestamps) == sorted(log.timestamps)
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+import pytest
+from apipool import ApiKeyManager, StatusCollection
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+
+class EchoClient(object):
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def echo(self, x, delay=0):
+        if "1" in self.apikey:
+            raise ReachLimitError
+        time.sleep(delay)
+        return x
+
+    def fail_on_odd(self, x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+
+
+class EchoApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return EchoClient(self.apikey)
+
+
+def create_manager():
+    return ApiKeyManager(
+        apikey_list=[EchoApiKey(apikey=apikey) for apikey in apikeys],
+        reach_limit_exc=ReachLimitError,
+    )
+
+
+class TestMap(object):
+    def test_ordered(self):
+        manager = create_manager()
+        inputs = [(i, random.random() * 0.01) for i in range(100)]
+        assert list(manager.map("echo", inputs, concurrency=8)) == \
+            list(range(100))
+
+        # the key reached limit is archived, its calls retried on others
+        assert "example1@gmail.com" in manager.archived_apikey_chain
+        stats = manager.stats
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c1_Success.id) == 100
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c9_ReachLimit.id) >= 1
+
+    def test_unordered(self):
+        manager = create_manager()
+        results = list(manager.imap_unordered(
+            "echo", [(i, 0.05 if i == 0 else 0) for i in range(20)],
+            concurrency=4,
+        ))
+        assert sorted(results) == list(range(20))
+        assert results[0] != 0
+
+    def test_single_argument(self):
+        manager = create_manager()
+        assert list(manager.map("fail_on_odd", [0, 2, 4])) == [0, 2, 4]
+
+    def test_exception(self):
+        manager = create_manager()
+        results = list(manager.map(
+            "fail_on_odd", range(6), return_exceptions=True,
+        ))
+        assert results[0::2] == [0, 2, 4]
+        assert all(isinstance(e, ValueError) for e in results[1::2])
+
+        with pytest.raises(ValueError):
+            list(manager.map("fail_on_odd", range(6)))
+
+    def test_max_attempts(self):
+        manager = ApiKeyManager(
+            apikey_list=[EchoApiKey(apikey="example1@gmail.com")],
+            reach_limit_exc=ReachLimitError,
+        )
+        results = list(manager.map(
+            "echo", [1], max_attempts=1, return_exceptions=True,
+        ))
+        assert isinstance(results[0], ReachLimitError)
+
+    def test_bounded(self):
+        manager = create_manager()
+        n_read = [0, ]
+        lock = threading.Lock()
+
+        def inputs():
+            for i in range(1000):
+                with lock:
+                    n_read[0] += 1
+                yield (i,)
+
+        results = manager.map("echo", inputs(), concurrency=4)
+        for i, result in enumerate(results):
+            assert result == i
+            assert n_read[0] <= i + 1 + 2 * 4
+            if i == 100:
+                break
+        results.close()
+        assert n_read[0] < 200
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
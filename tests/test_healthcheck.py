@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from apipool import ApiKeyManager, StatusCollection
+from apipool.healthcheck import HealthStatus, check_apikeys
+from apipool.tests import GoogleMapApiKey
+
+
+class SlowGoogleMapApiKey(GoogleMapApiKey):
+    def user_03_test_usable(self, client):
+        time.sleep(2)
+        return True
+
+
+class BrokenGoogleMapApiKey(GoogleMapApiKey):
+    def user_03_test_usable(self, client):
+        raise ValueError("invalid key")
+
+
+def create_apikey_list():
+    return [
+        GoogleMapApiKey(apikey="example1@gmail.com"),
+        SlowGoogleMapApiKey(apikey="example2@gmail.com"),
+        BrokenGoogleMapApiKey(apikey="example3@gmail.com"),
+        GoogleMapApiKey(apikey="example99@gmail.com"),
+    ]
+
+
+class TestCheckApikeys(object):
+    def test(self):
+        report = check_apikeys(create_apikey_list(), parallelism=4, timeout=0.2)
+        assert list(report.results) == [
+            "example1@gmail.com", "example2@gmail.com",
+            "example3@gmail.com", "example99@gmail.com",
+        ]
+        assert report.usable == ["example1@gmail.com"]
+        assert report.timed_out == ["example2@gmail.com"]
+        assert report.failed == ["example3@gmail.com", "example99@gmail.com"]
+
+        result = report.results["example3@gmail.com"]
+        assert result.status == HealthStatus.failed
+        assert isinstance(result.error, ValueError)
+        assert result.latency >= 0
+        assert "1 usable, 2 failed, 1 timed out." in str(report)
+
+    def test_parallelism(self):
+        apikey_list = [
+            SlowGoogleMapApiKey(apikey="example%s@gmail.com" % i)
+            for i in range(10)
+        ]
+        for apikey in apikey_list:
+            apikey.user_03_test_usable = lambda client: time.sleep(0.1) or True
+        started_at = time.time()
+        report = check_apikeys(apikey_list, parallelism=10)
+        assert len(report.usable) == 10
+        assert time.time() - started_at < 0.5
+
+
+class TestApiKeyManager(object):
+    def test_check_usable(self):
+        manager = ApiKeyManager(apikey_list=create_apikey_list())
+        report = manager.check_usable(parallelism=4, timeout=0.2)
+        assert list(manager.apikey_chain) == ["example1@gmail.com"]
+        assert len(manager.archived_apikey_chain) == 3
+        assert len(report.results) == 4
+        assert manager.stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c5_Failed.id) == 3
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
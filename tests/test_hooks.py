@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from apipool import ApiKeyManager, StatusCollection
+from apipool.backends import NullStatsCollector
+from apipool.hooks import CallHook, SlowestCallsProfiler
+from apipool.retry import RetryPolicy
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+
+class SleepClient(object):
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def sleep(self, seconds, fail=False):
+        time.sleep(seconds)
+        if fail:
+            raise ValueError
+        return self.apikey
+
+    def reach_limit(self):
+        raise ReachLimitError
+
+
+class SleepApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return SleepClient(self.apikey)
+
+
+class LogHook(CallHook):
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+
+    def before_call(self, primary_key, method_name, args, kwargs):
+        self.log.append((self.name, "before", method_name, args, kwargs))
+
+    def after_call(self,
+                   primary_key, method_name, args, kwargs,
+                   elapsed, result):
+        assert result == primary_key
+        self.log.append((self.name, "after", method_name, elapsed))
+
+    def on_error(self,
+                 primary_key, method_name, args, kwargs,
+                 elapsed, error):
+        self.log.append((self.name, "error", method_name, type(error)))
+
+
+class SlowStatsCollector(NullStatsCollector):
+    def __init__(self):
+        self.n_events = 0
+
+    def add_event(self,
+                  primary_key,
+                  status_id,
+                  finished_at=None,
+                  duration=None):
+        time.sleep(0.05)
+        self.n_events += 1
+
+
+class FailingHook(CallHook):
+    def after_call(self,
+                   primary_key, method_name, args, kwargs,
+                   elapsed, result):
+        raise RuntimeError
+
+    def on_error(self,
+                 primary_key, method_name, args, kwargs,
+                 elapsed, error):
+        raise RuntimeError
+
+
+def create_manager(**kwargs):
+    return ApiKeyManager(
+        apikey_list=[SleepApiKey(apikey=apikey) for apikey in apikeys],
+        reach_limit_exc=ReachLimitError,
+        **kwargs
+    )
+
+
+class TestHooks(object):
+    def test(self):
+        log = list()
+        outer, inner = LogHook("outer", log), LogHook("inner", log)
+        manager = create_manager(hooks=[outer, ])
+        manager.add_hook(inner)
+
+        manager.dummyclient.sleep(0.01)
+        assert [entry[:2] for entry in log] == [
+            ("outer", "before"), ("inner", "before"),
+            ("inner", "after"), ("outer", "after"),
+        ]
+        assert log[0][3:] == ((0.01,), {})
+        assert log[-1][3] >= 0.01
+
+        del log[:]
+        with pytest.raises(ValueError):
+            manager.dummyclient.sleep(0, fail=True)
+        assert log[0][4] == {"fail": True}
+        assert log[-1] == ("outer", "error", "sleep", ValueError)
+
+        # every failover attempt goes through the hooks
+        del log[:]
+        manager.retry_policy = RetryPolicy(max_attempts=2)
+        with pytest.raises(ReachLimitError):
+            manager.dummyclient.reach_limit()
+        assert len([entry for entry in log if entry[1] == "error"]) == 4
+
+        manager.remove_hook(outer)
+        manager.remove_hook(inner)
+        assert manager.hooks == tuple()
+        del log[:]
+        manager.dummyclient.sleep(0)
+        assert log == []
+
+    def test_failing_hook(self):
+        manager = create_manager(hooks=[FailingHook(), ])
+        with pytest.raises(RuntimeError):
+            manager.dummyclient.reach_limit()
+        # the exhausted key is archived and the event recorded anyway
+        assert len(manager.apikey_chain) == len(apikeys) - 1
+        assert len(manager.archived_apikey_chain) == 1
+
+        with pytest.raises(RuntimeError):
+            manager.dummyclient.sleep(0, fail=True)
+        with pytest.raises(RuntimeError):
+            manager.dummyclient.sleep(0)
+        stats = manager.stats
+        assert stats.usage_count_in_recent_n_seconds(60) == 3
+        for status in [StatusCollection.c1_Success,
+                       StatusCollection.c5_Failed,
+                       StatusCollection.c9_ReachLimit]:
+            assert stats.usage_count_in_recent_n_seconds(
+                60, status_id=status.id) == 1
+
+    def test_profiler(self):
+        profiler = SlowestCallsProfiler(n=3)
+        manager = create_manager(hooks=[profiler, ])
+        for seconds in [0.001, 0.02, 0.001, 0.03, 0.001, 0.01, 0.001]:
+            manager.dummyclient.sleep(seconds)
+        with pytest.raises(ValueError):
+            manager.dummyclient.sleep(0.04, fail=True)
+
+        slowest = profiler.get_slowest()
+        assert [record.args for record in slowest] == [
+            (0.04,), (0.03,), (0.02,),
+        ]
+        assert isinstance(slowest[0].error, ValueError)
+        assert slowest[1].error is None
+        assert slowest[1].primary_key in apikeys
+
+        profiler.reset()
+        assert profiler.get_slowest() == []
+
+        sampled = SlowestCallsProfiler(n=10, sample_rate=0)
+        manager.add_hook(sampled)
+        manager.dummyclient.sleep(0)
+        assert sampled.get_slowest() == []
+
+    def test_elapsed_excludes_stats(self):
+        profiler = SlowestCallsProfiler(n=3)
+        stats = SlowStatsCollector()
+        manager = create_manager(stats=stats, hooks=[profiler, ])
+        manager.dummyclient.sleep(0)
+        with pytest.raises(ValueError):
+            manager.dummyclient.sleep(0, fail=True)
+
+        # the usage events are recorded after the hooks ran
+        assert stats.n_events == 2
+        for record in profiler.get_slowest():
+            assert record.elapsed < 0.05
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
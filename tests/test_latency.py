@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import pytest
+from apipool import ApiKeyManager
+from apipool.latency import LatencyHistogram, LatencyRecorder
+from apipool.stats import Event
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+
+class TestLatencyHistogram(object):
+    def test(self):
+        histogram = LatencyHistogram()
+        assert histogram.percentile(50) is None
+        assert histogram.mean is None
+
+        values = [random.uniform(0.001, 0.1) for _ in range(10000)]
+        for value in values:
+            histogram.record(value)
+        values.sort()
+        for q in [1, 50, 95, 99, 100]:
+            expected = values[int(q / 100.0 * len(values)) - 1]
+            assert histogram.percentile(q) == pytest.approx(expected, rel=0.04)
+        assert histogram.count == 10000
+        assert histogram.mean == pytest.approx(
+            sum(values) / len(values), rel=0.001)
+        assert histogram.percentile(100) <= max(values)
+        assert list(histogram.percentiles()) == [50, 95, 99]
+
+        # O(buckets) memory
+        assert len(histogram.counts) < 1000
+
+    def test_merge(self):
+        fast, slow = LatencyHistogram(), LatencyHistogram()
+        for _ in range(100):
+            fast.record(0.001)
+            slow.record(1)
+        merged = fast.copy()
+        merged.merge(slow)
+        assert merged.count == 200
+        assert merged.percentile(25) == pytest.approx(0.001, rel=0.04)
+        assert merged.percentile(75) == pytest.approx(1, rel=0.04)
+        assert fast.count == 100
+
+
+class SlowClient(object):
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def fast(self):
+        return self.apikey
+
+    def slow(self):
+        time.sleep(0.01)
+        return self.apikey
+
+    def fail(self):
+        raise ValueError
+
+
+class SlowApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return SlowClient(self.apikey)
+
+
+class TestLatencyRecorder(object):
+    def test(self):
+        manager = ApiKeyManager(
+            apikey_list=[SlowApiKey(apikey=apikey) for apikey in apikeys],
+            reach_limit_exc=ReachLimitError,
+            stats_store_duration=True,
+            latency=LatencyRecorder(),
+        )
+        for _ in range(10):
+            manager.dummyclient.fast()
+            manager.dummyclient.slow()
+        with pytest.raises(ValueError):
+            manager.dummyclient.fail()
+
+        latency = manager.latency
+        assert latency.get_histogram().count == 20
+        assert latency.get_histogram(method_name="fail").count == 0
+        assert latency.percentiles(method_name="slow")[50] >= 0.01
+        assert latency.percentiles(method_name="fast")[99] < 0.01
+        assert sum(
+            latency.get_histogram(primary_key=apikey).count
+            for apikey in apikeys
+        ) == 20
+        with pytest.raises(ValueError):
+            latency.get_histogram(primary_key=apikeys[0], method_name="fast")
+
+        # duration of every call is stored on the event
+        durations = [
+            event.duration for event in manager.stats.ses.query(Event)
+        ]
+        assert len(durations) == 21
+        assert all(duration is not None for duration in durations)
+        assert len([d for d in durations if d >= 10000]) == 10
+
+        latency.reset()
+        assert latency.get_histogram().count == 0
+
+    def test_no_duration(self):
+        manager = ApiKeyManager(
+            apikey_list=[SlowApiKey(apikey=apikey) for apikey in apikeys],
+        )
+        manager.dummyclient.fast()
+        assert manager.latency is None
+        assert manager.stats.ses.query(Event).one().duration is None
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
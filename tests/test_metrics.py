@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from apipool import ApiKeyManager
+from apipool.metrics import Metrics, start_http_server, escape_label_value
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # pragma: no cover
+    from urllib2 import urlopen, HTTPError
+
+address = "123st, NewYork, NY 10001"
+
+
+def create_manager(**kwargs):
+    kwargs.setdefault("metrics", Metrics())
+    return ApiKeyManager(
+        apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in apikeys],
+        reach_limit_exc=ReachLimitError,
+        **kwargs
+    )
+
+
+class TestMetrics(object):
+    def test_snapshot(self):
+        manager = create_manager()
+        for _ in range(10):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        with pytest.raises(ValueError):
+            manager.dummyclient.raise_other_error(address)
+        manager.remove_one(apikeys[0])
+
+        snapshot = manager.metrics.snapshot()
+        assert snapshot["active_apikeys"] == len(apikeys) - 1
+        assert snapshot["archived_apikeys"] == 1
+        assert snapshot["stats_queue_size"] == 0
+        calls = snapshot["calls"]
+        assert sum(
+            statuses.get("success", 0)
+            for methods in calls.values()
+            for statuses in methods.values()
+        ) == 10
+        assert sum(
+            methods.get("raise_other_error", {}).get("failed", 0)
+            for methods in calls.values()
+        ) == 1
+
+        manager.metrics.reset()
+        assert manager.metrics.snapshot()["calls"] == {}
+
+    def test_stats_writer(self):
+        manager = create_manager(async_stats=True)
+        for _ in range(10):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        manager.flush()
+        snapshot = manager.metrics.snapshot()
+        assert snapshot["stats_flush_count"] >= 1
+        assert snapshot["stats_flush_seconds_total"] > 0
+        manager.close()
+
+    def test_openmetrics(self):
+        manager = create_manager()
+        manager.dummyclient.get_lat_lng_by_address(address)
+        text = manager.metrics.to_openmetrics()
+        lines = text.splitlines()
+        assert lines[-1] == "# EOF"
+        assert "# TYPE apipool_calls counter" in lines
+        assert len([
+            line for line in lines
+            if line.startswith("apipool_calls_total{") and
+            "method=\"get_lat_lng_by_address\"" in line and
+            "status=\"success\"" in line and line.endswith(" 1")
+        ]) == 1
+        assert "apipool_active_apikeys %s" % len(apikeys) in lines
+        assert "apipool_stats_flush_count 0" in lines
+
+        assert escape_label_value("a\"b\\c\nd") == "a\\\"b\\\\c\\nd"
+
+        with pytest.raises(ValueError):
+            create_manager(metrics=manager.metrics)
+
+    def test_http_server(self):
+        manager = create_manager()
+        manager.dummyclient.get_lat_lng_by_address(address)
+        server = start_http_server(manager.metrics)
+        try:
+            url = "http://127.0.0.1:%s" % server.server_address[1]
+            response = urlopen(url + "/metrics")
+            assert "openmetrics-text" in response.headers["Content-Type"]
+            body = response.read().decode("utf-8")
+            assert "apipool_calls_total{" in body
+            with pytest.raises(HTTPError):
+                urlopen(url + "/other")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from apipool import ApiKeyManager
+from apipool.ratelimit import (
+    TokenBucket, RateLimiter, RateLimitedError, normalize_rate_limits,
+)
+from apipool.tests import GoogleMapApiKey
+
+address = "123st, NewYork, NY 10001"
+
+
+class LimitedGoogleMapApiKey(GoogleMapApiKey):
+    rate_limits = [(2, 3600), ]
+
+
+class TestTokenBucket(object):
+    def test(self):
+        bucket = TokenBucket(max_calls=2, period=1)
+        now = bucket.updated_at
+        assert bucket.wait_time(now) == 0
+        bucket.tokens -= 2
+        assert bucket.wait_time(now) == pytest.approx(0.5)
+        assert bucket.wait_time(now + 0.5) == 0
+
+        with pytest.raises(ValueError):
+            TokenBucket(max_calls=0, period=1)
+
+
+class TestRateLimiter(object):
+    def test(self):
+        limiter = RateLimiter([(10, 1), (3, 60)])
+        now = limiter.buckets[0].updated_at
+        assert [limiter.try_acquire(now) for _ in range(4)] == [
+            True, True, True, False,
+        ]
+        assert limiter.wait_time(now) == pytest.approx(20, abs=0.01)
+        assert limiter.try_acquire(now + 21)
+
+
+def test_normalize_rate_limits():
+    assert normalize_rate_limits(None) is None
+    assert normalize_rate_limits([]) is None
+    assert normalize_rate_limits((10, 1)) == [(10, 1), ]
+    assert normalize_rate_limits([(10, 1), [100, 60]]) == [
+        (10, 1), (100, 60),
+    ]
+    for rate_limits in [[(10, 0)], [(-1, 1)], [(10, 1, 2)], [10], ["ab"]]:
+        with pytest.raises(ValueError):
+            normalize_rate_limits(rate_limits)
+
+
+class BadLimitGoogleMapApiKey(GoogleMapApiKey):
+    rate_limits = [(10, 0), ]
+
+
+class TestApiKeyManager(object):
+    def test_invalid_rate_limits(self):
+        with pytest.raises(ValueError):
+            ApiKeyManager(
+                apikey_list=[GoogleMapApiKey(apikey="example1@gmail.com")],
+                rate_limits=[(10, 0), ],
+            )
+
+        # nothing is added with an invalid key level rate limit
+        manager = ApiKeyManager(apikey_list=[])
+        with pytest.raises(ValueError):
+            manager.add_one(
+                BadLimitGoogleMapApiKey(apikey="example1@gmail.com"))
+        assert len(manager.apikey_chain) == 0
+        assert len(manager._apikey_list) == 0
+
+        # a single tuple is accepted
+        manager = ApiKeyManager(
+            apikey_list=[GoogleMapApiKey(apikey="example1@gmail.com")],
+            rate_limits=(1, 3600),
+        )
+        manager.select_one()
+        with pytest.raises(RateLimitedError):
+            manager.select_one()
+
+    def test_skip_exhausted(self):
+        manager = ApiKeyManager(
+            apikey_list=[
+                LimitedGoogleMapApiKey(apikey="example1@gmail.com"),
+                GoogleMapApiKey(apikey="example2@gmail.com"),
+            ],
+            rate_limits=[(1, 3600), ],
+        )
+        used = [manager.select_one().primary_key for _ in range(3)]
+        assert sorted(used) == [
+            "example1@gmail.com", "example1@gmail.com", "example2@gmail.com",
+        ]
+        with pytest.raises(RateLimitedError):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        with pytest.raises(RateLimitedError):
+            manager.select_one()
+
+        manager.rate_limit_wait = 0.1
+        with pytest.raises(RateLimitedError):
+            manager.select_one()
+
+    def test_wait(self):
+        manager = ApiKeyManager(
+            apikey_list=[GoogleMapApiKey(apikey="example1@gmail.com")],
+            rate_limits=[(20, 1), ],
+            rate_limit_wait=True,
+        )
+        for _ in range(25):
+            manager.dummyclient.get_lat_lng_by_address(address)
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
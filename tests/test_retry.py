@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+import asyncio
+from apipool import ApiKeyManager, AsyncApiKeyManager, StatusCollection
+from apipool.retry import RetryPolicy
+from apipool.strategy import (
+    SelectionStrategy,
+    RandomStrategy,
+    RoundRobinStrategy,
+    LeastUsedInWindowStrategy,
+)
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+
+class TransientError(Exception):
+    pass
+
+
+class FlakyClient(object):
+    """
+    example1 reaches limit, example2 has transient errors, others work.
+    """
+
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def get_apikey(self):
+        if "1" in self.apikey:
+            raise ReachLimitError
+        if "2" in self.apikey:
+            raise TransientError
+        return self.apikey
+
+    def raise_other_error(self):
+        raise ValueError
+
+    async def get_apikey_async(self):
+        await asyncio.sleep(0)
+        return self.get_apikey()
+
+
+class FlakyApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return FlakyClient(self.apikey)
+
+
+class FirstKeyStrategy(SelectionStrategy):
+    def select(self):
+        return self._apikey_manager._apikey_list[0]
+
+
+def create_manager(manager_class=ApiKeyManager, **kwargs):
+    return manager_class(
+        apikey_list=[FlakyApiKey(apikey=apikey) for apikey in apikeys],
+        reach_limit_exc=ReachLimitError,
+        strategy=RoundRobinStrategy(),
+        **kwargs
+    )
+
+
+class TestRetryPolicy(object):
+    def test_wait_time(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3, jitter=False)
+        assert [policy.get_wait_time(i) for i in range(1, 5)] == \
+            pytest.approx([0.1, 0.2, 0.3, 0.3])
+        policy = policy.copy(jitter=True)
+        for i in range(1, 5):
+            assert 0 <= policy.get_wait_time(i) <= 0.3
+        assert RetryPolicy().get_wait_time(3) == 0
+
+    def test_transient_exc(self):
+        assert RetryPolicy(transient_exc=ValueError).transient_exc == \
+            (ValueError,)
+
+
+class TestFailover(object):
+    def test(self):
+        manager = create_manager(retry_policy=RetryPolicy(
+            max_attempts=len(apikeys), transient_exc=TransientError,
+        ))
+        for _ in range(20):
+            assert manager.dummyclient.get_apikey() in [
+                "example3@gmail.com", "example99@gmail.com",
+            ]
+
+        # the exhausted key is archived, the flaky one stays
+        assert "example1@gmail.com" in manager.archived_apikey_chain
+        assert "example2@gmail.com" in manager.apikey_chain
+
+        # every attempt is recorded
+        stats = manager.stats
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c1_Success.id) == 20
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c9_ReachLimit.id) == 1
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c5_Failed.id) >= 1
+
+        # other errors are not retried
+        n_failed = stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c5_Failed.id)
+        with pytest.raises(ValueError):
+            manager.dummyclient.raise_other_error()
+        assert stats.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c5_Failed.id) == n_failed + 1
+
+    def test_max_attempts(self):
+        manager = ApiKeyManager(
+            apikey_list=[
+                FlakyApiKey(apikey=apikey)
+                for apikey in ["example2@gmail.com", "example22@gmail.com"]
+            ],
+            reach_limit_exc=ReachLimitError,
+            retry_policy=RetryPolicy(
+                max_attempts=3, transient_exc=TransientError, backoff=0.01,
+            ),
+        )
+        with pytest.raises(TransientError):
+            manager.dummyclient.get_apikey()
+        assert manager.stats.usage_count_in_recent_n_seconds(3600) == 3
+
+    def test_no_key_left(self):
+        manager = ApiKeyManager(
+            apikey_list=[FlakyApiKey(apikey="example1@gmail.com")],
+            reach_limit_exc=ReachLimitError,
+            retry_policy=RetryPolicy(max_attempts=None),
+        )
+        with pytest.raises(ReachLimitError):
+            manager.dummyclient.get_apikey()
+
+    def test_max_attempts_none(self):
+        # a persistent transient error is tried once on each key
+        apikey_list = ["example2@gmail.com", "example22@gmail.com"]
+        manager = ApiKeyManager(
+            apikey_list=[
+                FlakyApiKey(apikey=apikey) for apikey in apikey_list],
+            reach_limit_exc=ReachLimitError,
+            retry_policy=RetryPolicy(
+                max_attempts=None, transient_exc=TransientError,
+            ),
+        )
+        with pytest.raises(TransientError):
+            manager.dummyclient.get_apikey()
+        assert manager.stats.usage_count_in_recent_n_seconds(3600) == 2
+
+    @pytest.mark.parametrize("strategy_class", [
+        FirstKeyStrategy, RandomStrategy, LeastUsedInWindowStrategy,
+    ])
+    def test_one_token_per_attempt(self, strategy_class):
+        apikey_list = ["example2@gmail.com", "example22@gmail.com",
+                       "example222@gmail.com", "example2222@gmail.com"]
+        manager = ApiKeyManager(
+            apikey_list=[
+                FlakyApiKey(apikey=apikey) for apikey in apikey_list],
+            reach_limit_exc=ReachLimitError,
+            strategy=strategy_class(),
+            rate_limits=[(100, 3600), ],
+            retry_policy=RetryPolicy(
+                max_attempts=len(apikey_list), transient_exc=TransientError,
+            ),
+        )
+        with pytest.raises(TransientError):
+            manager.dummyclient.get_apikey()
+        # each key took exactly one token, and was counted once
+        for limiter in manager._rate_limiters.values():
+            assert 99 <= limiter.buckets[0].tokens < 99.01
+        if strategy_class is LeastUsedInWindowStrategy:
+            assert set(manager.strategy._counts.values()) == {1}
+
+    def test_without_policy(self):
+        manager = create_manager()
+        with pytest.raises((ReachLimitError, TransientError)):
+            for _ in range(100):
+                manager.dummyclient.get_apikey()
+
+    def test_async(self):
+        async def main():
+            async with create_manager(
+                AsyncApiKeyManager,
+                retry_policy=RetryPolicy(
+                    max_attempts=len(apikeys), transient_exc=TransientError,
+                ),
+            ) as manager:
+                results = await asyncio.gather(*[
+                    manager.dummyclient.get_apikey_async()
+                    for _ in range(20)
+                ])
+                assert set(results) <= {
+                    "example3@gmail.com", "example99@gmail.com",
+                }
+
+        asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from apipool import ApiKeyManager
+from apipool.revival import ArchiveReason, RevivalScheduler
+from apipool.strategy import RoundRobinStrategy
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+# primary key -> whether quota is used up
+exhausted = dict()
+
+
+class QuotaClient(object):
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def get_apikey(self):
+        if exhausted.get(self.apikey):
+            raise ReachLimitError
+        return self.apikey
+
+
+class QuotaApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return QuotaClient(self.apikey)
+
+    def user_03_test_usable(self, client):
+        return not exhausted.get(self.apikey)
+
+
+class LongCooldownApiKey(QuotaApiKey):
+    revival_cooldown = {ArchiveReason.reach_limit: 3600}
+
+
+def create_manager(revival, apikey_list=None):
+    if apikey_list is None:
+        apikey_list = [QuotaApiKey(apikey=apikey) for apikey in apikeys]
+    return ApiKeyManager(
+        apikey_list=apikey_list,
+        reach_limit_exc=ReachLimitError,
+        revival=revival,
+    )
+
+
+def use_up(manager, primary_key):
+    exhausted[primary_key] = True
+    caller = manager.get_caller(manager.fetch_one(primary_key), "get_apikey")
+    with pytest.raises(ReachLimitError):
+        caller()
+
+
+class TestRevivalScheduler(object):
+    def setup_method(self, method):
+        exhausted.clear()
+
+    def test(self):
+        revival = RevivalScheduler(
+            cooldowns={ArchiveReason.reach_limit: 0.1}, check_interval=3600,
+        )
+        manager = create_manager(revival)
+        use_up(manager, apikeys[0])
+        assert apikeys[0] in manager.archived_apikey_chain
+
+        # cooldown not expired yet
+        assert revival.run_once() == []
+
+        # quota not reset yet, start another cooldown
+        time.sleep(0.1)
+        assert revival.run_once() == []
+        assert revival.run_once() == []
+        assert apikeys[0] in manager.archived_apikey_chain
+
+        # quota reset
+        exhausted[apikeys[0]] = False
+        time.sleep(0.1)
+        assert revival.run_once() == [apikeys[0], ]
+        assert apikeys[0] in manager.apikey_chain
+        assert apikeys[0] not in manager.archived_apikey_chain
+        assert len(manager._apikey_list) == len(apikeys)
+        assert manager.dummyclient.get_apikey() in apikeys
+        manager.close()
+
+    def test_cooldown(self):
+        revival = RevivalScheduler(
+            cooldowns={ArchiveReason.reach_limit: 0}, check_interval=3600,
+        )
+        manager = create_manager(revival, apikey_list=[
+            QuotaApiKey(apikey=apikeys[0]),
+            LongCooldownApiKey(apikey=apikeys[1]),
+        ])
+        use_up(manager, apikeys[0])
+        use_up(manager, apikeys[1])
+        exhausted.clear()
+
+        assert revival.run_once() == [apikeys[0], ]
+
+        # manually archived key is never revived
+        manager.remove_one(apikeys[0])
+        assert revival.run_once() == []
+        assert apikeys[0] in manager.archived_apikey_chain
+
+        # declared on api key class
+        assert revival.get_cooldown(
+            manager.archived_apikey_chain[apikeys[1]],
+            ArchiveReason.reach_limit,
+        ) == 3600
+        assert apikeys[1] in manager.archived_apikey_chain
+        manager.close()
+
+    def test_background(self):
+        revival = RevivalScheduler(
+            cooldowns={ArchiveReason.reach_limit: 0}, check_interval=0.01,
+        )
+        manager = create_manager(revival)
+        assert revival.is_alive
+        use_up(manager, apikeys[0])
+        exhausted.clear()
+        for _ in range(100):
+            if apikeys[0] in manager.apikey_chain:
+                break
+            time.sleep(0.01)
+        assert apikeys[0] in manager.apikey_chain
+        manager.close()
+        assert not revival.is_alive
+
+    def test_shared_state(self):
+        from apipool.shm import SharedKeyState
+
+        state = SharedKeyState(apikeys)
+        try:
+            revival = RevivalScheduler(
+                cooldowns={ArchiveReason.reach_limit: 0}, check_interval=3600,
+            )
+            manager = ApiKeyManager(
+                apikey_list=[QuotaApiKey(apikey=apikey) for apikey in apikeys],
+                reach_limit_exc=ReachLimitError,
+                rate_limits=[(1000, 1)],
+                shared_state=state,
+                strategy=RoundRobinStrategy(),
+                revival=revival,
+            )
+
+            # archived by another process
+            state.set_active(apikeys[0], False)
+            for _ in range(len(apikeys)):
+                manager.select_one()
+            assert apikeys[0] in manager.archived_apikey_chain
+            assert revival.run_once() == []
+
+            # revived by another process
+            state.set_active(apikeys[0], True)
+            assert revival.run_once() == [apikeys[0], ]
+            assert apikeys[0] in manager.apikey_chain
+            manager.close()
+        finally:
+            state.close()
+            state.unlink()
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import pytest
+import multiprocessing
+from apipool import ApiKeyManager, StatusCollection
+from apipool.tests import GoogleMapApiKey, ReachLimitError, apikeys
+
+pytestmark = pytest.mark.skipif(
+    (sys.version_info < (3, 8)) or (sys.platform == "win32"),
+    reason="requires multiprocessing.shared_memory and fork",
+)
+
+address = "123st, NewYork, NY 10001"
+
+
+def new_manager(state):
+    return ApiKeyManager(
+        apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in apikeys],
+        reach_limit_exc=ReachLimitError,
+        rate_limits=[(5, 3600), ],
+        shared_state=state,
+    )
+
+
+def worker(state):
+    manager = new_manager(state)
+    for _ in range(5):
+        manager.dummyclient.get_lat_lng_by_address(address)
+    manager.remove_one(apikeys[0])
+
+
+def spawn_worker(state):
+    # state is passed as argument, so the child re-attaches by name
+    manager = new_manager(state)
+    manager.dummyclient.get_lat_lng_by_address(address)
+
+
+@pytest.fixture()
+def state():
+    from apipool.shm import SharedKeyState
+
+    state = SharedKeyState(apikeys)
+    yield state
+    state.close()
+    state.unlink()
+
+
+class TestSharedKeyState(object):
+    def test_attach(self, state):
+        from apipool.shm import SharedKeyState
+
+        other = SharedKeyState(apikeys, name=state.name, create=False)
+        other.incr(apikeys[1], StatusCollection.c1_Success.id)
+        other.set_active(apikeys[2], False)
+        assert state.usage_count(apikeys[1]) == 1
+        assert not state.is_active(apikeys[2])
+        other.close()
+
+        with pytest.raises(ValueError):
+            SharedKeyState(apikeys[:2], name=state.name, create=False)
+
+    def test_multi_process(self, state):
+        ctx = multiprocessing.get_context("fork")
+        processes = [
+            ctx.Process(target=worker, args=(state,)) for _ in range(3)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+
+        assert state.usage_count(status_id=StatusCollection.c1_Success.id) == 15
+        assert not state.is_active(apikeys[0])
+
+        # key archived by other process is skipped, rate limit is shared,
+        # 4 keys * 5 calls, 15 used by other processes, apikeys[0] is archived
+        manager = new_manager(state)
+        n_success = 0
+        for _ in range(20):
+            try:
+                manager.dummyclient.get_lat_lng_by_address(address)
+                n_success += 1
+            except Exception:
+                break
+        assert apikeys[0] not in manager.apikey_chain
+        assert n_success == 20 - 15 - \
+            (5 - state.usage_count(apikeys[0]))
+
+    def test_spawn(self):
+        from apipool.shm import SharedKeyState
+
+        ctx = multiprocessing.get_context("spawn")
+        state = SharedKeyState(apikeys, context=ctx)
+        try:
+            process = ctx.Process(target=spawn_worker, args=(state,))
+            process.start()
+            process.join()
+            assert process.exitcode == 0
+            assert state.usage_count() == 1
+        finally:
+            state.close()
+            state.unlink()
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import pytest
+from collections import OrderedDict
+from apipool.backends import NullStatsCollector
+from apipool.retry import RetryPolicy
+from apipool.strategy import EwmaStrategy
+from apipool.simulation import (
+    SimulatedReachLimitError,
+    SimulatedTransientError,
+    constant, uniform, exponential, lognormal,
+    KeyProfile, SimulatedApiKey, Simulation, format_reports,
+)
+
+
+class TestDistribution(object):
+    def test(self):
+        rnd = random.Random(1)
+        assert constant(0.1)(rnd) == 0.1
+        assert all(0.1 <= uniform(0.1, 0.2)(rnd) <= 0.2 for _ in range(100))
+        values = sorted(exponential(0.1)(rnd) for _ in range(10000))
+        assert sum(values) / len(values) == pytest.approx(0.1, rel=0.05)
+        values = sorted(lognormal(0.1, 0.5)(rnd) for _ in range(10000))
+        assert values[5000] == pytest.approx(0.1, rel=0.05)
+
+
+class TestSimulatedApiKey(object):
+    def test(self):
+        apikey = SimulatedApiKey(
+            "key", KeyProfile(quota=3, period=3600), random_seed=1)
+        apikey.connect_client()
+        for _ in range(3):
+            assert apikey._client.request() == "key"
+        assert not apikey.is_usable()
+        with pytest.raises(SimulatedReachLimitError):
+            apikey._client.request()
+        assert apikey.n_rejected == 1
+        assert apikey.get_utilisation(1) == 1.0
+        assert apikey.get_utilisation(3601) == 0.5
+
+    def test_error_rate(self):
+        apikey = SimulatedApiKey(
+            "key", KeyProfile(error_rate=0.5), random_seed=1)
+        apikey.connect_client()
+        n_error = 0
+        for _ in range(1000):
+            try:
+                apikey._client.request()
+            except SimulatedTransientError:
+                n_error += 1
+        assert 400 < n_error < 600
+        assert apikey.n_transient_error == n_error
+        assert apikey.get_utilisation(1) is None
+
+
+profiles = [
+    KeyProfile(latency=constant(0.001), quota=50, period=3600),
+    KeyProfile(latency=constant(0.001), quota=50, period=3600),
+    KeyProfile(latency=constant(0.001), quota=50, period=3600,
+               error_rate=0.2),
+]
+
+
+class TestSimulation(object):
+    def test_closed_loop(self):
+        simulation = Simulation(profiles, random_seed=1)
+        manager = simulation.create_manager(stats=NullStatsCollector())
+        report = simulation.run_closed_loop(
+            manager, concurrency=4, n_requests=200)
+        assert report.load == "closed"
+        assert report.n_requests == 200
+
+        # 150 calls of quota, part of the third key's are transient errors
+        assert report.n_success < 150
+        assert report.errors["SimulatedTransientError"] > 0
+        assert report.n_success + report.errors["SimulatedTransientError"] \
+            <= 150
+        assert report.latency.count == report.n_success
+        assert report.latency.percentile(50) >= 0.001
+        assert report.throughput > 0
+        assert report.utilisation["simulated-0"] == 1.0
+        assert 0 < report.mean_utilisation < 1
+        assert report.to_dict()["n_success"] == report.n_success
+        assert "SimulationReport" in repr(report)
+
+    def test_open_loop(self):
+        simulation = Simulation(profiles[:2], random_seed=1)
+        manager = simulation.create_manager(stats=NullStatsCollector())
+        report = simulation.run_open_loop(
+            manager, rate=1000, n_requests=50, max_concurrency=10)
+        assert report.load == "open"
+        assert report.n_success == 50
+        assert report.mean_utilisation == 0.5
+
+        report = simulation.run_open_loop(
+            simulation.create_manager(stats=NullStatsCollector()),
+            rate=1000, n_requests=50, max_concurrency=10, poisson=False)
+        assert report.n_success == 50
+
+    def test_compare(self):
+        simulation = Simulation(profiles, random_seed=1)
+        reports = simulation.compare(OrderedDict([
+            ("random", dict(stats=NullStatsCollector())),
+            ("ewma_retry", lambda: dict(
+                stats=NullStatsCollector(),
+                strategy=EwmaStrategy(),
+                retry_policy=RetryPolicy(
+                    max_attempts=None,
+                    transient_exc=(SimulatedTransientError,),
+                ),
+            )),
+        ]), load="closed", concurrency=4, n_requests=100)
+        assert list(reports) == ["random", "ewma_retry"]
+
+        # transient errors are retried on other keys
+        assert "SimulatedTransientError" in reports["random"].errors
+        assert reports["ewma_retry"].n_success == 100
+
+        text = format_reports(reports)
+        assert len(text.splitlines()) == 3
+        assert "ewma_retry" in text
+
+        with pytest.raises(ValueError):
+            simulation.compare(dict(), load="other")
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
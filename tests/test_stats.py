@@ -2,8 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import time
 import random
-from apipool.stats import StatsCollector, StatusCollection
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, DateTime, ForeignKey, inspect,
+)
+from apipool.stats import (
+    StatsCollector, StatusCollection, Event, EventRollup,
+    create_durable_sqlite_engine, migrate_event_table, MINUTE, HOUR,
+)
 from apipool.tests import GoogleMapApiKey, apikeys
 from sqlalchemy_mate import engine_creator
 
@@ -55,6 +63,313 @@ class TestDashboardConstructor(object):
         assert len(collector._cache_apikey) == 4
 
 
+class TestBufferedWrite(object):
+    def test(self):
+        engine = engine_creator.create_sqlite()
+        collector = StatsCollector(engine=engine, buffer_size=10)
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+
+        for _ in range(15):
+            collector.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        assert len(collector._buffer) == 5
+        assert collector.ses.query(Event).count() == 10
+
+        # unflushed events are visible to queries
+        assert collector.usage_count_in_recent_n_seconds(3600) == 15
+        assert collector.usage_count_in_recent_n_seconds(
+            3600, primary_key=apikeys[0]) == 15
+        assert collector.usage_count_in_recent_n_seconds(
+            3600, status_id=StatusCollection.c5_Failed.id) == 0
+        assert collector.usage_count_stats_in_recent_n_seconds(3600) == {
+            apikeys[0]: 15}
+
+        assert collector.flush() == 5
+        assert collector.flush() == 0
+        assert collector.ses.query(Event).count() == 15
+
+    def test_same_finish_time(self):
+        engine = engine_creator.create_sqlite()
+        collector = StatsCollector(engine=engine, buffer_size=3)
+        collector.add_all_apikey([GoogleMapApiKey(apikey=apikeys[0])])
+        finished_at = datetime.now()
+        for _ in range(3):
+            collector.add_event(
+                apikeys[0], StatusCollection.c1_Success.id, finished_at)
+        assert len(collector._buffer) == 0
+        assert collector.ses.query(Event).count() == 3
+        event = collector.ses.query(Event).first()
+        assert event.finished_datetime == finished_at
+
+    def test_max_age(self):
+        engine = engine_creator.create_sqlite()
+        collector = StatsCollector(engine=engine, buffer_max_age=0)
+        collector.add_all_apikey([GoogleMapApiKey(apikey=apikeys[0])])
+        collector.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        assert len(collector._buffer) == 0
+
+    def test_close(self):
+        engine = engine_creator.create_sqlite()
+        with StatsCollector(engine=engine, buffer_size=100) as collector:
+            collector.add_all_apikey([GoogleMapApiKey(apikey=apikeys[0])])
+            collector.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        assert len(collector._buffer) == 0
+        assert collector.usage_count_in_recent_n_seconds(3600) == 1
+
+
+class TestSlidingWindow(object):
+    def test(self):
+        engine = engine_creator.create_sqlite()
+        collector = StatsCollector(engine=engine, window=600)
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        for primary_key in apikeys[:2]:
+            for status_id in StatusCollection.get_id_list():
+                collector.add_event(primary_key, status_id)
+        collector.add_events([
+            (apikeys[2], StatusCollection.c1_Success.id, datetime.now()),
+        ])
+
+        # answered by sliding window
+        assert collector.usage_count_in_recent_n_seconds(600) == 7
+        assert collector.usage_count_in_recent_n_seconds(
+            600, primary_key=apikeys[0]) == 3
+        assert collector.usage_count_in_recent_n_seconds(
+            600, status_id=StatusCollection.c1_Success.id) == 3
+        assert collector.usage_count_stats_in_recent_n_seconds(600) == {
+            apikeys[0]: 3, apikeys[1]: 3, apikeys[2]: 1,
+        }
+
+        # answered by database
+        assert collector.usage_count_in_recent_n_seconds(3600) == 7
+        assert collector.usage_count_stats_in_recent_n_seconds(3600) == \
+            collector.usage_count_stats_in_recent_n_seconds(600)
+
+
+class TestDurableSqlite(object):
+    def test(self, tmpdir):
+        path = str(tmpdir.join("stats.sqlite"))
+        collector = StatsCollector.from_sqlite_file(path, buffer_size=10)
+        with collector.engine.connect() as conn:
+            assert conn.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert conn.execute("PRAGMA synchronous").scalar() == 1
+
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        for _ in range(25):
+            collector.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        collector.close()
+        collector.engine.dispose()
+
+        # history survives restart
+        collector = StatsCollector(engine=create_durable_sqlite_engine(path))
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        assert collector.usage_count_in_recent_n_seconds(3600) == 25
+        assert len(collector._cache_apikey) == 4
+        collector.close()
+
+
+class TestMigration(object):
+    def test(self, tmpdir):
+        path = str(tmpdir.join("stats.sqlite"))
+        engine = create_durable_sqlite_engine(path)
+
+        # tables created by older versions
+        metadata = MetaData()
+        Table("apikey", metadata,
+              Column("id", Integer, primary_key=True),
+              Column("key", Integer))
+        Table("status", metadata,
+              Column("id", Integer, primary_key=True),
+              Column("description", Integer))
+        legacy_table = Table(
+            "event", metadata,
+            Column("apikey_id", Integer, ForeignKey("apikey.id"),
+                   primary_key=True),
+            Column("finished_at", DateTime, primary_key=True),
+            Column("status_id", Integer, ForeignKey("status.id")),
+        )
+        metadata.create_all(engine)
+        now = datetime.now()
+        with engine.begin() as conn:
+            conn.execute(metadata.tables["apikey"].insert(), [
+                {"id": 1, "key": apikeys[0]},
+            ])
+            conn.execute(legacy_table.insert(), [
+                {
+                    "apikey_id": 1,
+                    "finished_at": now - timedelta(seconds=i),
+                    "status_id": StatusCollection.c1_Success.id,
+                }
+                for i in range(25)
+            ] + [
+                {
+                    "apikey_id": 1,
+                    "finished_at": now - timedelta(days=1),
+                    "status_id": StatusCollection.c5_Failed.id,
+                }
+            ])
+
+        collector = StatsCollector(engine=engine)
+        collector.add_all_apikey([GoogleMapApiKey(apikey=apikeys[0])])
+        assert collector.usage_count_in_recent_n_seconds(3600) == 25
+        assert collector.usage_count_in_recent_n_seconds(
+            2 * 86400, status_id=StatusCollection.c5_Failed.id) == 1
+        collector.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        assert collector.usage_count_in_recent_n_seconds(3600) == 26
+
+        insp = inspect(engine)
+        assert "event_migrating" not in insp.get_table_names()
+        assert {index["name"] for index in insp.get_indexes("event")} == {
+            index.name for index in Event.__table__.indexes
+        }
+        assert migrate_event_table(engine) is None
+        collector.close()
+
+    def test_add_column(self):
+        engine = engine_creator.create_sqlite()
+        metadata = MetaData()
+        Table("event", metadata,
+              Column("id", Integer, primary_key=True),
+              Column("apikey_id", Integer),
+              Column("finished_at", Integer),
+              Column("status_id", Integer))
+        metadata.create_all(engine)
+
+        collector = StatsCollector(engine=engine, store_duration=True)
+        assert "duration" in [
+            column["name"] for column in inspect(engine).get_columns("event")
+        ]
+        collector.add_all_apikey([GoogleMapApiKey(apikey=apikeys[0])])
+        collector.add_event(
+            apikeys[0], StatusCollection.c1_Success.id, duration=0.5)
+        assert collector.ses.query(Event).one().duration == 500000
+
+
+class TestRollup(object):
+    def test(self):
+        engine = engine_creator.create_sqlite()
+        collector = StatsCollector(
+            engine=engine,
+            rollup_after=3600,
+            hourly_rollup_after=86400,
+            retention=7 * 86400,
+            rollup_interval=3600,
+        )
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        now = time.time()
+        success_id = StatusCollection.c1_Success.id
+        failed_id = StatusCollection.c5_Failed.id
+        collector.add_events(
+            [(apikeys[0], success_id, now - i) for i in range(10)] +
+            [(apikeys[0], success_id, now - 2 * 3600 - i) for i in range(5)] +
+            [(apikeys[1], failed_id, now - 2 * 86400 - i) for i in range(3)] +
+            [(apikeys[1], failed_id, now - 30 * 86400)]
+        )
+        # writes never roll up, the first automatic run is one interval away
+        assert collector.ses.query(Event).count() == 19
+        assert collector.maybe_rollup() is False
+        assert collector.rollup(now) == 9
+        assert collector.ses.query(Event).count() == 10
+        counts = {MINUTE: 0, HOUR: 0}
+        for row in collector.ses.query(EventRollup):
+            counts[row.resolution] += row.count
+        assert counts == {MINUTE: 15, HOUR: 3}
+        collector.ses.remove()
+
+        # raw and rolled up events are combined
+        assert collector.usage_count_in_recent_n_seconds(
+            30 * 86400 - 3600) == 18
+        assert collector.usage_count_in_recent_n_seconds(
+            86400, primary_key=apikeys[0]) == 15
+        assert collector.usage_count_in_recent_n_seconds(
+            30 * 86400 - 3600, status_id=failed_id) == 3
+        assert collector.usage_count_stats_in_recent_n_seconds(
+            30 * 86400 - 3600) == {apikeys[0]: 15, apikeys[1]: 3}
+
+        # events rolled up later are merged into existing rows
+        collector.add_events(
+            [(apikeys[0], success_id, now - 2 * 3600 - i) for i in range(5)]
+        )
+        assert collector.rollup(now) == 5
+        assert collector.usage_count_in_recent_n_seconds(86400) == 20
+        assert collector.rollup(now) == 0
+
+    def test_rollup_interval(self):
+        collector = StatsCollector(
+            engine=engine_creator.create_sqlite(),
+            rollup_after=3600,
+            rollup_interval=0,
+        )
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        collector.add_events([
+            (apikeys[0], StatusCollection.c1_Success.id, time.time() - 7200),
+        ])
+        assert collector.ses.query(Event).count() == 1
+        assert collector.maybe_rollup() is True
+        assert collector.ses.query(Event).count() == 0
+
+        # None turns the automatic rollup off
+        collector = StatsCollector(
+            engine=engine_creator.create_sqlite(),
+            rollup_after=3600,
+            rollup_interval=None,
+        )
+        assert collector.maybe_rollup() is False
+
+
+class TestCounter(object):
+    @pytest.mark.parametrize("native_upsert", [True, False])
+    def test(self, native_upsert):
+        engine = engine_creator.create_sqlite()
+        collector = StatsCollector(engine=engine)
+        if not native_upsert:
+            collector._upsert_sql = None
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        now = time.time()
+        success_id = StatusCollection.c1_Success.id
+        for i in range(3):
+            collector.add_events(
+                [(apikeys[0], success_id, now - i * 40 - j) for j in range(5)]
+            )
+        collector.add_event(apikeys[1], StatusCollection.c5_Failed.id, now)
+
+        # one row per api key, status and minute, updated by every write
+        rows = collector.ses.query(EventRollup).all()
+        assert sum(row.count for row in rows) == 16
+        assert len(rows) <= 2 + 3
+        assert {row.resolution for row in rows} == {MINUTE}
+        collector.ses.remove()
+
+        assert collector.usage_count_in_recent_n_seconds(3600) == 16
+        assert collector.usage_count_in_recent_n_seconds(
+            3600, primary_key=apikeys[0], status_id=success_id) == 15
+        assert collector.usage_count_stats_in_recent_n_seconds(3600) == {
+            apikeys[0]: 15, apikeys[1]: 1}
+
+        # the partial minute at the start of the window is counted from raw
+        # events, so the count is exact
+        for n_seconds in [10, 50, 90, 130]:
+            n_seconds_before = now - n_seconds
+            expected = len([
+                i for i in range(3) for j in range(5)
+                if now - i * 40 - j >= n_seconds_before
+            ])
+            assert collector.usage_count_in_recent_n_seconds(
+                n_seconds, primary_key=apikeys[0]) == expected
+
+
 if __name__ == "__main__":
     import os
 
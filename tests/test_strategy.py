@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from collections import Counter
+from apipool import ApiKeyManager
+from apipool.strategy import (
+    RandomStrategy,
+    RoundRobinStrategy,
+    LeastRecentlyUsedStrategy,
+    LeastUsedInWindowStrategy,
+    WeightedStrategy,
+    EwmaStrategy,
+)
+from apipool.stats import StatusCollection
+from apipool.tests import GoogleMapApiKey
+
+address = "123st, NewYork, NY 10001"
+keys = ["example%s@gmail.com" % i for i in range(5)]
+
+
+def new_manager(strategy):
+    return ApiKeyManager(
+        apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in keys],
+        strategy=strategy,
+    )
+
+
+class FlakyClient(object):
+    """
+    The first key fails at once, the others take 2 milliseconds.
+    """
+
+    def __init__(self, apikey):
+        self.apikey = apikey
+
+    def get_lat_lng_by_address(self, address):
+        if self.apikey == keys[0]:
+            raise ValueError
+        time.sleep(0.002)
+        return {"lat": 40.762882, "lng": -73.973700}
+
+
+class FlakyApiKey(GoogleMapApiKey):
+    def user_02_create_client(self):
+        return FlakyClient(self.apikey)
+
+    def user_03_test_usable(self, client):
+        return True
+
+
+def used_keys(manager, n):
+    return [manager.select_one().primary_key for _ in range(n)]
+
+
+class TestStrategy(object):
+    def test_bind(self):
+        strategy = RandomStrategy()
+        new_manager(strategy)
+        with pytest.raises(ValueError):
+            new_manager(strategy)
+
+    def test_random(self):
+        manager = new_manager(None)
+        assert isinstance(manager.strategy, RandomStrategy)
+        assert set(used_keys(manager, 200)) == set(keys)
+
+    @pytest.mark.parametrize("strategy_class", [
+        RoundRobinStrategy,
+        LeastRecentlyUsedStrategy,
+        LeastUsedInWindowStrategy,
+    ])
+    def test_even(self, strategy_class):
+        manager = new_manager(strategy_class())
+        counter = Counter(used_keys(manager, 50))
+        assert set(counter.values()) == {10}
+
+        manager.remove_one(keys[0])
+        counter = Counter(used_keys(manager, 40))
+        assert keys[0] not in counter
+        assert set(counter.values()) == {10}
+
+        manager.add_one(GoogleMapApiKey(apikey=keys[0]))
+        assert keys[0] in used_keys(manager, 5)
+
+    def test_lru(self):
+        manager = new_manager(LeastRecentlyUsedStrategy())
+        assert used_keys(manager, 5) == keys
+        assert used_keys(manager, 5) == keys
+
+    def test_least_used_in_window(self):
+        manager = new_manager(LeastUsedInWindowStrategy(n_seconds=3600))
+        for _ in range(5):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        # refresh counts from stats, every key has been used once
+        manager.strategy.refresh()
+        assert set(manager.strategy._counts.values()) == {1}
+        counter = Counter(used_keys(manager, 10))
+        assert set(counter.values()) == {2}
+
+    def test_weighted(self):
+        strategy = WeightedStrategy(weights={keys[0]: 0, keys[1]: 9})
+        manager = new_manager(strategy)
+        counter = Counter(used_keys(manager, 1200))
+        assert keys[0] not in counter
+        assert counter[keys[1]] > counter[keys[2]]
+
+        manager.remove_one(keys[1])
+        assert keys[1] not in used_keys(manager, 100)
+
+    @pytest.mark.parametrize("check_usable", [True, False])
+    def test_ewma(self, check_usable):
+        manager = ApiKeyManager(
+            apikey_list=[FlakyApiKey(apikey=apikey) for apikey in keys],
+            strategy=EwmaStrategy(decay_time=3600),
+        )
+        if check_usable:
+            manager.check_usable()
+            # no duration known yet, no key is free
+            assert manager.strategy.get_cost(keys[0]) == 0.0
+
+        n_failed = 0
+        for _ in range(300):
+            try:
+                manager.dummyclient.get_lat_lng_by_address(address)
+            except ValueError:
+                n_failed += 1
+        # the fast failing key is dropped after its first failures
+        assert n_failed < 10
+        strategy = manager.strategy
+        assert strategy.get_cost(keys[0]) > strategy.error_penalty * 0.1
+        assert strategy.get_cost(keys[0]) > 10 * strategy.get_cost(keys[1])
+
+    def test_ewma_decay(self):
+        strategy = EwmaStrategy(decay_time=0.01)
+        new_manager(strategy)
+        strategy.on_result(keys[0], StatusCollection.c1_Success.id, 1.0)
+        strategy.on_result(keys[0], StatusCollection.c5_Failed.id, None)
+        cost = strategy.get_cost(keys[0])
+        time.sleep(0.05)
+        assert strategy.get_cost(keys[0]) < cost / 100
+
+    def test_ewma_feedback(self):
+        manager = new_manager(EwmaStrategy())
+        for _ in range(20):
+            manager.dummyclient.get_lat_lng_by_address(address)
+        assert set(manager.strategy._stats) == set(keys)
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
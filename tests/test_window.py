@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from datetime import datetime
+from apipool.window import SlidingWindowCounter, to_timestamp
+
+
+class TestSlidingWindowCounter(object):
+    def test(self):
+        counter = SlidingWindowCounter(window=60, resolution=1)
+        now = 1000000.0
+        for i in range(120):
+            counter.add("k1", 1, timestamp=now - i)
+        counter.add("k1", 5, timestamp=now)
+        counter.add("k2", 5, timestamp=now - 5)
+
+        assert counter.count(10, now=now) == 10 + 1 + 1
+        assert counter.count(10, primary_key="k1", now=now) == 11
+        assert counter.count(10, primary_key="k1", status_id=5, now=now) == 1
+        assert counter.count(10, primary_key="k3", now=now) == 0
+        assert counter.count(60, primary_key="k1", status_id=1, now=now) == 60
+        assert counter.count_by_key(5, now=now) == {"k1": 6}
+        assert list(counter.count_by_key(10, now=now).items()) == [
+            ("k1", 11), ("k2", 1),
+        ]
+
+        # old buckets expire as time moves on
+        assert counter.count(60, now=now + 30) == 30 + 1 + 1
+        assert counter.count(60, now=now + 60) == 0
+
+        # event older than the ring slot is ignored
+        counter.add("k1", 1, timestamp=now - 60)
+        assert counter.count(60, primary_key="k1", now=now) == 61
+
+    def test_covers(self):
+        counter = SlidingWindowCounter(window=60, resolution=10)
+        assert counter.n_buckets == 6
+        assert counter.covers(60)
+        assert not counter.covers(61)
+        with pytest.raises(ValueError):
+            SlidingWindowCounter(window=0)
+
+    def test_datetime(self):
+        counter = SlidingWindowCounter(window=60)
+        dt = datetime.now()
+        counter.add("k1", 1, timestamp=dt)
+        assert counter.count(60, now=to_timestamp(dt)) == 1
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
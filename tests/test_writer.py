@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from apipool import ApiKeyManager, StatusCollection
+from apipool.stats import StatsCollector
+from apipool.writer import OverflowPolicy, StatsWriter
+from apipool.tests import GoogleMapApiKey, apikeys
+from sqlalchemy.pool import StaticPool
+from sqlalchemy_mate import engine_creator
+
+
+def new_collector():
+    collector = StatsCollector(engine=engine_creator.create_sqlite())
+    collector.add_all_apikey(
+        [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+    )
+    return collector
+
+
+class TestStatsWriter(object):
+    def test_overflow_policy(self):
+        with pytest.raises(ValueError):
+            StatsWriter(new_collector(), overflow_policy="unknown")
+
+        # writer is not started, so the queue fills up
+        writer = StatsWriter(
+            new_collector(), maxsize=5, overflow_policy=OverflowPolicy.drop_new,
+        )
+        for _ in range(8):
+            writer.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        assert writer.qsize == 5
+        assert writer.n_dropped == 3
+
+        writer = StatsWriter(
+            new_collector(), maxsize=5,
+            overflow_policy=OverflowPolicy.drop_oldest,
+        )
+        for _ in range(4):
+            writer.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        for _ in range(4):
+            writer.add_event(apikeys[1], StatusCollection.c1_Success.id)
+        assert writer.qsize == 5
+        assert writer.n_dropped == 3
+        writer.flush()
+        assert writer.stats.usage_count_in_recent_n_seconds(3600) == 5
+        assert writer.stats.usage_count_in_recent_n_seconds(
+            3600, primary_key=apikeys[1]) == 4
+
+
+    def test_thread_local_memory_engine(self):
+        # each thread would get its own empty database
+        writer = StatsWriter(new_collector())
+        with pytest.raises(ValueError):
+            writer.start()
+        assert not writer.is_alive
+
+        with pytest.raises(ValueError):
+            ApiKeyManager(
+                apikey_list=[
+                    GoogleMapApiKey(apikey=apikey) for apikey in apikeys],
+                db_engine=engine_creator.create_sqlite(),
+                async_stats=True,
+            )
+
+    def test_static_pool_engine(self):
+        engine = engine_creator.create_sqlite(
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        with ApiKeyManager(
+            apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in apikeys],
+            db_engine=engine,
+            async_stats=True,
+        ) as manager:
+            assert manager.stats_writer.is_alive
+            for _ in range(10):
+                manager.add_event(apikeys[0], StatusCollection.c1_Success.id)
+            manager.flush()
+            assert manager.stats.usage_count_in_recent_n_seconds(3600) == 10
+
+    def test_rollup(self):
+        engine = engine_creator.create_sqlite(
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        collector = StatsCollector(
+            engine=engine, rollup_after=3600, rollup_interval=0,
+        )
+        collector.add_all_apikey(
+            [GoogleMapApiKey(apikey=apikey) for apikey in apikeys]
+        )
+        collector.add_events([
+            (apikeys[0], StatusCollection.c1_Success.id, time.time() - 7200),
+        ])
+        assert collector.query_event_in_recent_n_seconds(86400).count() == 1
+
+        # the writer thread runs the rollup, not the api caller
+        writer = StatsWriter(collector).start()
+        writer.add_event(apikeys[0], StatusCollection.c1_Success.id)
+        writer.flush()
+        assert collector.query_event_in_recent_n_seconds(86400).count() == 1
+        assert collector.usage_count_in_recent_n_seconds(86400) == 2
+        writer.join()
+
+
+class TestAsyncApiKeyManager(object):
+    def test(self):
+        address = "123st, NewYork, NY 10001"
+        with ApiKeyManager(
+            apikey_list=[GoogleMapApiKey(apikey=apikey) for apikey in apikeys],
+            async_stats=True,
+        ) as manager:
+            assert manager.stats_writer.is_alive
+            for _ in range(100):
+                manager.dummyclient.get_lat_lng_by_address(address)
+            manager.flush()
+            assert manager.stats.usage_count_in_recent_n_seconds(3600) == 100
+        assert not manager.stats_writer.is_alive
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])